@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+"""
+Benchmarks the instance state evaluator in instance_states.py against
+synthetic fleets and checks the results against regression thresholds.
+
+    ./benchmark-instance-states.py --sizes 1000,10000,100000
+    ./benchmark-instance-states.py --thresholds benchmark-thresholds.json
+    ./benchmark-instance-states.py --generate fleet.jsonl --sizes 5000
+
+Runs offline; no Relay or GCP access is needed.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ZONES = ['us-west1-a', 'us-west1-b', 'us-west1-c']
+GEOS = [('amer', 5), ('emea', 3), ('apj', 2)]
+LIFETIMES = [('indefinite', 3), ('1w', 2), ('2w', 2), ('4w', 2), ('12w', 2), ('52w', 1), ('3m', 1), ('1y', 1), ('24h', 1)]
+WORKHOURS = [(None, 6), ('7-18', 1), ('9-17', 1), ('8-20', 1), ('0-23', 1), ('8-12_13-17', 1), ('mon-thu_8-18_fri_8-14', 1)]
+RUNSCHEDULES = [(None, 5), ('weekdays', 2), ('daily', 2), ('continuous', 1)]
+STATUSES = [('RUNNING', 6), ('TERMINATED', 3), ('SUSPENDED', 1)]
+
+# Ways a generated instance can be mislabelled, with the share of the fleet
+MALFORMED = [
+    ('no_labels', 0.01),
+    ('missing_owner', 0.02),
+    ('bad_geo', 0.01),
+    ('bad_lifetime', 0.01),
+    ('bad_workhours', 0.01),
+]
+
+# Functions reported by the benchmark, in report order
+BENCHMARKS = [
+    'instance_record',
+    'validate_labels',
+    'get_termination_date',
+    'should_be_started',
+    'evaluate_instances',
+    'states_to_slack_messages',
+    'simulate_fleet',
+]
+
+def load_evaluator():
+    import instance_states
+    return instance_states
+
+def weighted(rng, choices):
+    values = [value for value, _weight in choices]
+    weights = [weight for _value, weight in choices]
+    return rng.choices(values, weights)[0]
+
+def gcp_timestamp(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%S.') + '{0:03d}'.format(date.microsecond // 1000) + '-07:00'
+
+def generate_instance(rng, index, now, owners):
+    """
+    :param rng: The random.Random generating the fleet.
+    :param index: The number of the instance in the fleet.
+    :param now: The time the fleet is generated for.
+    :param owners: The owner names to pick from.
+
+    Returns a GCP instance resource with a realistic label mix.
+    """
+    created = now - timedelta(days=rng.uniform(0, 400))
+    labels = {
+        'owner': rng.choice(owners),
+        'geo': weighted(rng, GEOS),
+        'lifetime': weighted(rng, LIFETIMES),
+    }
+    for label, choices in (('workhours', WORKHOURS), ('runschedule', RUNSCHEDULES)):
+        value = weighted(rng, choices)
+        if value is not None:
+            labels[label] = value
+    if rng.random() < 0.5:
+        labels['autostart'] = 'true' if rng.random() < 0.8 else 'false'
+    if rng.random() < 0.2:
+        labels['shutdown_type'] = 'suspend'
+    if rng.random() < 0.05:
+        labels['stopped_until'] = (now + timedelta(days=rng.randint(-10, 20))).strftime('%Y-%m-%d')
+    if rng.random() < 0.05:
+        labels['termination_date'] = (now + timedelta(days=rng.randint(-30, 60))).strftime('%Y-%m-%d')
+    if rng.random() < 0.03:
+        labels['disabled'] = 'true'
+
+    roll = rng.random()
+    for kind, share in MALFORMED:
+        if roll < share:
+            if kind == 'no_labels':
+                labels = None
+            elif kind == 'missing_owner':
+                del labels['owner']
+            elif kind == 'bad_geo':
+                labels['geo'] = 'mars'
+            elif kind == 'bad_lifetime':
+                labels['lifetime'] = 'forever'
+            elif kind == 'bad_workhours':
+                labels['workhours'] = '9to5'
+            break
+        roll -= share
+
+    zone = ZONES[index % len(ZONES)]
+    return {
+        'name': 'instance-{0:06d}'.format(index),
+        'zone': 'https://www.googleapis.com/compute/v1/projects/benchmark/zones/{0}'.format(zone),
+        'status': weighted(rng, STATUSES),
+        'creationTimestamp': gcp_timestamp(created),
+        'labels': labels
+    }
+
+def generate_fleet(size, seed=0, now=None):
+    """
+    :param size: The number of instances in the fleet.
+    :param seed: The seed of the fleet, the same seed gives the same fleet.
+    :param now: The time the fleet is generated for.
+
+    Returns a list of synthetic GCP instances.
+    """
+    rng = random.Random(seed)
+    now = now or load_evaluator().timenow_with_utc()
+    owners = ['owner_{0}'.format(i) for i in range(max(10, size // 50))]
+    return [generate_instance(rng, index, now, owners) for index in range(size)]
+
+def reset_caches(evaluator):
+    """Start each benchmark cold so cached results do not carry over."""
+    evaluator.DEFAULT_CONFIG = evaluator.EvaluatorConfig()
+    evaluator.parse_label_date.cache_clear()
+    evaluator.parse_lifetime_delta.cache_clear()
+
+def timed(function, items):
+    """Returns the number of items processed per second by the function."""
+    start = time.perf_counter()
+    for item in items:
+        try:
+            function(item)
+        except Exception:
+            # Invalid instances raise; that is part of the work being measured
+            pass
+    elapsed = time.perf_counter() - start
+    return len(items) / elapsed if elapsed > 0 else float('inf')
+
+def run_benchmarks(evaluator, fleet, workers=1):
+    """
+    :param evaluator: The loaded evaluator module.
+    :param fleet: A list of GCP instances.
+    :param workers: The processes of the parallel evaluation, which is only
+    measured when this is more than 1.
+
+    Returns a dict of benchmark name to instances per second.
+    """
+    results = {}
+
+    reset_caches(evaluator)
+    results['instance_record'] = timed(lambda i: evaluator.InstanceRecord(i), fleet)
+    records = [evaluator.InstanceRecord(instance) for instance in fleet]
+    running = [record for record in records if record.status == 'RUNNING']
+    stopped = [record for record in records if record.status != 'RUNNING']
+
+    reset_caches(evaluator)
+    results['validate_labels'] = timed(evaluator.validate_labels, records)
+    reset_caches(evaluator)
+    results['get_termination_date'] = timed(evaluator.get_termination_date, running)
+    reset_caches(evaluator)
+    results['should_be_started'] = timed(evaluator.should_be_started, stopped)
+
+    reset_caches(evaluator)
+    states = {}
+    start = time.perf_counter()
+    for decision in evaluator.evaluate_instances((None, instance) for instance in fleet):
+        if decision.state:
+            states.setdefault(decision.state, {})[evaluator.instance_display_name(decision.record)] = decision.reason
+    elapsed = time.perf_counter() - start
+    results['evaluate_instances'] = len(fleet) / elapsed
+
+    if workers > 1:
+        reset_caches(evaluator)
+        start = time.perf_counter()
+        for decision in evaluator.evaluate_instances_parallel(((None, instance) for instance in fleet), workers):
+            pass
+        elapsed = time.perf_counter() - start
+        results['evaluate_parallel'] = len(fleet) / elapsed
+
+    reported = sum(len(instances) for instances in states.values())
+    start = time.perf_counter()
+    evaluator.states_to_slack_messages(states)
+    elapsed = time.perf_counter() - start
+    results['states_to_slack_messages'] = reported / elapsed if elapsed > 0 else float('inf')
+
+    # A week at 15 minute steps, the default forecast window
+    reset_caches(evaluator)
+    start = time.perf_counter()
+    evaluator.simulate_fleet(((None, instance) for instance in fleet), evaluator.FleetSimulation(evaluator.timenow_with_utc()))
+    elapsed = time.perf_counter() - start
+    results['simulate_fleet'] = len(fleet) / elapsed
+    return results
+
+def check_thresholds(size, results, thresholds):
+    """
+    :param size: The fleet size the results are for.
+    :param results: The dict from `run_benchmarks`.
+    :param thresholds: A dict of benchmark name to the minimum instances per
+    second, optionally keyed by fleet size first.
+
+    Returns a list of the benchmarks that are slower than their threshold.
+    """
+    limits = thresholds.get(str(size), thresholds)
+    failures = []
+    for name, minimum in limits.items():
+        if isinstance(minimum, dict) or name not in results:
+            continue
+        if results[name] < minimum:
+            failures.append('{0} at {1} instances: {2:,.0f}/s is below {3:,.0f}/s'.format(name, size, results[name], minimum))
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the GCP instance state evaluator.')
+    parser.add_argument('--sizes', default='1000,10000,100000', help='Comma separated fleet sizes')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic fleet')
+    parser.add_argument('--thresholds', help='JSON file of minimum instances per second per benchmark')
+    parser.add_argument('--workers', type=int, default=1, help='Also measure the parallel evaluation with this many processes')
+    parser.add_argument('--generate', metavar='FILE', help='Write a JSON-lines fleet of the first size and exit')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    evaluator = load_evaluator()
+
+    if args.generate:
+        with open(args.generate, 'w') as fh:
+            for instance in generate_fleet(sizes[0], args.seed):
+                fh.write(json.dumps(instance) + '\n')
+        print('Wrote {0} instances to {1}'.format(sizes[0], args.generate))
+        return 0
+
+    thresholds = None
+    if args.thresholds:
+        with open(args.thresholds) as fh:
+            thresholds = json.load(fh)
+
+    failures = []
+    print('{0:<24}'.format('instances/s') + ''.join('{0:>14}'.format(size) for size in sizes))
+    all_results = {}
+    for size in sizes:
+        fleet = generate_fleet(size, args.seed)
+        all_results[size] = run_benchmarks(evaluator, fleet, args.workers)
+        if thresholds:
+            failures.extend(check_thresholds(size, all_results[size], thresholds))
+    for name in BENCHMARKS + (['evaluate_parallel'] if args.workers > 1 else []):
+        print('{0:<24}'.format(name) + ''.join('{0:>14,.0f}'.format(all_results[size][name]) for size in sizes))
+
+    for failure in failures:
+        print('REGRESSION: {0}'.format(failure))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+Evaluates dumps of GCP instances with the evaluator in instance_states.py,
+without Relay or GCP access.
+
+    ./evaluate-instance-states.py instances.json
+    ./evaluate-instance-states.py --format decisions fleet.jsonl
+    ./evaluate-instance-states.py --simulate-days 7 fleet.jsonl
+    ./evaluate-instance-states.py --watch snapshots/ --output results/
+
+The input is a JSON-lines file of instances, or a JSON file with a list of
+instances, a dict of zone to instances or the `items` of an aggregated listing.
+
+With `--watch` the evaluator keeps running and evaluates every new or changed
+snapshot in a file or directory. It stays warm between snapshots: parsed
+labels and dates, the label policy and the decisions of unchanged instances
+are reused.
+"""
+
+import argparse
+import json
+import os
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import instance_states
+
+# Seconds between checks for new snapshots
+DEFAULT_INTERVAL = 5
+SNAPSHOT_EXTENSIONS = ('.json', '.jsonl')
+
+def build_config(args):
+    required_labels = args.required_labels
+    if required_labels is not None:
+        required_labels = json.loads(required_labels) if required_labels.startswith('[') else required_labels.split(',')
+    return instance_states.EvaluatorConfig(required_labels, args.terminate_days, start_lead_minutes=args.start_lead_minutes,
+        start_waves=args.start_waves, start_wave_minutes=args.start_wave_minutes)
+
+def evaluate(instance_source, config, schedule=None, cache=None, delta_only=False, workers=1, history=None):
+    """
+    :param instance_source: An iterable of (zone, GCP instance) tuples.
+    :param config: The EvaluatorConfig.
+    :param schedule: An optional TransitionSchedule.
+    :param cache: An optional DecisionCache.
+    :param delta_only: Whether only the decisions that changed, or that still
+    have an action to take, are reported.
+    :param workers: The number of processes evaluating the instances when
+    there is no schedule or cache.
+    :param history: An optional DecisionHistory every decision is added to.
+
+    Returns the RunReport and the list of decisions.
+    """
+    report = instance_states.RunReport()
+    decisions = []
+    if workers > 1 and schedule is None and cache is None:
+        evaluated = instance_states.evaluate_instances_parallel(instance_source, workers, config=config)
+    else:
+        evaluated = instance_states.evaluate_instances(instance_source, schedule=schedule, cache=cache, config=config)
+    for decision in evaluated:
+        if history is not None:
+            history.add(decision)
+        if delta_only and not decision.changed:
+            # Actions are repeated until they take effect
+            if decision.append_list:
+                report.add(decision, report=False)
+                decisions.append(decision)
+            continue
+        report.add(decision)
+        decisions.append(decision)
+    return (report, decisions)
+
+def format_result(args, report, decisions):
+    """Returns the text written for an evaluation in the chosen format."""
+    if args.format == 'decisions':
+        return ''.join(json.dumps(decision.to_json()) + '\n' for decision in decisions)
+    if args.format == 'slack':
+        return json.dumps([json.loads(message) for message in instance_states.states_to_slack_messages(report.states)]) + '\n'
+    result = dict(report.outputs, states=report.states, metrics=instance_states.METRICS.to_json())
+    return json.dumps(result, indent=2 if args.output is None and not args.watch else None) + '\n'
+
+def write_output(path, text):
+    # Write to a temporary file first so a partial result is never read
+    (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(text)
+    os.replace(tmp_path, path)
+
+def run_once(args, config):
+    if args.simulate_days:
+        simulation = instance_states.FleetSimulation(instance_states.timenow_with_utc(), args.simulate_days, args.step_minutes, config)
+        forecast_file = open(args.forecast_file, 'w') if args.forecast_file else None
+        forecast = instance_states.simulate_fleet(instance_states.iter_file_instances(args.input), simulation, forecast_file)
+        if forecast_file:
+            forecast_file.close()
+        text = json.dumps(forecast, indent=2) + '\n'
+    else:
+        schedule = instance_states.TransitionSchedule.load(args.schedule_file, config) if args.schedule_file else None
+        cache = instance_states.DecisionCache(args.decision_cache, config) if args.decision_cache else None
+        history = instance_states.DecisionHistory(args.history) if args.history else None
+        (report, decisions) = evaluate(instance_states.iter_file_instances(args.input), config, schedule, cache, args.delta_only, args.workers, history)
+        if history is not None:
+            history.close()
+        if cache is not None:
+            cache.close()
+        if schedule is not None:
+            schedule.finish()
+            schedule.save(args.schedule_file)
+        text = format_result(args, report, decisions)
+
+    if args.output:
+        write_output(args.output, text)
+    else:
+        sys.stdout.write(text)
+    if args.metrics:
+        write_output(args.metrics, instance_states.METRICS.to_prometheus())
+    return 0
+
+def find_snapshots(path, seen):
+    """
+    :param path: A snapshot file or a directory of snapshot files.
+    :param seen: A dict of snapshot path to the (mtime, size) it was evaluated
+    at, updated in place.
+
+    Returns the snapshots that are new or changed since they were last seen,
+    oldest first.
+    """
+    if os.path.isdir(path):
+        paths = [os.path.join(path, name) for name in os.listdir(path) if name.endswith(SNAPSHOT_EXTENSIONS)]
+    else:
+        paths = [path] if os.path.exists(path) else []
+    changed = []
+    for snapshot in paths:
+        try:
+            stat = os.stat(snapshot)
+        except OSError:
+            continue
+        version = (stat.st_mtime_ns, stat.st_size)
+        if seen.get(snapshot) != version:
+            seen[snapshot] = version
+            changed.append((stat.st_mtime_ns, snapshot))
+    return [snapshot for (_mtime, snapshot) in sorted(changed)]
+
+def run_daemon(args, config):
+    """
+    Evaluates every new or changed snapshot under `--watch` until interrupted.
+    Every snapshot is a dump of the whole fleet. Decisions of unchanged
+    instances are kept in a decision cache, in memory unless
+    `--decision-cache` is given.
+    """
+    running = [True]
+
+    def stop(signum, frame):
+        running[0] = False
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    cache = instance_states.DecisionCache(args.decision_cache or ':memory:', config)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    seen = {}
+    print('Watching {0} for instance snapshots'.format(args.watch), file=sys.stderr)
+    while running[0]:
+        for snapshot in find_snapshots(args.watch, seen):
+            instance_states.METRICS.reset()
+            history = instance_states.DecisionHistory(args.history) if args.history else None
+            try:
+                (report, decisions) = evaluate(instance_states.iter_file_instances(snapshot), config, cache=cache, delta_only=args.delta_only, history=history)
+            except (OSError, ValueError) as e:
+                # Most likely a snapshot that is still being written
+                print('Unable to evaluate {0}: {1}'.format(snapshot, e), file=sys.stderr)
+                if history is not None:
+                    history.discard()
+                del seen[snapshot]
+                continue
+            cache.finish()
+            if history is not None:
+                history.close()
+            text = format_result(args, report, decisions)
+            if args.output:
+                write_output(os.path.join(args.output, os.path.basename(snapshot) + '.result'), text)
+            else:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            if args.metrics:
+                write_output(args.metrics, instance_states.METRICS.to_prometheus())
+            print('Evaluated {0} instances of {1}'.format(len(decisions), snapshot), file=sys.stderr)
+        if running[0]:
+            time.sleep(args.interval)
+    cache.close()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluate GCP instance dumps offline.')
+    parser.add_argument('input', nargs='?', help='A JSON or JSON-lines file of GCP instances')
+    parser.add_argument('--required-labels', help='Comma separated or JSON array of required labels')
+    parser.add_argument('--terminate-days', type=int, default=instance_states.TERMINATE_DAYS, help='Days after the lifetime that instances are deleted')
+    parser.add_argument('--start-lead-minutes', type=int, default=instance_states.START_LEAD_MINUTES, help='Minutes before their working hours that autostart instances are started')
+    parser.add_argument('--start-waves', type=int, default=instance_states.START_WAVES, help='Number of waves the starts are spread over')
+    parser.add_argument('--start-wave-minutes', type=int, default=instance_states.START_WAVE_MINUTES, help='Minutes between the start waves')
+    parser.add_argument('--format', choices=['outputs', 'decisions', 'slack'], default='outputs', help='The action outputs, one JSON decision per line, or the Slack messages')
+    parser.add_argument('--output', help='Write the result to this file, or the directory of results with --watch')
+    parser.add_argument('--schedule-file', help='A transition schedule kept between runs')
+    parser.add_argument('--decision-cache', help='A SQLite decision cache kept between runs')
+    parser.add_argument('--delta-only', action='store_true', help='Only report decisions that changed since the last run, and the actions still to take')
+    parser.add_argument('--simulate-days', type=float, help='Forecast the fleet over this many days')
+    parser.add_argument('--step-minutes', type=float, default=15, help='Minutes between forecast evaluations')
+    parser.add_argument('--forecast-file', help='Write the forecast of every instance to this JSON-lines file')
+    parser.add_argument('--history', metavar='DIR', help='Append the decisions to the decision history in this directory')
+    parser.add_argument('--workers', type=instance_states.get_workers, default=1, help='Processes evaluating the instances, or auto for one per CPU')
+    parser.add_argument('--profile', action='store_true', help='Time the evaluator phases in the metrics')
+    parser.add_argument('--metrics', help='Write the metrics in the Prometheus text format to this file')
+    parser.add_argument('--watch', metavar='PATH', help='Keep running and evaluate every new snapshot in this file or directory')
+    parser.add_argument('--interval', type=float, default=DEFAULT_INTERVAL, help='Seconds between checks for new snapshots')
+    args = parser.parse_args(argv)
+    if not args.input and not args.watch:
+        parser.error('an input file or --watch is required')
+
+    config = build_config(args)
+    if args.profile:
+        instance_states.METRICS.instrument(vars(instance_states), instance_states.PROFILED_FUNCTIONS)
+    if args.watch:
+        return run_daemon(args, config)
+    return run_once(args, config)
+
+if __name__ == '__main__':
+    sys.exit(main())
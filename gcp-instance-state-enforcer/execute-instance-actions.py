@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+The `execute-instance-actions` Relay step. Carries out the whole `plan` of
+`identify-instance-states` in one process: every stop, start, suspend and
+resume of every zone goes through one Compute client, one rate controller and
+one set of batch requests, and all of their operations are waited for
+together. Sets the `results` and `summary` outputs and the Slack report with
+the outcome of the actions added.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import urllib.request
+
+# Relay only fetches this script. The modules next to it in the repository are
+# imported through library.py, which is fetched, like them, from the
+# `libraryRef` of the step when it is not installed.
+try:
+    import library
+except ImportError:
+    from relay_sdk import Interface, Dynamic as D
+    LIBRARY_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gcp-instance-state-enforcer')
+    os.makedirs(LIBRARY_DIRECTORY, exist_ok=True)
+    with urllib.request.urlopen('https://raw.githubusercontent.com/puppetlabs/support-relay_workflows/{0}/gcp-instance-state-enforcer/library.py'.format(
+            Interface().get(D.libraryRef) or 'main'), timeout=60) as response:
+        with open(os.path.join(LIBRARY_DIRECTORY, 'library.py'), 'wb') as fh:
+            fh.write(response.read())
+    sys.path.append(LIBRARY_DIRECTORY)
+    import library
+
+instance_states = library.import_library('instance_states')
+# gcp_compute needs the Google client libraries, so it is imported when the
+# step runs, where a failed import is still reported in the outputs
+gcp_compute = None
+
+# The API call made for the instances of each action output. Instances to be
+# deleted are only stopped while deleting is disabled.
+ACTION_CALLS = {
+    'to_terminate': 'stop',
+    'to_suspend': 'suspend',
+    'to_delete': 'stop',
+    'to_start': 'start',
+    'to_resume': 'resume'
+}
+
+def plan_requests(actions):
+    """
+    :param actions: The action outputs of `identify-instance-states`, each a
+    dict of zone to the instances to act on.
+
+    Returns a dict of request id, the `zone/name` of the instance, to the
+    (zone, name, API call) of the request.
+    """
+    planned = {}
+    for output in instance_states.ACTION_OUTPUTS:
+        for zone, instances in ((actions or {}).get(output) or {}).items():
+            for instance in instances or []:
+                name = instance['name'] if isinstance(instance, dict) else instance
+                if isinstance(instance, dict) and instance.get('zone'):
+                    zone = instance['zone'].rsplit('/', 1)[-1]
+                planned['{0}/{1}'.format(zone, name)] = (zone, name, ACTION_CALLS[output])
+    return planned
+
+def instance_request(compute, project_id, zone, name, call):
+    """Returns a function building the request of the API call."""
+    return lambda: getattr(compute.instances(), call)(project=project_id, zone=zone, instance=name)
+
+def execute_actions(compute, project_id, planned, concurrency, wait_timeout, rate_limit, max_attempts):
+    """
+    :param compute: The compute API resource.
+    :param project_id: The project of the instances.
+    :param planned: The requests from `plan_requests`.
+    :param concurrency: The most requests to send per batch.
+    :param wait_timeout: The seconds to wait for the operations, 0 to not wait.
+    :param rate_limit: The most requests per second.
+    :param max_attempts: The most times to try a request with transient errors.
+
+    Sends the requests of every action together, stops the instances that can
+    not be suspended, and waits for the operations. Returns a dict of request
+    id to the result and the summary of the operations, or None when they were
+    not waited for.
+    """
+    controller = gcp_compute.RateController(rate_limit)
+    calls = {request_id: call for request_id, (_zone, _name, call) in planned.items()}
+    requests = []
+    for request_id, (zone, name, call) in planned.items():
+        print('{0} instance {1}'.format(call, request_id))
+        requests.append((request_id, instance_request(compute, project_id, zone, name, call)))
+    results = gcp_compute.execute_requests(compute, calls, requests, concurrency, controller, max_attempts)
+
+    # Only instances that can not be suspended are shut down instead. Transient
+    # errors that ran out of retries are left as failed, so rate limiting never
+    # turns in to a full shutdown. A suspend that was retried after a server or
+    # network error may have gone through already, so unless the error says
+    # the instance can not be suspended, it is only stopped when the instance
+    # is not suspending.
+    stops = []
+    uncertain = {}
+    for request_id, result in results.items():
+        if result['success'] or result['action'] != 'suspend':
+            continue
+        if result['retryable']:
+            print('GCP instance {0} failed to suspend after {1} attempts. Exception: {2}'.format(request_id, result['attempts'], result['error']))
+        elif result['uncertain'] and not gcp_compute.is_suspend_unsupported(result):
+            uncertain[request_id] = planned[request_id][:2]
+        else:
+            stops.append(request_id)
+    for request_id, status in gcp_compute.get_instance_statuses(compute, project_id, uncertain, concurrency).items():
+        if status in gcp_compute.SUSPEND_STATUSES:
+            print('GCP instance {0} is {1} after an earlier suspend attempt'.format(request_id, status))
+            results[request_id] = gcp_compute.operation_result('suspend', attempts=results[request_id]['attempts'], uncertain=True)
+        elif status is None:
+            print('GCP instance {0} failed to suspend and its status is unknown. Exception: {1}'.format(request_id, results[request_id]['error']))
+        else:
+            stops.append(request_id)
+    requests = []
+    for request_id in stops:
+        print('GCP instance {0} failed to suspend. Shutting down. Exception: {1}'.format(request_id, results[request_id]['error']))
+        (zone, name, _call) = planned[request_id]
+        requests.append((request_id, instance_request(compute, project_id, zone, name, 'stop')))
+    results.update(gcp_compute.execute_requests(compute, 'stop', requests, concurrency, controller, max_attempts))
+    for request_id, result in results.items():
+        if not result['success']:
+            print('GCP instance {0} failed to {1}. Exception: {2}'.format(request_id, result['action'], result['error']))
+
+    if wait_timeout <= 0:
+        return (results, None)
+    print('Waiting up to {0} seconds for {1} operations to complete'.format(wait_timeout, len(results)))
+    tracker = gcp_compute.OperationTracker(compute, project_id, concurrency)
+    for request_id, result in results.items():
+        (zone, name, _call) = planned[request_id]
+        tracker.track(zone, name, result)
+    for (zone, name), completion in tracker.wait(wait_timeout).items():
+        result = results['{0}/{1}'.format(zone, name)]
+        result.update(completion)
+        print('{0} {1}/{2}: {3} {4}'.format(result['action'], zone, name, completion['status'],
+            '({0}s)'.format(completion['latency']) if completion['latency'] is not None else completion['error']))
+    summary = tracker.summary()
+    print('Operations succeeded: {succeeded}, failed: {failed}, timed out: {timed_out}'.format(**summary))
+    return (results, summary)
+
+def group_results(results):
+    """Returns the results as a dict of zone to instance name to result."""
+    grouped = {}
+    for request_id, result in results.items():
+        (zone, name) = request_id.split('/', 1)
+        grouped.setdefault(zone, {})[name] = result
+    return grouped
+
+def all_failed(results):
+    """Returns True when there were results and none of them succeeded."""
+    return bool(results) and all(instance_states.action_result_status(result) in ('failed', 'timed_out') for result in results.values())
+
+if __name__ == '__main__':
+    from relay_sdk import Interface, Dynamic as D
+
+    relay = Interface()
+    plan = relay.get(D.plan) or {}
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    planned = plan_requests(plan.get('actions'))
+
+    results = {}
+    error = None
+    try:
+        gcp_compute = library.import_library('gcp_compute')
+        if planned:
+            # The client is only built when there is something to do
+            (compute, project_id) = gcp_compute.get_compute(relay.get(D.google.service_account_info))
+            (results, _summary) = execute_actions(compute, project_id, planned,
+                concurrency=gcp_compute.get_concurrency(relay.get(D.concurrency)),
+                wait_timeout=gcp_compute.get_wait_timeout(relay.get(D.waitTimeout)),
+                rate_limit=gcp_compute.get_number(relay.get(D.rateLimit), 'rateLimit', gcp_compute.DEFAULT_RATE_LIMIT),
+                max_attempts=int(gcp_compute.get_number(relay.get(D.maxAttempts), 'maxAttempts', gcp_compute.DEFAULT_MAX_ATTEMPTS)))
+        else:
+            print('No instances to act on')
+    except Exception as e:
+        # The outputs are still set before the step fails below
+        print('Unable to carry out the instance actions: {0}'.format(e))
+        error = str(e)
+    summary = instance_states.summarize_action_results(results)
+    for action, statuses in sorted(summary.items()):
+        print('{0}: {1}'.format(action, json.dumps(statuses, sort_keys=True)))
+    relay.outputs.set('results', group_results(results))
+    relay.outputs.set('summary', summary)
+    relay.outputs.set('error', error)
+
+    # The report of the plan is sent as it is when no action was taken
+    messages = plan.get('messages') or ['[]']
+    if results and plan.get('states') is not None:
+        try:
+            messages = instance_states.states_to_slack_messages(plan['states'], results)
+        except Exception as e:
+            print('Unable to add the action results to the slack report: {0}'.format(e))
+    for number in range(1, instance_states.SLACK_MAX_MESSAGES + 1):
+        relay.outputs.set('slack_block' if number == 1 else 'slack_block_{0}'.format(number),
+            messages[number - 1] if len(messages) >= number else '[]')
+
+    # A run that could not act on its instances fails, which also skips the
+    # Slack steps
+    if error is not None or all_failed(results):
+        exit(1)
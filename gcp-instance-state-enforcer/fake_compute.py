@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the Compute API and the Relay metadata service, for
+testing the enforcer scripts against large fleets without a real project.
+
+    ./fake_compute.py --port 8080 --instances 5000 --latency 0.05 --quota 20
+
+Point the scripts at it with the `GCP_COMPUTE_ENDPOINT` and
+`METADATA_API_URL` environment variables, both set to the printed URL. It
+serves a discovery document for the instance and zone operation methods the
+scripts use, batch requests, and the step spec and outputs of the metadata
+service. Latency, server errors, quota errors and instances that can not be
+suspended are configurable. `load-test-actions.py` runs the action executor
+against it.
+"""
+
+import argparse
+import email.parser
+import http.client
+import http.server
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime as dt, timezone
+
+COMPUTE_VERSION = 'beta'
+# Instances per page when the listing does not ask for fewer
+DEFAULT_PAGE_SIZE = 500
+# The mutations and the status of the instance once they are done
+ACTIONS = {
+    'suspend': 'SUSPENDED',
+    'resume': 'RUNNING',
+    'stop': 'TERMINATED',
+    'start': 'RUNNING'
+}
+PATH_PATTERN = re.compile(r'^/compute/[^/]+/projects/([^/]+)/(?:zones/([^/]+)/)?(aggregated/instances|instances|operations)(?:/([^/]+))?(?:/([^/]+))?$')
+FILTER_STATUS_PATTERN = re.compile(r'status\s*=\s*"?([A-Z_]+)"?')
+
+def discovery_document(root_url, version=COMPUTE_VERSION):
+    """
+    :param root_url: The URL the fake is served at, ending with a slash.
+    :param version: The Compute API version.
+
+    Returns a discovery document with the methods of the fake.
+    """
+    def method(name, http_method, path, parameters, query=(), response=None):
+        description = {
+            'id': 'compute.{0}'.format(name),
+            'path': path,
+            'httpMethod': http_method,
+            'parameters': {parameter: {'type': 'string', 'location': 'path', 'required': True} for parameter in parameters},
+            'parameterOrder': list(parameters),
+            'response': {'$ref': response or 'Operation'}
+        }
+        for (parameter, kind) in query:
+            description['parameters'][parameter] = {'type': kind, 'location': 'query'}
+        return description
+
+    listing = [('filter', 'string'), ('maxResults', 'integer'), ('pageToken', 'string')]
+    instance = ['project', 'zone', 'instance']
+    methods = {
+        'list': method('instances.list', 'GET', 'projects/{project}/zones/{zone}/instances', ['project', 'zone'], listing, 'InstanceList'),
+        'aggregatedList': method('instances.aggregatedList', 'GET', 'projects/{project}/aggregated/instances', ['project'], listing, 'InstanceAggregatedList'),
+        'get': method('instances.get', 'GET', 'projects/{project}/zones/{zone}/instances/{instance}', instance, response='Instance')
+    }
+    for action in ACTIONS:
+        methods[action] = method('instances.{0}'.format(action), 'POST', 'projects/{project}/zones/{zone}/instances/{instance}/' + action, instance)
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'compute:{0}'.format(version),
+        'name': 'compute',
+        'version': version,
+        'rootUrl': root_url,
+        'servicePath': 'compute/{0}/'.format(version),
+        'batchPath': 'batch/compute/{0}'.format(version),
+        # The standard parameters of every method, such as a field mask
+        'parameters': {parameter: {'type': 'string', 'location': 'query'} for parameter in ['alt', 'fields', 'prettyPrint', 'quotaUser']},
+        'schemas': {
+            'Instance': {'id': 'Instance', 'type': 'object'},
+            'Operation': {'id': 'Operation', 'type': 'object'},
+            'InstanceList': {'id': 'InstanceList', 'type': 'object', 'properties': {'nextPageToken': {'type': 'string'}}},
+            'InstanceAggregatedList': {'id': 'InstanceAggregatedList', 'type': 'object', 'properties': {'nextPageToken': {'type': 'string'}}}
+        },
+        'resources': {
+            'instances': {'methods': methods},
+            'zoneOperations': {'methods': {
+                'get': method('zoneOperations.get', 'GET', 'projects/{project}/zones/{zone}/operations/{operation}', ['project', 'zone', 'operation'])
+            }}
+        }
+    }
+
+def api_error(status, reason, message):
+    return (status, {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}})
+
+def make_fleet(size, zones, status='RUNNING', ineligible=0.0, seed=0):
+    """
+    :param size: The number of instances.
+    :param zones: The zones to spread the instances over.
+    :param status: The status of every instance.
+    :param ineligible: The share of instances with a GPU, which can not be
+    suspended.
+    :param seed: The seed of the fleet.
+
+    Returns a list of instance resources.
+    """
+    rng = random.Random(seed)
+    fleet = []
+    for index in range(size):
+        zone = zones[index % len(zones)]
+        instance = {
+            'name': 'instance-{0:06d}'.format(index),
+            'zone': 'https://www.googleapis.com/compute/{0}/projects/fake/zones/{1}'.format(COMPUTE_VERSION, zone),
+            'status': status,
+            'creationTimestamp': '2021-01-01T00:00:00.000-07:00',
+            'machineType': 'zones/{0}/machineTypes/n1-standard-1'.format(zone),
+            'labels': {'owner': 'load_test', 'geo': 'amer', 'lifetime': 'indefinite'}
+        }
+        if rng.random() < ineligible:
+            instance['guestAccelerators'] = [{'acceleratorType': 'nvidia-tesla-t4', 'acceleratorCount': 1}]
+        fleet.append(instance)
+    return fleet
+
+class FakeCompute(object):
+    """
+    The state of the fake: the instances by zone, their operations, the step
+    spec and outputs, and counters of the requests served.
+    """
+
+    def __init__(self, instances, latency=0.0, jitter=0.0, error_rate=0.0, quota=None, operation_seconds=1.0,
+            throttle_status=429, spec=None, seed=0):
+        """
+        :param instances: A list of instance resources.
+        :param latency: Seconds added to every HTTP request.
+        :param jitter: The most seconds randomly added to the latency.
+        :param error_rate: The share of API calls answered with a 503.
+        :param quota: The most mutations per second, or None for no limit.
+        Mutations over it are answered with `throttle_status`.
+        :param operation_seconds: Seconds until an operation is DONE.
+        :param throttle_status: 429, or 403 with a rateLimitExceeded reason.
+        :param spec: The Relay step spec served to the scripts.
+        """
+        self.zones = {}
+        for instance in instances:
+            zone = instance['zone'].rsplit('/', 1)[-1]
+            self.zones.setdefault(zone, {})[instance['name']] = instance
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+        self.operation_seconds = operation_seconds
+        self.throttle_status = throttle_status
+        self.spec = spec or {}
+        self.outputs = {}
+        self.operations = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.rng = random.Random(seed)
+        self.operation_ids = itertools.count(1)
+        self.tokens = float(quota or 0)
+        self.updated = time.monotonic()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def statuses(self):
+        """Returns the number of instances in each status."""
+        statuses = {}
+        for instances in self.zones.values():
+            for instance in instances.values():
+                statuses[instance['status']] = statuses.get(instance['status'], 0) + 1
+        return statuses
+
+    def stats(self):
+        with self.lock:
+            return {'counters': dict(sorted(self.counters.items())), 'statuses': self.statuses()}
+
+    def throttled(self):
+        if self.quota is None:
+            return False
+        now = time.monotonic()
+        self.tokens = min(float(self.quota), self.tokens + (now - self.updated) * self.quota)
+        self.updated = now
+        if self.tokens < 1:
+            return True
+        self.tokens -= 1
+        return False
+
+    def call(self, method, path, query):
+        """
+        :param method: The HTTP method.
+        :param path: The path of the API call.
+        :param query: A dict of the query parameters.
+
+        Returns the (status, body) of a Compute API call.
+        """
+        match = PATH_PATTERN.match(path)
+        if match is None:
+            return api_error(404, 'notFound', 'Unknown path {0}'.format(path))
+        (_project, zone, collection, name, action) = match.groups()
+        with self.lock:
+            self.count('calls')
+            if self.rng.random() < self.error_rate:
+                self.count('server_errors')
+                return api_error(503, 'backendError', 'Backend Error')
+            if collection == 'operations':
+                return self.get_operation(name)
+            if name is None:
+                self.count('list_pages')
+                return (200, self.list_instances(zone, query))
+            instance = self.zones.get(zone, {}).get(name)
+            if instance is None:
+                return api_error(404, 'notFound', "The resource 'instances/{0}' was not found".format(name))
+            if method == 'GET' and action is None:
+                return (200, instance)
+            if method != 'POST' or action not in ACTIONS:
+                return api_error(400, 'badRequest', 'Unsupported method {0} {1}'.format(method, path))
+            if self.throttled():
+                self.count('throttled')
+                return api_error(self.throttle_status, 'rateLimitExceeded', 'Rate Limit Exceeded')
+            if action == 'suspend' and instance.get('guestAccelerators'):
+                self.count('ineligible')
+                return api_error(400, 'badRequest', 'Instances with guest accelerators do not support suspend.')
+            self.count(action)
+            instance['status'] = ACTIONS[action]
+            return (200, self.new_operation(zone, name, action))
+
+    def list_instances(self, zone, query):
+        if zone is not None:
+            instances = list(self.zones.get(zone, {}).values())
+        else:
+            instances = [instance for zone_instances in self.zones.values() for instance in zone_instances.values()]
+        statuses = FILTER_STATUS_PATTERN.findall(query.get('filter', ''))
+        if statuses:
+            instances = [instance for instance in instances if instance['status'] in statuses]
+        offset = int(query.get('pageToken') or 0)
+        size = int(query.get('maxResults') or DEFAULT_PAGE_SIZE)
+        page = instances[offset:offset + size]
+        if zone is not None:
+            response = {'items': page}
+        else:
+            response = {'items': {}}
+            for instance in page:
+                scope = 'zones/{0}'.format(instance['zone'].rsplit('/', 1)[-1])
+                response['items'].setdefault(scope, {'instances': []})['instances'].append(instance)
+        if offset + size < len(instances):
+            response['nextPageToken'] = str(offset + size)
+        return response
+
+    def new_operation(self, zone, name, action):
+        operation = 'operation-{0}'.format(next(self.operation_ids))
+        self.operations[operation] = (zone, name, action, time.time())
+        return {'name': operation, 'zone': zone, 'operationType': action, 'status': 'RUNNING'}
+
+    def get_operation(self, operation):
+        if operation not in self.operations:
+            return api_error(404, 'notFound', "The resource 'operations/{0}' was not found".format(operation))
+        self.count('operation_polls')
+        (zone, name, action, started) = self.operations[operation]
+        response = {'name': operation, 'zone': zone, 'operationType': action, 'targetLink': name,
+            'insertTime': dt.fromtimestamp(started, timezone.utc).isoformat()}
+        if time.time() - started < self.operation_seconds:
+            response['status'] = 'RUNNING'
+        else:
+            response['status'] = 'DONE'
+            response['endTime'] = dt.fromtimestamp(started + self.operation_seconds, timezone.utc).isoformat()
+        return (200, response)
+
+    def get_spec(self, query):
+        """
+        :param query: The `q` parameter of the metadata service, such as
+        `google["zone"]`.
+
+        Returns the part of the step spec the query selects, or None.
+        """
+        value = self.spec
+        for key in re.findall(r'^\w+|\["((?:[^"\\]|\\.)*)"\]', query or ''):
+            key = key or query.split('[', 1)[0]
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+def parse_http_part(payload):
+    """Returns the (method, path, query, body) of a request in a batch."""
+    (head, _separator, body) = payload.replace('\r\n', '\n').partition('\n\n')
+    (method, target, _version) = head.split('\n', 1)[0].split(' ', 2)
+    parsed = urllib.parse.urlsplit(target)
+    return (method, parsed.path, dict(urllib.parse.parse_qsl(parsed.query)), body)
+
+class FakeComputeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set on the subclass built by `serve`
+    fake = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json; charset=UTF-8'):
+        data = body.encode('utf-8') if isinstance(body, str) else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        # Clients asking to close the connection must be told it is closed
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def handle_request(self, method):
+        fake = self.fake
+        body = self.read_body()
+        parsed = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        with fake.lock:
+            fake.count('http_requests')
+        if fake.latency or fake.jitter:
+            time.sleep(fake.latency + fake.rng.uniform(0, fake.jitter))
+
+        if parsed.path.startswith('/discovery/'):
+            root_url = 'http://{0}/'.format(self.headers.get('Host'))
+            return self.send_body(200, discovery_document(root_url, parsed.path.split('/')[-2]))
+        if parsed.path == '/spec':
+            return self.send_body(200, {'value': fake.get_spec(query.get('q')), 'complete': True})
+        if parsed.path.startswith('/outputs/') and method == 'PUT':
+            with fake.lock:
+                fake.outputs[urllib.parse.unquote(parsed.path[len('/outputs/'):])] = json.loads(body or b'null')
+            return self.send_body(200, {})
+        if parsed.path == '/_stats':
+            return self.send_body(200, fake.stats())
+        if parsed.path.startswith('/batch/'):
+            return self.handle_batch(body)
+        (status, response) = fake.call(method, parsed.path, query)
+        self.send_body(status, response)
+
+    def handle_batch(self, body):
+        message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + self.headers.get('Content-Type').encode('utf-8') + b'\r\n\r\n' + body)
+        with self.fake.lock:
+            self.fake.count('batches')
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.get_payload():
+            (method, path, query, _body) = parse_http_part(part.get_payload())
+            (status, response) = self.fake.call(method, path, query)
+            # Long Content-IDs arrive folded over several lines
+            content_id = ''.join(str(part['Content-ID']).splitlines()).strip().strip('<>')
+            parts.append('--{0}\r\nContent-Type: application/http\r\nContent-ID: <response-{1}>\r\n\r\n'
+                'HTTP/1.1 {2} {3}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{4}\r\n'.format(
+                boundary, content_id, status, http.client.responses.get(status, ''), json.dumps(response)))
+        self.send_body(200, ''.join(parts) + '--{0}--\r\n'.format(boundary), 'multipart/mixed; boundary={0}'.format(boundary))
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+def serve(fake, port=0, host='127.0.0.1'):
+    """
+    :param fake: The FakeCompute to serve.
+    :param port: The port, or 0 for a free one.
+
+    Starts serving in a background thread and returns the server. Its URL is
+    `server_url(server)`.
+    """
+    handler = type('BoundFakeComputeHandler', (FakeComputeHandler,), {'fake': fake})
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def server_url(server):
+    (host, port) = server.server_address[:2]
+    return 'http://{0}:{1}/'.format(host, port)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a fake Compute API and Relay metadata service.')
+    parser.add_argument('--port', type=int, default=8080, help='The port to listen on')
+    parser.add_argument('--instances', type=int, default=1000, help='The number of instances')
+    parser.add_argument('--zones', default='us-west1-a,us-west1-b,us-west1-c', help='Comma separated zones')
+    parser.add_argument('--status', default='RUNNING', help='The status of every instance')
+    parser.add_argument('--ineligible', type=float, default=0.0, help='The share of instances that can not be suspended')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='The most seconds randomly added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The share of API calls that fail with a 503')
+    parser.add_argument('--quota', type=float, help='The most mutations per second')
+    parser.add_argument('--throttle-status', type=int, choices=[403, 429], default=429, help='The status of throttled requests')
+    parser.add_argument('--operation-seconds', type=float, default=1.0, help='Seconds until an operation is done')
+    parser.add_argument('--spec', help='A JSON file of the step spec to serve')
+    args = parser.parse_args(argv)
+
+    spec = None
+    if args.spec:
+        with open(args.spec) as fh:
+            spec = json.load(fh)
+    fake = FakeCompute(make_fleet(args.instances, args.zones.split(','), args.status, args.ineligible), args.latency, args.jitter,
+        args.error_rate, args.quota, args.operation_seconds, args.throttle_status, spec)
+    server = serve(fake, args.port)
+    print('Serving {0} instances at {1}'.format(args.instances, server_url(server)))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(fake.stats(), indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
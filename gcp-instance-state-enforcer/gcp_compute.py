@@ -0,0 +1,484 @@
+"""
+Shared Compute API client for the GCP instance state enforcer steps.
+
+Builds the compute resource from a Relay GCP connection with the discovery
+document bundled with the API client and a single authorized HTTP session, so
+each step skips the discovery fetch and reuses its connections.
+"""
+
+import collections
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import socket
+import time
+from datetime import datetime as dt
+
+import googleapiclient.discovery
+import googleapiclient.errors
+import google_auth_httplib2
+import httplib2
+
+from google.oauth2 import service_account
+
+COMPUTE_VERSION = 'beta'
+
+# Seconds before a request to the API times out
+HTTP_TIMEOUT = 60
+
+# When set, the API is called unauthenticated at this URL instead, with the
+# discovery document it serves. Used to run the steps against fake_compute.py.
+COMPUTE_ENDPOINT = os.environ.get('GCP_COMPUTE_ENDPOINT')
+
+# For security purposes we whitelist the keys that can be fed in to the
+# google oauth library. This prevents workflow users from feeding arbitrary
+# data in to that library.
+SERVICE_ACCOUNT_INFO_KEYS = [
+    "type",
+    "project_id",
+    "private_key_id",
+    "private_key",
+    "client_email",
+    "client_id",
+    "auth_uri",
+    "token_uri",
+    "auth_provider_x509_cert_url",
+    "client_x509_cert_url",
+]
+
+# Instance mutations per second allowed by the project quota, and the lowest
+# rate the controller backs off to when it is throttled
+DEFAULT_RATE_LIMIT = 20
+MIN_RATE = 0.5
+# Rate added per throttle-free round and the factor applied when throttled
+RATE_INCREASE = 1.0
+RATE_DECREASE = 0.5
+
+# Attempts per request and the backoff between them for transient errors
+DEFAULT_MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+# Errors of a suspend request saying the instance can not be suspended at all,
+# as opposed to it being busy, for example with an earlier suspend
+SUSPEND_UNSUPPORTED_PATTERN = re.compile(r'not support|unsupported|can ?not be suspended', re.IGNORECASE)
+SUSPEND_STATUSES = ['SUSPENDING', 'SUSPENDED']
+
+# The number of requests sent together in a single batch request. Compute
+# accepts at most 1000 calls per batch. A value of 1 sends the requests one at
+# a time.
+DEFAULT_CONCURRENCY = 50
+MAX_CONCURRENCY = 1000
+
+# The number of seconds to wait for the operations to finish. 0 returns as
+# soon as the requests have been sent.
+DEFAULT_WAIT_TIMEOUT = 600
+POLL_INTERVAL_INITIAL = 2
+POLL_INTERVAL_MAX = 30
+
+# Clients built in this process, keyed by service account and API version
+_CLIENTS = {}
+
+def slice(orig, keys):
+    return {key: orig[key] for key in keys if key in orig}
+
+def chunk_list(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+def get_service_account_info(connection):
+    """
+    :param connection: The Relay GCP connection, a dict with the
+    `serviceAccountKey` JSON string.
+
+    Returns the whitelisted service account info.
+    """
+    # TODO: How to validate all the required data is present here?
+    return slice(json.loads(connection['serviceAccountKey']), SERVICE_ACCOUNT_INFO_KEYS)
+
+def get_compute(connection, version=COMPUTE_VERSION):
+    """
+    :param connection: The Relay GCP connection.
+    :param version: The Compute API version.
+
+    Returns a (compute, project_id) tuple. The compute resource is built once
+    per service account in a process and shares one authorized HTTP session,
+    which keeps its connections open between requests. With
+    `GCP_COMPUTE_ENDPOINT` set, the client calls that endpoint instead.
+    """
+    service_account_info = get_service_account_info(connection)
+    key = (service_account_info.get('client_email'), version)
+    if key not in _CLIENTS and COMPUTE_ENDPOINT:
+        http = httplib2.Http(timeout=HTTP_TIMEOUT)
+        (response, content) = http.request('{0}/discovery/v1/apis/compute/{1}/rest'.format(COMPUTE_ENDPOINT.rstrip('/'), version))
+        if response.status >= 400:
+            raise ValueError('Unable to fetch the compute {0} discovery document from {1}: HTTP {2}'.format(version, COMPUTE_ENDPOINT, response.status))
+        compute = googleapiclient.discovery.build_from_document(content.decode('utf-8'), http=http)
+        _CLIENTS[key] = (compute, service_account_info.get('project_id'))
+    elif key not in _CLIENTS:
+        credentials = service_account.Credentials.from_service_account_info(service_account_info)
+        http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        compute = googleapiclient.discovery.build('compute', version, http=http, cache_discovery=False, static_discovery=True)
+        _CLIENTS[key] = (compute, credentials.project_id)
+    return _CLIENTS[key]
+
+def get_error_reason(exception):
+    """Returns the reason of the first error in an HttpError or None."""
+    try:
+        content = json.loads(exception.content.decode('utf-8'))
+        return content['error']['errors'][0]['reason']
+    except Exception:
+        return None
+
+def is_rate_limited(exception):
+    """
+    :param exception: The exception raised by a request.
+
+    Returns if the request was rejected by rate limiting.
+    """
+    if not isinstance(exception, googleapiclient.errors.HttpError):
+        return False
+    status = exception.resp.status
+    return status == 429 or (status == 403 and get_error_reason(exception) in RATE_LIMIT_REASONS)
+
+def is_retryable(exception):
+    """
+    :param exception: The exception raised by a request.
+
+    Returns if the request can succeed when it is tried again: rate limiting,
+    server errors and network errors. Anything else, such as an instance that
+    does not support the call, is final.
+    """
+    if isinstance(exception, googleapiclient.errors.HttpError):
+        return is_rate_limited(exception) or exception.resp.status >= 500
+    return isinstance(exception, (socket.timeout, ConnectionError, httplib2.HttpLib2Error))
+
+def backoff_delay(attempt):
+    """Returns the jittered seconds to wait before the given retry attempt."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+class RateController(object):
+    """
+    A token bucket that paces requests to the project's mutation quota.
+
+    The rate is adjusted AIMD style: it is halved whenever a round of requests
+    is throttled and grows back by a fixed step after each round that is not,
+    up to the configured limit.
+    """
+
+    def __init__(self, rate_limit=DEFAULT_RATE_LIMIT, min_rate=MIN_RATE, clock=time.monotonic, sleep=time.sleep):
+        """
+        :param rate_limit: The most requests per second to send.
+        :param min_rate: The lowest requests per second to back off to.
+        """
+        self.max_rate = float(rate_limit)
+        self.min_rate = min(float(min_rate), self.max_rate)
+        self.rate = self.max_rate
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = self.capacity()
+        self.updated = clock()
+
+    def capacity(self):
+        # Allow a burst of up to one second of requests
+        return max(1.0, self.rate)
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity(), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, count=1):
+        """
+        :param count: The number of requests about to be sent.
+
+        Blocks until the bucket holds enough tokens for the requests.
+        """
+        count = min(count, self.capacity())
+        self.refill()
+        if self.tokens < count:
+            self.sleep((count - self.tokens) / self.rate)
+            self.refill()
+        # Rounding can leave the bucket a hair short after the sleep
+        self.tokens = max(0.0, self.tokens - count)
+
+    def batch_size(self, concurrency):
+        """Returns how many requests to send in the next batch."""
+        return max(1, min(concurrency, int(self.capacity())))
+
+    def record(self, throttled):
+        """
+        :param throttled: If any request of the last round was rate limited.
+        """
+        if throttled:
+            self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+            self.tokens = min(self.tokens, self.capacity())
+        else:
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+def operation_result(action, operation=None, error=None, attempts=1, uncertain=False):
+    """
+    :param action: The API call that was made for the instance.
+    :param operation: The zone operation returned by the API call.
+    :param error: The exception raised by the API call.
+    :param attempts: The number of times the call was made.
+    :param uncertain: If an earlier attempt failed with a server or network
+    error, so the call may have been carried out anyway.
+
+    Returns the per-instance result entry.
+    """
+    return {
+        'action': action,
+        'operation': operation.get('name') if operation else None,
+        'success': error is None,
+        'error': str(error) if error is not None else None,
+        'retryable': error is not None and is_retryable(error),
+        'attempts': attempts,
+        'uncertain': uncertain
+    }
+
+def is_suspend_unsupported(result):
+    """Returns if the failed suspend of a result says the instance can not be suspended."""
+    return bool(result['error']) and SUSPEND_UNSUPPORTED_PATTERN.search(result['error']) is not None
+
+def execute_requests(compute, action, requests, concurrency, controller=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    :param compute: The compute API resource.
+    :param action: The API call the requests make, or a dict of request id to
+    the API call when the requests make different calls.
+    :param requests: A list of (request id, function returning an HttpRequest)
+    tuples.
+    :param concurrency: The most requests to send per batch.
+    :param controller: The RateController pacing the requests.
+    :param max_attempts: The most times to try a request with transient errors.
+
+    Sends the requests in batches paced by the controller. Requests that fail
+    with a transient error are retried with jittered exponential backoff.
+    Returns a dict of request id to the operation result.
+    """
+    controller = controller or RateController()
+    get_action = action.get if isinstance(action, dict) else lambda request_id: action
+    results = {}
+    # Requests to send as (request id, request factory, attempts so far, if an
+    # earlier attempt may have been carried out), and the retries waiting for
+    # their backoff as (time, sequence, entry)
+    pending = collections.deque((request_id, factory, 0, False) for (request_id, factory) in requests)
+    retries = []
+    sequence = itertools.count()
+
+    while pending or retries:
+        now = controller.clock()
+        while retries and retries[0][0] <= now:
+            pending.append(heapq.heappop(retries)[2])
+        if not pending:
+            controller.sleep(retries[0][0] - now)
+            continue
+        chunk = [pending.popleft() for _ in range(min(len(pending), controller.batch_size(concurrency)))]
+        controller.acquire(len(chunk))
+
+        responses = {}
+        def callback(request_id, response, exception):
+            responses[request_id] = (response, exception)
+
+        if len(chunk) == 1:
+            (request_id, factory, _attempts, _uncertain) = chunk[0]
+            try:
+                callback(request_id, factory().execute(), None)
+            except Exception as e:
+                callback(request_id, None, e)
+        else:
+            batch = compute.new_batch_http_request(callback=callback)
+            for (request_id, factory, _attempts, _uncertain) in chunk:
+                batch.add(factory(), request_id=request_id)
+            try:
+                batch.execute()
+            except Exception as e:
+                # The batch itself failed, so every request in it did
+                for (request_id, _factory, _attempts, _uncertain) in chunk:
+                    responses.setdefault(request_id, (None, e))
+
+        throttled = False
+        for (request_id, factory, attempts, uncertain) in chunk:
+            (response, exception) = responses[request_id]
+            attempts += 1
+            if exception is None:
+                results[request_id] = operation_result(get_action(request_id), response, attempts=attempts, uncertain=uncertain)
+                continue
+            throttled = throttled or is_rate_limited(exception)
+            if is_retryable(exception) and attempts < max_attempts:
+                print('Retrying {0} of {1} after a transient error: {2}'.format(get_action(request_id), request_id, exception))
+                # Throttled requests are rejected before they are carried out
+                uncertain = uncertain or not is_rate_limited(exception)
+                heapq.heappush(retries, (controller.clock() + backoff_delay(attempts), next(sequence), (request_id, factory, attempts, uncertain)))
+            else:
+                results[request_id] = operation_result(get_action(request_id), error=exception, attempts=attempts, uncertain=uncertain)
+        controller.record(throttled)
+    return results
+
+def get_instance_statuses(compute, project_id, instances, concurrency=DEFAULT_CONCURRENCY):
+    """
+    :param compute: The compute API resource.
+    :param project_id: The project of the instances.
+    :param instances: A dict of request id to the (zone, name) of an instance.
+    :param concurrency: The most requests to send per batch.
+
+    Returns a dict of request id to the status of the instance, or None when
+    it could not be read.
+    """
+    statuses = {request_id: None for request_id in instances}
+    def callback(request_id, response, exception):
+        if exception is not None:
+            print('Unable to get instance {0}: {1}'.format(request_id, exception))
+            return
+        statuses[request_id] = response.get('status')
+
+    for chunk in chunk_list(list(instances.items()), concurrency):
+        batch = compute.new_batch_http_request(callback=callback)
+        for request_id, (zone, name) in chunk:
+            batch.add(compute.instances().get(project=project_id, zone=zone, instance=name, fields='status'), request_id=request_id)
+        try:
+            batch.execute()
+        except Exception as e:
+            print('Unable to get {0} instances: {1}'.format(len(chunk), e))
+    return statuses
+
+def get_concurrency(value):
+    """
+    :param value: The `concurrency` step parameter.
+
+    Returns the number of requests to send per batch, bounded to what the
+    Compute batch endpoint accepts.
+    """
+    try:
+        concurrency = int(value) if value is not None else DEFAULT_CONCURRENCY
+    except ValueError:
+        print('Invalid `concurrency` parameter "{0}". Using {1}.'.format(value, DEFAULT_CONCURRENCY))
+        concurrency = DEFAULT_CONCURRENCY
+    return max(1, min(concurrency, MAX_CONCURRENCY))
+
+def get_wait_timeout(value):
+    try:
+        return max(0, int(value)) if value is not None else DEFAULT_WAIT_TIMEOUT
+    except ValueError:
+        print('Invalid `waitTimeout` parameter "{0}". Using {1}.'.format(value, DEFAULT_WAIT_TIMEOUT))
+        return DEFAULT_WAIT_TIMEOUT
+
+def get_number(value, parameter, default):
+    try:
+        number = float(value) if value is not None else default
+    except ValueError:
+        number = 0
+    if number <= 0:
+        print('Invalid `{0}` parameter "{1}". Using {2}.'.format(parameter, value, default))
+        return default
+    return number
+
+def parse_operation_time(value):
+    return dt.fromisoformat(value) if value else None
+
+def operation_latency(operation, started):
+    """
+    :param operation: A DONE zone operation.
+    :param started: The monotonic time the operation was tracked.
+
+    Returns the seconds the operation took, preferring the API reported times
+    over the time it was observed as DONE.
+    """
+    try:
+        start = parse_operation_time(operation.get('insertTime'))
+        end = parse_operation_time(operation.get('endTime'))
+        if start and end:
+            return (end - start).total_seconds()
+    except ValueError:
+        pass
+    return time.monotonic() - started
+
+class OperationTracker(object):
+    """
+    Collects the zone operations started for instances and waits for them to
+    finish. Every outstanding operation is polled in a single batch request per
+    round, backing off between rounds until they are all DONE or the deadline
+    passes.
+    """
+
+    def __init__(self, compute, project_id, concurrency=DEFAULT_CONCURRENCY):
+        self.compute = compute
+        self.project_id = project_id
+        self.concurrency = concurrency
+        # 'zone/name' -> (zone, instance name, operation name, time tracked)
+        self.pending = {}
+        # (zone, instance name) -> completion entry
+        self.completed = {}
+
+    def track(self, zone, name, result):
+        """
+        :param zone: The zone of the instance.
+        :param name: The instance name.
+        :param result: The per-instance result from `operation_result`.
+
+        Starts tracking the operation in the result. Requests that failed
+        outright are recorded as failed straight away, and successes without
+        an operation as succeeded.
+        """
+        if result['success'] and result['operation']:
+            self.pending['{0}/{1}'.format(zone, name)] = (zone, name, result['operation'], time.monotonic())
+        elif result['success']:
+            self.completed[(zone, name)] = {'status': 'succeeded', 'latency': None, 'error': None}
+        else:
+            self.completed[(zone, name)] = {'status': 'failed', 'latency': None, 'error': result['error']}
+
+    def poll(self):
+        """Fetch the state of every pending operation using batch requests."""
+        def callback(request_id, response, exception):
+            if exception is not None:
+                # Treat polling errors as transient and try again next round
+                print('Unable to get operation for {0}: {1}'.format(request_id, exception))
+                return
+            if response.get('status') != 'DONE':
+                return
+            (zone, name, _operation, started) = self.pending.pop(request_id)
+            errors = response.get('error', {}).get('errors', [])
+            self.completed[(zone, name)] = {
+                'status': 'failed' if errors else 'succeeded',
+                'latency': round(operation_latency(response, started), 3),
+                'error': '; '.join(e.get('message', str(e)) for e in errors) if errors else None
+            }
+
+        for chunk in chunk_list(list(self.pending.items()), self.concurrency):
+            batch = self.compute.new_batch_http_request(callback=callback)
+            for request_id, (zone, _name, operation, _started) in chunk:
+                batch.add(self.compute.zoneOperations().get(project=self.project_id, zone=zone, operation=operation), request_id=request_id)
+            try:
+                batch.execute()
+            except Exception as e:
+                # The operations of a failed batch stay pending for the next round
+                print('Unable to get {0} operations: {1}'.format(len(chunk), e))
+
+    def wait(self, timeout):
+        """
+        :param timeout: The number of seconds to wait for the operations.
+
+        Polls until all operations are DONE or the timeout passes. Operations
+        that are still running at the deadline are marked as timed out.
+        """
+        deadline = time.monotonic() + timeout
+        interval = POLL_INTERVAL_INITIAL
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(min(interval, max(0, deadline - time.monotonic())))
+            self.poll()
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+        for (zone, name, _operation, _started) in self.pending.values():
+            self.completed[(zone, name)] = {'status': 'timed_out', 'latency': None, 'error': 'Timed out after {0} seconds'.format(timeout)}
+        return self.completed
+
+    def summary(self):
+        summary = {'succeeded': 0, 'failed': 0, 'timed_out': 0}
+        for entry in self.completed.values():
+            summary[entry['status']] += 1
+        return summary
@@ -1,481 +1,222 @@
 #!/usr/bin/env python
-## Origional source: https://raw.githubusercontent.com/puppetlabs/relay-workflows/master/gcp-instance-reaper/filter-instances.py
+"""
+The `identify-instance-states` Relay step. Reads the step parameters, runs
+the instances through the evaluator in instance_states.py and sets the action,
+Slack and metrics outputs, and a `plan` output that combines them for
+execute-instance-actions.py.
+"""
 
 import datetime
-from datetime import datetime as dt, timedelta
-import re
 import json
-# zoneinfo requires Python 3.9+
+import os
 import sys
-if sys.version_info.major < 3 or sys.version_info.minor < 9:
-    raise Exception("Must be using Python 3.9+")
-
-from zoneinfo import ZoneInfo
-
-from relay_sdk import Interface, Dynamic as D
-
-
-relay = Interface()
-
-# The `MINUTES_TO_WAIT` global variable is the number of minutes to wait for
-# a termination_date label to appear for the GCP instance.
-MINUTES_TO_WAIT = 5
-
-# The Indefinite lifetime constant
-INDEFINITE = ['indefinite', 'infinity', '0']
-
-WORKHOURS_DEFAULT = (7, 18)
-RUNSCHEDULE_DEFAULT = 'weekdays'
-
-# Geo to timezone mappings
-TIMEZONES = {
-    "apj": "Asia/Singapore",
-    "emea": "Europe/Belfast",
-    "amer": "America/Los_Angeles"
-}
-
-# Label names (user-configurable)
-TERMINATION_DATE_LABEL = 'termination_date'
-LIFETIME_LABEL = 'lifetime'
-AUTOSTART_LABEL = 'autostart'
-SHUTDOWN_TYPE_LABEL = 'shutdown_type'
-RUNSCHEDULE_LABEL = 'runschedule'
-WORKHOURS_LABEL = 'workhours'
-GEO_LABEL = 'geo'
-DISABLED_LABEL = 'disabled'
-STOPPED_UNTIL_LABEL = 'stopped_until'
-REQUIRED_LABELS = json.loads(relay.get(D.requiredLabels))
-TERMINATE_DAYS = relay.get(D.terminateDays)
-INSTANCES = relay.get(D.instances)
-LOG_LEVEL = relay.get(D.logLevel)
+import tempfile
+import urllib.request
+
+# Relay only fetches this script. The modules next to it in the repository are
+# imported through library.py, which is fetched, like them, from the
+# `libraryRef` of the step when it is not installed.
+try:
+    import library
+except ImportError:
+    from relay_sdk import Interface, Dynamic as D
+    LIBRARY_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gcp-instance-state-enforcer')
+    os.makedirs(LIBRARY_DIRECTORY, exist_ok=True)
+    with urllib.request.urlopen('https://raw.githubusercontent.com/puppetlabs/support-relay_workflows/{0}/gcp-instance-state-enforcer/library.py'.format(
+            Interface().get(D.libraryRef) or 'main'), timeout=60) as response:
+        with open(os.path.join(LIBRARY_DIRECTORY, 'library.py'), 'wb') as fh:
+            fh.write(response.read())
+    sys.path.append(LIBRARY_DIRECTORY)
+    import library
+
+instance_states = library.import_library('instance_states')
+
+# Step parameters. These are the workflow defaults until `load_relay_config`
+# reads them from the step.
+CONFIG = instance_states.DEFAULT_CONFIG
+INSTANCES = None
+LOG_LEVEL = 'info'
+# Alternative instance sources. A JSON-lines file of instances, or listing the
+# instances page by page with the `google` connection when no `instances` are
+# given. `zones` limits the listing, which otherwise covers every zone.
+INSTANCES_FILE = None
+GOOGLE = None
+ZONES = None
+# An optional JSON-lines file every decision is appended to as it is made
+DECISIONS_FILE = None
+# An optional file keeping the next transition time of every instance between
+# runs, so instances without a due transition or a change are skipped
+SCHEDULE_FILE = None
+# An optional SQLite file caching every decision until it can next change, and
+# whether the outputs only list the decisions that changed since the last run
+DECISION_CACHE = None
+DELTA_ONLY = False
+# When set, the run forecasts the fleet over this many days at evaluations
+# this many minutes apart instead of enforcing it, optionally writing the
+# forecast of every instance to a JSON-lines file
+SIMULATE_DAYS = None
+SIMULATE_STEP_MINUTES = 15
+FORECAST_FILE = None
+# An optional directory every run's decisions are appended to as a columnar
+# history, read by report-decision-history.py
+HISTORY_DIR = None
+# Whether the hot paths are timed for the `metrics` output
+PROFILE = False
+# The number of processes evaluating the instances
+WORKERS = 1
+
+def load_relay_config(relay):
+    """
+    :param relay: The relay_sdk Interface of the step.
+
+    Reads the step parameters and builds the evaluator config from them.
+    """
+    from relay_sdk import Dynamic as D
+    global CONFIG, INSTANCES, LOG_LEVEL, INSTANCES_FILE, GOOGLE, ZONES, DECISIONS_FILE, SCHEDULE_FILE, DECISION_CACHE, DELTA_ONLY
+    global SIMULATE_DAYS, SIMULATE_STEP_MINUTES, FORECAST_FILE, PROFILE, WORKERS, HISTORY_DIR
+
+    CONFIG = instance_states.EvaluatorConfig(json.loads(relay.get(D.requiredLabels)), relay.get(D.terminateDays),
+        start_lead_minutes=relay.get(D.startLeadMinutes) or instance_states.START_LEAD_MINUTES,
+        start_waves=relay.get(D.startWaves) or instance_states.START_WAVES,
+        start_wave_minutes=relay.get(D.startWaveMinutes) or instance_states.START_WAVE_MINUTES)
+    INSTANCES = relay.get(D.instances)
+    LOG_LEVEL = relay.get(D.logLevel)
+    INSTANCES_FILE = relay.get(D.instancesFile)
+    GOOGLE = relay.get(D.google)
+    ZONES = relay.get(D.zones)
+    if isinstance(ZONES, str):
+        ZONES = json.loads(ZONES)
+    DECISIONS_FILE = relay.get(D.decisionsFile)
+    SCHEDULE_FILE = relay.get(D.scheduleFile)
+    DECISION_CACHE = relay.get(D.decisionCache)
+    DELTA_ONLY = str(relay.get(D.deltaOnly)).lower() == 'true'
+    simulate_days = relay.get(D.simulateDays)
+    SIMULATE_DAYS = float(simulate_days) if simulate_days else None
+    SIMULATE_STEP_MINUTES = float(relay.get(D.simulateStepMinutes) or SIMULATE_STEP_MINUTES)
+    FORECAST_FILE = relay.get(D.forecastFile)
+    HISTORY_DIR = relay.get(D.historyDir)
+    PROFILE = str(relay.get(D.profile)).lower() == 'true'
+    WORKERS = instance_states.get_workers(relay.get(D.workers))
 
 def verbose_log(msg):
     if LOG_LEVEL == 'verbose':
         print(msg)
 
-def get_label(gcp_instance, label_name):
-    """
-    :param gcp_instance: a description of a GCP instance.
-    :param label_name: A string of the key name you are searching for.
-
-    This method returns None if the GCP instance currently has no tags
-    or if the label is not found. If the tag is found, it returns the label
-    value.
-    """
-    if 'labels' not in gcp_instance.keys() or gcp_instance['labels'] is None:
-        return None
-
-    return gcp_instance['labels'][label_name] if label_name in gcp_instance['labels'] else None
-
-def timenow_with_utc():
-    """
-    Return a datetime object that includes the tzinfo for utc time.
-    """
-    time = dt.utcnow()
-    time = time.replace(tzinfo=datetime.timezone.utc)
-    return time
-
-def parse_lifetime_value(lifetime_value):
-    """
-    :param lifetime_value: A string from your GCP instance.
-
-    Return a match object if a match is found; otherwise, return the None from
-    the search method.
-    """
-    search_result = re.search(r'^([0-9]+)(w|d|h|m|y)$', lifetime_value)
-    if search_result is None:
-        return None
-    toople = search_result.groups()
-    unit = toople[1]
-    length = int(toople[0])
-    return (length, unit)
-
-
-def calculate_lifetime_delta(lifetime_tuple):
-    """
-    :param lifetime_match: Resulting regex match object from parse_lifetime_value.
-    Check the value of the lifetime. If not indefinite convert the regex match from
-    `parse_lifetime_value` into a timedelta.
-    """
-    try:
-        length = lifetime_tuple[0]
-        unit = lifetime_tuple[1]
-    except Exception as e:
-        raise ValueError('Invalid lifetime label tuple: "{0}" error: "{1}"'.format(lifetime_tuple,e))
-    if unit is None:
-        raise ValueError("Unable to parse the lifetime unit")
-    if unit == 'w':
-        return timedelta(weeks=length)
-    elif unit == 'h':
-        return timedelta(hours=length)
-    elif unit == 'd':
-        return timedelta(days=length)
-    elif unit == 'm':
-        return timedelta(weeks=length*5)
-    elif unit == 'y':
-        return timedelta(weeks=length*52)
+def get_instance_source():
+    if INSTANCES_FILE:
+        return instance_states.iter_jsonl_instances(INSTANCES_FILE)
+    if INSTANCES is None and GOOGLE:
+        # build_compute imports gcp_compute, so it is made importable first
+        library.import_library('gcp_compute')
+        (compute, project_id) = instance_states.build_compute(GOOGLE)
+        return instance_states.iter_api_instances(compute, project_id, ZONES)
+    return instance_states.iter_instances(INSTANCES)
+
+def set_metrics_outputs(relay):
+    metrics = instance_states.METRICS.to_json()
+    relay.outputs.set('metrics', metrics)
+    relay.outputs.set('metrics_prometheus', instance_states.METRICS.to_prometheus())
+    for name, span in metrics['spans'].items():
+        print('{0}: {1} calls in {2:.3f}s, longest {3:.6f}s'.format(name, span['calls'], span['total_seconds'], span['max_seconds']))
+
+def set_slack_outputs(relay, messages):
+    # The workflow sends each message in its own step
+    relay.outputs.set('slack_block', messages[0])
+    for number in range(2, instance_states.SLACK_MAX_MESSAGES + 1):
+        relay.outputs.set('slack_block_{0}'.format(number), messages[number - 1] if len(messages) >= number else '[]')
+
+def set_action_outputs(relay, outputs):
+    for name in instance_states.ACTION_OUTPUTS:
+        relay.outputs.set(name, outputs[name])
+
+def set_plan_output(relay, outputs, states, messages):
+    """
+    Sets the `plan` output read by `execute-instance-actions`: the action
+    outputs, the report states the executor adds the action results to, and
+    the Slack messages it sends as they are when it takes no action.
+    """
+    relay.outputs.set('plan', {'actions': outputs, 'states': states, 'messages': messages})
+
+def run_simulation(relay, instance_source, report):
+    """
+    Dry run: forecast the fleet and leave the action outputs empty.
+    """
+    simulation = instance_states.FleetSimulation(instance_states.timenow_with_utc(), SIMULATE_DAYS, SIMULATE_STEP_MINUTES, CONFIG)
+    forecast_file = open(FORECAST_FILE, 'w') if FORECAST_FILE else None
+    forecast = instance_states.simulate_fleet(instance_source, simulation, forecast_file, verbose=LOG_LEVEL == 'verbose')
+    if forecast_file:
+        forecast_file.close()
+    print('Forecast for {0} instances: {1}'.format(forecast['instances'], json.dumps(forecast['events'], sort_keys=True)))
+    set_action_outputs(relay, report.outputs)
+    relay.outputs.set('forecast', forecast)
+    messages = instance_states.forecast_to_slack_messages(forecast)
+    set_slack_outputs(relay, messages)
+    set_plan_output(relay, report.outputs, None, messages)
+    set_metrics_outputs(relay)
+
+def run_evaluation(relay, instance_source, report):
+    schedule = instance_states.TransitionSchedule.load(SCHEDULE_FILE, CONFIG) if SCHEDULE_FILE else None
+    cache = instance_states.DecisionCache(DECISION_CACHE, CONFIG) if DECISION_CACHE else None
+    decisions_file = open(DECISIONS_FILE, 'a') if DECISIONS_FILE else None
+    history = instance_states.DecisionHistory(HISTORY_DIR) if HISTORY_DIR else None
+    if WORKERS > 1 and schedule is None and cache is None:
+        decisions = instance_states.evaluate_instances_parallel(instance_source, WORKERS, config=CONFIG)
     else:
-        raise ValueError("Unable to parse the lifetime unit '{0}'".format(unit))
-
-def get_iso_date(data):
-    for fmt in (r'%Y-%m-%dT%H:%M:%S.%f%z', r'%Y-%m-%dT%H:%M:%S%z', r'%Y-%m-%d'):
-        try:
-            iso_date = dt.strptime(data, fmt)
-            return iso_date.replace(tzinfo=datetime.timezone.utc)
-        except ValueError:
-            pass
-    raise ValueError('no valid date format found')
-
-def is_weekday(current_date):
-    return 0 <= current_date.weekday() <= 4
-
-def is_time_between(begin_time, end_time, check_time=None):
-    # If check time is not given, default to current UTC time
-    check_time = check_time or timenow_with_utc().time()
-    if begin_time < end_time:
-        return check_time >= begin_time and check_time <= end_time
-    else: # crosses midnight
-        return check_time >= begin_time or check_time <= end_time
-
-def is_current_worktime(worktime_match, geo, runschedule):
-    """
-    :param worktime_match: Resulting regex match object from validate_workhours_value.
-    Check the current time is in the working hours.
-    """
-    runschedule = runschedule or RUNSCHEDULE_DEFAULT
-    if runschedule.lower() == 'continuous':
-        return True
-
-    timezone = TIMEZONES[geo]
-    starttime = datetime.time(worktime_match[0] % 24)
-    endtime = datetime.time(worktime_match[1] % 24)
-    current_tz_date = dt.now(ZoneInfo(timezone))
-    if is_time_between(starttime, endtime, current_tz_date.time()):
-        if runschedule.lower() == 'daily':
-            return True
-        elif runschedule.lower() == 'weekdays' and is_weekday(current_tz_date):
-            return True
-    return False
-
-def get_workhours_times(workhours_value=None):
-    """
-    :param workhours_value: A string from your GCP instance.
-
-    Return a match object if a match is found; otherwise, return the None from
-    the search method.
-    """
-    if workhours_value is None:
-        return WORKHOURS_DEFAULT
-
-    search_result = re.search(r'^([0-9]+)-([0-9]+)$', workhours_value)
-    if search_result is None:
-        return None
-    toople = search_result.groups()
-    starthour = int(toople[0])
-    endhour = int(toople[1])
-    return (starthour, endhour)
-
-def validate_lifetime_value(val):
-    return val in INDEFINITE or parse_lifetime_value(val) is not None
-
-def validate_geo_value(val):
-    return val in TIMEZONES.keys()
-
-def validate_workhours_value(val):
-    return get_workhours_times(val) is not None
-
-def validate_runschedule_value(val):
-    return val in ['weekdays', 'daily', 'continuous']
-
-def validate_autostart_value(val):
-    return val in ['true', 'false']
-
-def validate_disabled_value(val):
-    return val in ['true', 'false']
-
-def validate_shutdown_type_value(val):
-    return val in ['shutdown', 'suspend']
-
-def validate_owner_value(val):
-    return bool(val and val.strip())
-
-def validate_termination_date_value(val):
-    try:
-        return get_iso_date(val) is not None
-    except Exception as e:
-        return False
-
-def validate_stopped_until_value(val):
-    try:
-        return get_iso_date(val) is not None
-    except Exception as e:
-        return False
-
-def required_labels_present(gcp_instance):
-    """
-    :param gpc_instance: a resource representing a GCP instance
-
-    This method returns a boolean based on if the labels associated with this
-    instance are valid or not. Invalid instances will be terminated.
-    """
-    for label in REQUIRED_LABELS:
-        if get_label(gcp_instance, label) is None:
-            raise ValueError("Missing label '{0}'".format(label))
-    return True
-
-def validate_labels(gcp_instance):
-    if 'labels' not in gcp_instance.keys() or gcp_instance['labels'] is None:
-        raise Exception('No Labels defined')
-    required_labels_present(gcp_instance)
-    for label in gcp_instance['labels'].keys():
-        if 'validate_{0}_value'.format(label) in globals():
-            val = get_label(gcp_instance, label)
-            if not globals()['validate_{0}_value'.format(label)](val):
-               raise ValueError('Invalid {0} label value: "{1}"'.format(label, val))
-
-def should_be_started(gcp_instance):
-    """
-    :param gcp_instance: a resource representing an GCP instance
-
-    This method returns a boolean and a reason if the instance should be
-    started.
-    """
-    autostart = get_label(gcp_instance, AUTOSTART_LABEL)
-    if autostart is None or autostart.lower() != 'true':
-        return (False, 'No configuration for starting')
-
-    disabled = get_label(gcp_instance, DISABLED_LABEL)
-    if disabled is not None and disabled.lower() == 'true':
-        return (False, 'Disabled')
-
-    validate_labels(gcp_instance)
-
-    timenow = timenow_with_utc()
-    runschedule = get_label(gcp_instance, RUNSCHEDULE_LABEL)
-    workhours = get_label(gcp_instance, WORKHOURS_LABEL)
-    geo  = get_label(gcp_instance, GEO_LABEL)
-
-    launch_date = get_iso_date(gcp_instance['creationTimestamp'])
-    lifetime = get_label(gcp_instance, LIFETIME_LABEL)
-    if lifetime is not None and lifetime not in INDEFINITE:
-        lifetime_match = parse_lifetime_value(lifetime)
-        end_date = launch_date + calculate_lifetime_delta(lifetime_match)
-        if end_date < timenow:
-            return (False, 'Lifetime elapsed on {0}'.format(end_date.strftime('%Y-%m-%d')))
-
-    if is_current_worktime(get_workhours_times(workhours), geo, runschedule):
-        stopped_until = get_label(gcp_instance, STOPPED_UNTIL_LABEL)
-        if stopped_until is not None:
-            stop_date = get_iso_date(stopped_until)
-            if stop_date < timenow:
-                return (True, 'Within working hours')
+        if WORKERS > 1:
+            print('Evaluating serially; `workers` is not used with a scheduleFile or decisionCache')
+        decisions = instance_states.evaluate_instances(instance_source, schedule=schedule, cache=cache, config=CONFIG)
+    evaluated = 0
+    for decision in decisions:
+        evaluated += 1
+        if history is not None:
+            history.add(decision)
+        if DELTA_ONLY and not decision.changed:
+            # Actions are repeated until they take effect; only the report
+            # leaves out the decisions that did not change
+            report.add(decision, report=False)
+            verbose_log('{0} is unchanged: {1}'.format(instance_states.instance_display_name(decision.record), decision.reason))
+            continue
+        report.add(decision)
+        if decision.state:
+            print(decision.message)
         else:
-            return (True, 'Within working hours')
-
-    return (False, 'No conditions met to initiate start')
-
-def get_termination_date(gcp_instance, wait_time=MINUTES_TO_WAIT):
-    """
-    :param gcp_instance: a resource representing an GCP instance
-    :param wait_time: The number of minutes to wait for the 'termination_date'
-
-    This method returns when a 'termination_date' is found and raises an
-    exception and terminates the instance when the wait_time has passed. The
-    method looks for the 'lifetime' key, parses it, and sets the
-    'termination_date' on the instance. The 'termination_date' can be set
-    directly on the instance, bypassing the steps to parse the lifetime key and
-    allowing this to return. This returns the termination_date value and reason
-    if action should be taken at a given time; otherwise, it returns None (e.g.,
-    for unlimited lifetimes or no tags available yet).
-    """
-    launch_date = get_iso_date(gcp_instance['creationTimestamp'])
-    timenow = timenow_with_utc()
-
+            verbose_log(decision.message)
+        if decisions_file:
+            decisions_file.write(json.dumps(decision.to_json()) + '\n')
+            decisions_file.flush()
+    if decisions_file:
+        decisions_file.close()
+    if history is not None:
+        history.close()
+    if cache is not None:
+        cache.close()
+    if schedule is not None:
+        schedule.finish()
+        schedule.save(SCHEDULE_FILE)
+        next_due = schedule.next_due()
+        print('Evaluated {0} of {1} instances. Next transition at {2}'.format(evaluated, len(schedule.entries),
+            datetime.datetime.fromtimestamp(next_due, datetime.timezone.utc).isoformat() if next_due else 'never'))
+
+    set_action_outputs(relay, report.outputs)
     try:
-        validate_labels(gcp_instance)
-    except ValueError as e:
-        if launch_date + timedelta(minutes=wait_time) < timenow:
-            # Timed out waiting for a label, so go ahead and delete this instance.
-            raise ValueError(e)
-        return (None, 'Waiting for labels to propagate')
-
-    disabled = get_label(gcp_instance, DISABLED_LABEL)
-    if disabled is not None and disabled.lower() == 'true':
-        return (timenow - timedelta(minutes=5), 'Disabled')
-
-    stopped_until = get_label(gcp_instance, STOPPED_UNTIL_LABEL)
-    if stopped_until is not None:
-        stop_date = get_iso_date(stopped_until)
-        if stop_date > timenow:
-            return (timenow - timedelta(minutes=5), 'Stopped until {0}'.format(stop_date.strftime('%Y-%m-%d')))
-
-    runschedule = get_label(gcp_instance, RUNSCHEDULE_LABEL)
-    workhours = get_label(gcp_instance, WORKHOURS_LABEL)
-    geo  = get_label(gcp_instance, GEO_LABEL)
-
-    if not is_current_worktime(get_workhours_times(workhours), geo, runschedule):
-        return (timenow - timedelta(minutes=5), 'Not within working hours')
-
-    termination_date = get_label(gcp_instance, TERMINATION_DATE_LABEL)
-
-    if termination_date is None:
-        lifetime = get_label(gcp_instance, LIFETIME_LABEL)
-        if lifetime in INDEFINITE:
-            return (None, 'Indefinite lifetime')
-        else:
-            lifetime_match = parse_lifetime_value(lifetime)
-            end_date = launch_date + calculate_lifetime_delta(lifetime_match)
-            owner = get_label(gcp_instance, 'owner')
-            return (end_date, '{0} lifetime expires at {1}. Owner {2}'.format(lifetime, end_date.strftime('%Y-%m-%d'), owner))
-    elif termination_date in INDEFINITE:
-        return (None, 'Indefinite lifetime')
-    else:
-        return (get_iso_date(termination_date), 'Scheduled for termination on {0}'.format(termination_date))
-
-def get_shutdown(instance):
-    if get_label(instance, SHUTDOWN_TYPE_LABEL) == 'suspend':
-        action = 'Suspending'
-        append_list = 'to_suspend'
-    else:
-        action = 'Stopping'
-        append_list = 'to_terminate'
-    return (append_list, action)
-
-def get_start(instance):
-    if instance['status'] == 'SUSPENDED':
-        action = 'Resuming'
-        append_list = 'to_resume'
-    else:
-        action = 'Starting'
-        append_list = 'to_start'
-    return (append_list, action)
-
-def chunk_list(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
-
-def states_to_slack_block(states):
-    """
-    :param states a hash of the various states with instances and reasons
-
-    Converts the states into a slack consumable block
-    """
-    blocks = []
-
-    for state, instances in states.items():
-        if not bool(instances):
-            continue
-
-        blocks.append({"type": "divider"})
-        section_header = {
-            "type": "section",
-            "text": {
-                "type": "mrkdwn",
-                "text": "*{0}*".format(state.capitalize())
-            },
-            "fields": [
-                {
-                    "type": "mrkdwn",
-                    "text": "*Instance*"
-                },
-                {
-                    "type": "mrkdwn",
-                    "text": "*Reason*"
-                }
-            ]
-        }
-        blocks.append(section_header)
-
-        for inst in chunk_list(list(instances.items()), 5):
-            section = {
-                "type": "section",
-                "fields": []
-            }
-            for instance, reason in inst:
-                section['fields'].append({
-                    "type": "plain_text",
-                    "text": instance
-                })
-                section['fields'].append({
-                    "type": "plain_text",
-                    "text": reason
-                })
-            blocks.append(section)
-
-    return json.dumps(blocks)
+        messages = instance_states.states_to_slack_messages(report.states)
+    except Exception as e:
+        print('Unable to print slack_block: {0} , {1}'.format(report.states, e))
+        messages = [json.dumps([{"type": "section", "text": {"type": "mrkdwn", "text": "Failed to generate slack block: {0}".format(e)}}])]
+    set_slack_outputs(relay, messages)
+    set_plan_output(relay, report.outputs, report.states, messages)
+    set_metrics_outputs(relay)
 
 if __name__ == '__main__':
-    to_terminate = []
-    to_suspend = []
-    to_delete = []
-    to_start = []
-    to_resume = []
-    states = {
-        "deleting": {},
-        "stopping": {},
-        "suspending": {},
-        "starting": {},
-        "resuming": {},
-        "expiring": {},
-        "error": {}
-    }
-
-    running_instances = filter(lambda i: i['status'] == 'RUNNING', INSTANCES)
-    timenow = timenow_with_utc()
-    for instance in running_instances:
-        try:
-            (termination_date, reason) = get_termination_date(instance)
-            if termination_date is not None:
-                action = None
-                if timenow > termination_date + timedelta(days=TERMINATE_DAYS):
-                    # Expired for longer than 14 days
-                    action = 'Deleting'
-                    to_delete.append(instance)
-                elif termination_date < timenow:
-                    # Should be shut down
-                    (append_list, action) = get_shutdown(instance)
-                    locals()[append_list].append(instance)
-                else:
-                    if termination_date < timenow + timedelta(days=1):
-                        # Instances expiring within 24 hours
-                        action = 'Expiring'
-                    else:
-                        verbose_log('{0}: {1}'.format(instance['name'], reason))
-                if action:
-                    states[action.lower()][instance['name']] = reason
-                    print('{0} {1}: {2}'.format(action, instance['name'], reason))
-            else:
-                verbose_log('{0} is running as expected: {1}'.format(instance['name'], reason))
-        except Exception as e:
-            (append_list, action) = get_shutdown(instance)
-            locals()[append_list].append(instance)
-            states['error'][instance['name']] = '{0}: {1}'.format(action, e)
-            print('{0} {1} due to a processing error: {2}'.format(action, instance['name'], e))
+    from relay_sdk import Interface
 
-    stopped_instances = filter(lambda i: i['status'] == 'TERMINATED' or i['status'] == 'SUSPENDED', INSTANCES)
-    for instance in stopped_instances:
-        try:
-            (should_start, reason) = should_be_started(instance)
-            if should_start:
-                (append_list, action) = get_start(instance)
-                locals()[append_list].append(instance)
-                states[action.lower()][instance['name']] = reason
-                print('{0} {1}: {2}'.format(action, instance['name'], reason))
-            else:
-                verbose_log('{0} is stopped as expected: {1}'.format(instance['name'], reason))
-        except Exception as e:
-            states['error'][instance['name']] = 'Not starting: {0}'.format(e)
-            print('Not starting {0} due to a processing error: {1}'.format(instance['name'], e))
+    relay = Interface()
+    load_relay_config(relay)
+    if PROFILE:
+        instance_states.METRICS.instrument(vars(instance_states), instance_states.PROFILED_FUNCTIONS)
 
-    relay.outputs.set('to_terminate', to_terminate)
-    relay.outputs.set('to_suspend', to_suspend)
-    relay.outputs.set('to_delete', to_delete)
-    relay.outputs.set('to_start', to_start)
-    relay.outputs.set('to_resume', to_resume)
-    try:
-        relay.outputs.set('slack_block', states_to_slack_block(states))
-    except Exception as e:
-        print('Unable to print slack_block: {0} , {1}'.format(states, e))
-        block = '[{"type": "section","text": {"type": "mrkdwn","text": "Failed to generate slack block: {0}"}}]'.format(e)
-        relay.outputs.set('slack_block', block)
+    report = instance_states.RunReport(instance_states.list_input_zones(INSTANCES) + (ZONES or []))
+    if SIMULATE_DAYS:
+        run_simulation(relay, get_instance_source(), report)
+    else:
+        run_evaluation(relay, get_instance_source(), report)
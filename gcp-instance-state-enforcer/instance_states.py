@@ -0,0 +1,2166 @@
+"""
+The decision logic of the GCP instance state enforcer.
+
+Evaluates GCP instance resources against their labels and decides which
+instances to stop, suspend, delete, start or resume. Importing the module has
+no side effects and it does not depend on Relay; the settings are passed in
+as an EvaluatorConfig. get-instance-states.py runs it as the Relay step and
+evaluate-instance-states.py runs it offline or as a daemon.
+"""
+## Origional source: https://raw.githubusercontent.com/puppetlabs/relay-workflows/master/gcp-instance-reaper/filter-instances.py
+
+import array
+import collections
+import concurrent.futures
+import datetime
+import functools
+import itertools
+import hashlib
+import heapq
+from datetime import datetime as dt, timedelta
+import re
+import json
+import math
+import mmap
+import os
+import sqlite3
+import struct
+import zlib
+import time
+# zoneinfo requires Python 3.9+
+import sys
+if sys.version_info.major < 3 or sys.version_info.minor < 9:
+    raise Exception("Must be using Python 3.9+")
+
+from zoneinfo import ZoneInfo
+
+# The `MINUTES_TO_WAIT` global variable is the number of minutes to wait for
+# a termination_date label to appear for the GCP instance.
+MINUTES_TO_WAIT = 5
+
+# The Indefinite lifetime constant
+INDEFINITE = ['indefinite', 'infinity', '0']
+
+# Autostart instances are started this many minutes before their working
+# hours, spread over waves of this many minutes. The default wave matches the
+# hourly trigger, so each wave is started by its own run.
+START_LEAD_MINUTES = 0
+START_WAVES = 1
+START_WAVE_MINUTES = 60
+
+WORKHOURS_DEFAULT = (7, 18)
+RUNSCHEDULE_DEFAULT = 'weekdays'
+
+LIFETIME_PATTERN = re.compile(r'^([0-9]+)(w|d|h|m|y)$')
+WORKHOURS_PATTERN = re.compile(r'^([0-9]+)-([0-9]+)$')
+WORKHOURS_DAYS_PATTERN = re.compile(r'^(mon|tue|wed|thu|fri|sat|sun)(?:-(mon|tue|wed|thu|fri|sat|sun))?$')
+
+# Schedules are compiled to a mask of the hours of the week, bit
+# `weekday * 24 + hour` in the local time of the geo, Monday first
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+HOURS_PER_DAY = 24
+WEEK_MASK = (1 << (7 * HOURS_PER_DAY)) - 1
+RUNSCHEDULE_DAYS = {
+    'weekdays': (0, 1, 2, 3, 4),
+    'daily': (0, 1, 2, 3, 4, 5, 6)
+}
+
+# Geo to timezone mappings
+TIMEZONES = {
+    "apj": "Asia/Singapore",
+    "emea": "Europe/Belfast",
+    "amer": "America/Los_Angeles"
+}
+
+# Label names (user-configurable)
+TERMINATION_DATE_LABEL = 'termination_date'
+LIFETIME_LABEL = 'lifetime'
+AUTOSTART_LABEL = 'autostart'
+SHUTDOWN_TYPE_LABEL = 'shutdown_type'
+RUNSCHEDULE_LABEL = 'runschedule'
+WORKHOURS_LABEL = 'workhours'
+GEO_LABEL = 'geo'
+DISABLED_LABEL = 'disabled'
+STOPPED_UNTIL_LABEL = 'stopped_until'
+
+# GCP refuses to suspend instances with GPUs, local SSDs or more memory than
+# this. The memory-optimized machine families are all above the limit.
+SUSPEND_MAX_MEMORY_MB = 208 * 1024
+SUSPEND_UNSUPPORTED_FAMILIES = ['m1', 'm2', 'm3']
+SUSPEND_UNSUPPORTED_CLASSES = ['megamem', 'ultramem']
+CUSTOM_MACHINE_TYPE_PATTERN = re.compile(r'custom-[0-9]+-([0-9]+)(-ext)?$')
+# The memory of predefined machine types is their vCPUs times the GB per vCPU
+# of their family and class. Families missing here are not checked.
+PREDEFINED_MACHINE_TYPE_PATTERN = re.compile(r'^([a-z0-9]+)-([a-z]+)-([0-9]+)')
+MACHINE_TYPE_GB_PER_CPU = {
+    'n1': {'standard': 3.75, 'highmem': 6.5, 'highcpu': 0.9},
+    'n2': {'standard': 4, 'highmem': 8, 'highcpu': 1},
+    'n2d': {'standard': 4, 'highmem': 8, 'highcpu': 1},
+    'n4': {'standard': 4, 'highmem': 8, 'highcpu': 2},
+    'e2': {'standard': 4, 'highmem': 8, 'highcpu': 1},
+    'c2': {'standard': 4},
+    'c2d': {'standard': 4, 'highmem': 8, 'highcpu': 2},
+    'c3': {'standard': 4, 'highmem': 8, 'highcpu': 2},
+    'c3d': {'standard': 4, 'highmem': 8, 'highcpu': 2},
+    't2d': {'standard': 4},
+    't2a': {'standard': 4}
+}
+
+# Defaults of the EvaluatorConfig settings
+REQUIRED_LABELS = ['geo', 'lifetime', 'owner']
+TERMINATE_DAYS = 14
+
+# The version of the decision logic, part of the config fingerprint so stored
+# decisions and schedules are dropped when it changes. Bump it with any change
+# to how a decision or the next transition of an instance is made
+LOGIC_VERSION = 2
+
+# Instances sent to a worker at a time in parallel mode, and the chunks in
+# flight per worker
+PARALLEL_CHUNK_SIZE = 500
+PARALLEL_CHUNKS_PER_WORKER = 2
+
+# The most label values and label sets a LabelPolicy remembers, and the most
+# workhours values and schedule masks cached, so a long running evaluator does
+# not grow with every value it has ever seen
+LABEL_CACHE_SIZE = 16384
+SCHEDULE_CACHE_SIZE = 4096
+
+# The statuses the evaluator acts on. Instances in other statuses are skipped,
+# and not listed at all when the evaluator lists them
+EVALUATED_STATUSES = ['RUNNING', 'TERMINATED', 'SUSPENDED']
+# The instance fields the evaluator reads, the only ones requested when it
+# lists instances
+INSTANCE_FIELDS = ['name', 'zone', 'status', 'creationTimestamp', 'labels', 'machineType', 'guestAccelerators', 'disks/type']
+# Instances per page of a listing, the most the API returns
+LIST_PAGE_SIZE = 500
+
+# The action outputs and the states of the report, in report order
+ACTION_OUTPUTS = ['to_terminate', 'to_suspend', 'to_delete', 'to_start', 'to_resume']
+REPORT_STATES = ['deleting', 'stopping', 'suspending', 'starting', 'resuming', 'expiring', 'error']
+
+# The decision history: the columns with their array type, the dictionary of
+# the strings they refer to, and the runs, each the time and the number of
+# rows written up to its end
+HISTORY_COLUMNS = [('instance', 'I'), ('owner', 'I'), ('geo', 'I'), ('reason', 'I'), ('status', 'B'), ('action', 'B')]
+HISTORY_STRINGS = 'strings.jsonl'
+HISTORY_RUNS = 'runs.bin'
+HISTORY_RUN_FORMAT = '<dQ'
+# Rows buffered before they are written, and the longest gap between runs
+# that is counted as time an instance spent in its state
+HISTORY_FLUSH_ROWS = 50000
+HISTORY_MAX_GAP_HOURS = 2
+# Reasons are stored as codes with the parts that vary between instances
+# replaced, so the dictionary stays small
+REASON_CODE_PATTERNS = [
+    (re.compile(r'[0-9]{4}-[0-9]{2}-[0-9]{2}'), '<date>'),
+    (re.compile(r'^[0-9]+[a-z] lifetime'), '<lifetime> lifetime'),
+    (re.compile(r'Owner .*$'), 'Owner <owner>'),
+    (re.compile(r'"[^"]*"'), '"<value>"'),
+]
+
+# The prefix of the Prometheus metric names
+METRICS_PREFIX = 'gcp_instance_state'
+# The functions timed when profiling, the phases of evaluating an instance
+PROFILED_FUNCTIONS = [
+    'validate_labels',
+    'parse_label_date',
+    'parse_date',
+    'get_iso_date',
+    'is_current_worktime',
+    'get_termination_date',
+    'should_be_started',
+    'evaluate_running',
+    'evaluate_stopped',
+    'next_transition',
+    'simulate_fleet',
+    'states_to_slack_messages',
+]
+
+class RunMetrics(object):
+    """
+    Counters and timing spans of a run, reported as the `metrics` output.
+
+    Counters are always kept. Timing spans are only recorded for the
+    functions wrapped by `instrument`, which is only done when profiling is
+    switched on, so the evaluator runs unchanged otherwise.
+    """
+    __slots__ = ('counters', 'spans', 'started')
+
+    def __init__(self):
+        # (name, ((label, value), ...)) to the count
+        self.counters = {}
+        # span name to [calls, total seconds, max seconds]
+        self.spans = {}
+        self.started = time.perf_counter()
+
+    def merge(self, counters, spans):
+        """Adds the counters and spans of another RunMetrics."""
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for name, (calls, total, longest) in spans.items():
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += calls
+            span[1] += total
+            span[2] = max(span[2], longest)
+
+    def reset(self):
+        """Starts a new run. Wrapped functions keep recording in to this object."""
+        self.counters.clear()
+        self.spans.clear()
+        self.started = time.perf_counter()
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def record(self, name, seconds):
+        span = self.spans.get(name)
+        if span is None:
+            self.spans[name] = [1, seconds, seconds]
+        else:
+            span[0] += 1
+            span[1] += seconds
+            if seconds > span[2]:
+                span[2] = seconds
+
+    def timed(self, name, function):
+        """Returns the function wrapped in a timing span."""
+        perf_counter = time.perf_counter
+        record = self.record
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, perf_counter() - start)
+        return wrapper
+
+    def instrument(self, namespace, names):
+        """
+        :param namespace: The dict the functions are looked up in, usually
+        `globals()`.
+        :param names: The names of the functions to time.
+
+        Replaces the functions with timed wrappers. Calls go through the
+        namespace, so every caller is timed.
+        """
+        for name in names:
+            namespace[name] = self.timed(name, namespace[name])
+
+    def to_json(self):
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, []).append(dict(labels, value=value))
+        return {
+            'duration_seconds': time.perf_counter() - self.started,
+            'counters': counters,
+            'spans': {name: {'calls': calls, 'total_seconds': total, 'max_seconds': longest}
+                for name, (calls, total, longest) in sorted(self.spans.items())}
+        }
+
+    def to_prometheus(self, prefix=METRICS_PREFIX):
+        """Returns the metrics in the Prometheus text exposition format."""
+        def labels_text(labels):
+            if not labels:
+                return ''
+            return '{' + ','.join('{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for (label, value) in labels) + '}'
+
+        lines = [
+            '# TYPE {0}_duration_seconds gauge'.format(prefix),
+            '{0}_duration_seconds {1}'.format(prefix, time.perf_counter() - self.started)
+        ]
+        typed = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in typed:
+                lines.append('# TYPE {0}_{1}_total counter'.format(prefix, name))
+                typed.add(name)
+            lines.append('{0}_{1}_total{2} {3}'.format(prefix, name, labels_text(labels), value))
+        if self.spans:
+            lines.append('# TYPE {0}_span_seconds summary'.format(prefix))
+            for name, (calls, total, _longest) in sorted(self.spans.items()):
+                lines.append('{0}_span_seconds_sum{{span="{1}"}} {2}'.format(prefix, name, total))
+                lines.append('{0}_span_seconds_count{{span="{1}"}} {2}'.format(prefix, name, calls))
+            lines.append('# TYPE {0}_span_seconds_max gauge'.format(prefix))
+            for name, (_calls, _total, longest) in sorted(self.spans.items()):
+                lines.append('{0}_span_seconds_max{{span="{1}"}} {2}'.format(prefix, name, longest))
+        return '\n'.join(lines) + '\n'
+
+METRICS = RunMetrics()
+
+def get_label(gcp_instance, label_name):
+    """
+    :param gcp_instance: a description of a GCP instance.
+    :param label_name: A string of the key name you are searching for.
+
+    This method returns None if the GCP instance currently has no tags
+    or if the label is not found. If the tag is found, it returns the label
+    value.
+    """
+    if 'labels' not in gcp_instance.keys() or gcp_instance['labels'] is None:
+        return None
+
+    return gcp_instance['labels'][label_name] if label_name in gcp_instance['labels'] else None
+
+def timenow_with_utc():
+    """
+    Return a datetime object that includes the tzinfo for utc time.
+    """
+    time = dt.utcnow()
+    time = time.replace(tzinfo=datetime.timezone.utc)
+    return time
+
+def parse_lifetime_value(lifetime_value):
+    """
+    :param lifetime_value: A string from your GCP instance.
+
+    Return a match object if a match is found; otherwise, return the None from
+    the search method.
+    """
+    search_result = LIFETIME_PATTERN.search(lifetime_value)
+    if search_result is None:
+        return None
+    toople = search_result.groups()
+    unit = toople[1]
+    length = int(toople[0])
+    return (length, unit)
+
+
+def calculate_lifetime_delta(lifetime_tuple):
+    """
+    :param lifetime_match: Resulting regex match object from parse_lifetime_value.
+    Check the value of the lifetime. If not indefinite convert the regex match from
+    `parse_lifetime_value` into a timedelta.
+    """
+    try:
+        length = lifetime_tuple[0]
+        unit = lifetime_tuple[1]
+    except Exception as e:
+        raise ValueError('Invalid lifetime label tuple: "{0}" error: "{1}"'.format(lifetime_tuple,e))
+    if unit is None:
+        raise ValueError("Unable to parse the lifetime unit")
+    if unit == 'w':
+        return timedelta(weeks=length)
+    elif unit == 'h':
+        return timedelta(hours=length)
+    elif unit == 'd':
+        return timedelta(days=length)
+    elif unit == 'm':
+        return timedelta(weeks=length*5)
+    elif unit == 'y':
+        return timedelta(weeks=length*52)
+    else:
+        raise ValueError("Unable to parse the lifetime unit '{0}'".format(unit))
+
+def get_iso_date(data):
+    for fmt in (r'%Y-%m-%dT%H:%M:%S.%f%z', r'%Y-%m-%dT%H:%M:%S%z', r'%Y-%m-%d'):
+        try:
+            iso_date = dt.strptime(data, fmt)
+            return iso_date.replace(tzinfo=datetime.timezone.utc)
+        except ValueError:
+            pass
+    raise ValueError('no valid date format found')
+
+@functools.lru_cache(maxsize=len(TIMEZONES))
+def get_timezone(geo):
+    return ZoneInfo(TIMEZONES[geo])
+
+@functools.lru_cache(maxsize=256)
+def get_hour_of_week(geo, timenow):
+    """
+    :param geo: The geo of the instance.
+    :param timenow: The time of the run.
+
+    Returns the hour of the week of the time in the local time of the geo.
+    Every instance of a run is evaluated at the same time, so this is worked
+    out once per geo.
+    """
+    local_time = timenow.astimezone(get_timezone(geo))
+    return local_time.weekday() * HOURS_PER_DAY + local_time.hour
+
+def get_hours_mask(starthour, endhour):
+    """Returns the mask of the hours of a day from starthour to endhour."""
+    starthour %= HOURS_PER_DAY
+    endhour %= HOURS_PER_DAY
+    day = (1 << HOURS_PER_DAY) - 1
+    if starthour < endhour:
+        return day & ~((1 << starthour) - 1) & ((1 << endhour) - 1)
+    # crosses midnight, or all day when the hours are the same
+    return (day & ~((1 << starthour) - 1)) | ((1 << endhour) - 1)
+
+@functools.lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def get_schedule_mask(workhours, runschedule=None):
+    """
+    :param workhours: The windows from get_workhours_times.
+    :param runschedule: The runschedule label of the instance.
+
+    Returns the 168 bit mask of the hours of the week the instance should be
+    running in. Windows without days of their own are on the days of the
+    runschedule.
+    """
+    runschedule = (runschedule or RUNSCHEDULE_DEFAULT).lower()
+    if runschedule == 'continuous':
+        return WEEK_MASK
+    mask = 0
+    for (days, starthour, endhour) in workhours or ():
+        hours = get_hours_mask(starthour, endhour)
+        for day in (days if days is not None else RUNSCHEDULE_DAYS.get(runschedule, ())):
+            mask |= hours << (day * HOURS_PER_DAY)
+    return mask
+
+def is_current_worktime(worktime_match, geo, runschedule, timenow=None):
+    """
+    :param worktime_match: The windows from get_workhours_times.
+    :param timenow: The time of the run, the current time when None.
+    Check the current time is in the working hours.
+    """
+    mask = get_schedule_mask(worktime_match, runschedule)
+    if mask == WEEK_MASK or mask == 0:
+        return mask != 0
+    return bool(mask >> get_hour_of_week(geo, timenow or timenow_with_utc()) & 1)
+
+def get_day_range(first, last=None):
+    """Returns the weekdays from the first to the last day name, wrapping."""
+    first = DAY_NAMES.index(first)
+    last = DAY_NAMES.index(last) if last else first
+    return tuple((first + offset) % 7 for offset in range((last - first) % 7 + 1))
+
+@functools.lru_cache(maxsize=SCHEDULE_CACHE_SIZE)
+def get_workhours_times(workhours_value=None):
+    """
+    :param workhours_value: A string from your GCP instance.
+
+    The value is one or more `starthour-endhour` windows separated by `_`,
+    each optionally after the days it applies to, e.g. `9-17`, `8-12_13-17`
+    or `mon-thu_8-18_fri_8-14`. Windows after a `day` or `day-day` range only
+    apply on those days; the others apply on the days of the runschedule.
+
+    Returns a tuple of (days, starthour, endhour) windows, with days None for
+    the runschedule days, or None when the value is invalid.
+    """
+    if workhours_value is None:
+        return ((None,) + WORKHOURS_DEFAULT,)
+
+    windows = []
+    days = None
+    # Day ranges that have not had a window yet
+    dangling = False
+    for token in workhours_value.split('_'):
+        search_result = WORKHOURS_PATTERN.search(token)
+        if search_result is not None:
+            toople = search_result.groups()
+            windows.append((days, int(toople[0]), int(toople[1])))
+            dangling = False
+            continue
+        search_result = WORKHOURS_DAYS_PATTERN.search(token)
+        if search_result is None:
+            return None
+        days = get_day_range(*search_result.groups())
+        dangling = True
+    if dangling or not windows:
+        return None
+    return tuple(windows)
+
+def validate_lifetime_value(val):
+    return val in INDEFINITE or parse_lifetime_value(val) is not None
+
+def validate_geo_value(val):
+    return val in TIMEZONES.keys()
+
+def validate_workhours_value(val):
+    return get_workhours_times(val) is not None
+
+def validate_runschedule_value(val):
+    return val in ['weekdays', 'daily', 'continuous']
+
+def validate_autostart_value(val):
+    return val in ['true', 'false']
+
+def validate_disabled_value(val):
+    return val in ['true', 'false']
+
+def validate_shutdown_type_value(val):
+    return val in ['shutdown', 'suspend']
+
+def validate_owner_value(val):
+    return bool(val and val.strip())
+
+def validate_termination_date_value(val):
+    try:
+        return get_iso_date(val) is not None
+    except Exception as e:
+        return False
+
+def validate_stopped_until_value(val):
+    try:
+        return get_iso_date(val) is not None
+    except Exception as e:
+        return False
+
+class LabelPolicy(object):
+    """
+    The label rules for a run, built once from the required labels and the
+    `validate_<label>_value` functions.
+
+    Validation results are memoized by (label, value) and whole label sets by
+    their items, so instances that share label values are only checked once.
+    Each memo is emptied when it reaches LABEL_CACHE_SIZE entries.
+    """
+    __slots__ = ('required_labels', 'checks', '_value_cache', '_labels_cache')
+
+    def __init__(self, required_labels, checks=None):
+        """
+        :param required_labels: A list of label names every instance must have.
+        :param checks: A dict of label name to a function that returns if a
+        value is valid. Defaults to the `validate_<label>_value` functions.
+        """
+        self.required_labels = tuple(required_labels)
+        self.checks = checks if checks is not None else collect_label_checks()
+        self._value_cache = {}
+        self._labels_cache = {}
+
+    def is_valid(self, label, value):
+        key = (label, value)
+        try:
+            return self._value_cache[key]
+        except KeyError:
+            check = self.checks.get(label)
+            valid = check is None or bool(check(value))
+            if len(self._value_cache) >= LABEL_CACHE_SIZE:
+                self._value_cache.clear()
+            self._value_cache[key] = valid
+            return valid
+
+    def violations(self, labels):
+        """
+        :param labels: The labels dict of a GCP instance.
+
+        Returns a tuple of every violation of the policy, which is empty when
+        the labels are valid.
+        """
+        key = frozenset(labels.items())
+        try:
+            return self._labels_cache[key]
+        except KeyError:
+            pass
+        violations = ["Missing label '{0}'".format(label) for label in self.required_labels if labels.get(label) is None]
+        for label, value in labels.items():
+            if not self.is_valid(label, value):
+                violations.append('Invalid {0} label value: "{1}"'.format(label, value))
+        violations = tuple(violations)
+        if len(self._labels_cache) >= LABEL_CACHE_SIZE:
+            self._labels_cache.clear()
+        self._labels_cache[key] = violations
+        return violations
+
+    def validate(self, labels):
+        """
+        :param labels: The labels dict of a GCP instance.
+
+        Raises a ValueError listing every violation when the labels of the
+        instance are invalid. Invalid instances will be terminated.
+        """
+        if labels is None:
+            raise Exception('No Labels defined')
+        violations = self.violations(labels)
+        if violations:
+            raise ValueError(', '.join(violations))
+
+def collect_label_checks():
+    """
+    Returns a dict of label name to its `validate_<label>_value` function.
+    """
+    checks = {}
+    for name, function in globals().items():
+        if name.startswith('validate_') and name.endswith('_value') and callable(function):
+            checks[name[len('validate_'):-len('_value')]] = function
+    return checks
+
+class EvaluatorConfig(object):
+    """
+    The settings every decision is made with.
+    """
+    __slots__ = ('required_labels', 'terminate_days', 'minutes_to_wait', 'start_lead_minutes', 'start_waves',
+        'start_wave_minutes', 'policy')
+
+    def __init__(self, required_labels=None, terminate_days=TERMINATE_DAYS, minutes_to_wait=MINUTES_TO_WAIT,
+            start_lead_minutes=START_LEAD_MINUTES, start_waves=START_WAVES, start_wave_minutes=START_WAVE_MINUTES):
+        """
+        :param required_labels: A list of label names every instance must have.
+        :param terminate_days: The number of days after the end of its lifetime
+        that a running instance is deleted.
+        :param minutes_to_wait: The number of minutes to wait for the labels of
+        a new instance.
+        :param start_lead_minutes: The number of minutes before its working
+        hours that an autostart instance is started.
+        :param start_waves: The number of waves the starts are spread over.
+        :param start_wave_minutes: The number of minutes between the waves.
+        """
+        self.required_labels = list(required_labels if required_labels is not None else REQUIRED_LABELS)
+        self.terminate_days = int(terminate_days)
+        self.minutes_to_wait = minutes_to_wait
+        self.start_lead_minutes = max(0, int(start_lead_minutes))
+        self.start_waves = max(1, int(start_waves))
+        self.start_wave_minutes = max(0, int(start_wave_minutes))
+        self.policy = LabelPolicy(self.required_labels)
+
+    def __reduce__(self):
+        # The memoized validations of the policy are rebuilt, not copied
+        return (EvaluatorConfig, (self.required_labels, self.terminate_days, self.minutes_to_wait,
+            self.start_lead_minutes, self.start_waves, self.start_wave_minutes))
+
+def validate_labels(record, policy=None):
+    (policy or DEFAULT_CONFIG.policy).validate(record.labels)
+
+DEFAULT_CONFIG = EvaluatorConfig()
+
+def parse_date(value):
+    """
+    :param value: A date string.
+
+    Returns the parsed date or None when the value is not a date.
+    """
+    try:
+        return get_iso_date(value)
+    except (TypeError, ValueError):
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def parse_label_date(value):
+    """
+    :param value: A date label value.
+
+    Returns the parsed date or None when the value is not a date. Label dates
+    are shared by many instances, so the results are cached.
+    """
+    return parse_date(value)
+
+@functools.lru_cache(maxsize=1024)
+def parse_lifetime_delta(lifetime_value):
+    """
+    :param lifetime_value: A lifetime label value.
+
+    Returns the lifetime as a timedelta or None when it is indefinite or can
+    not be parsed.
+    """
+    if lifetime_value is None or lifetime_value in INDEFINITE:
+        return None
+    lifetime_match = parse_lifetime_value(lifetime_value)
+    return calculate_lifetime_delta(lifetime_match) if lifetime_match else None
+
+def get_machine_type_memory(machine_type):
+    """
+    :param machine_type: The name of a machine type, such as n2-highmem-64.
+
+    Returns the MB of memory of a custom or predefined machine type, or None
+    when it is not known.
+    """
+    custom_match = CUSTOM_MACHINE_TYPE_PATTERN.search(machine_type)
+    if custom_match:
+        return int(custom_match.group(1))
+    predefined_match = PREDEFINED_MACHINE_TYPE_PATTERN.match(machine_type)
+    if predefined_match is None:
+        return None
+    (family, machine_class, cpus) = predefined_match.groups()
+    gb_per_cpu = MACHINE_TYPE_GB_PER_CPU.get(family, {}).get(machine_class)
+    return int(int(cpus) * gb_per_cpu * 1024) if gb_per_cpu else None
+
+def get_suspend_blocker(gcp_instance):
+    """
+    :param gcp_instance: a resource representing a GCP instance
+
+    Returns why GCP will refuse to suspend the instance, or None when it can
+    be suspended as far as the instance resource tells. The memory of machine
+    types of families missing from MACHINE_TYPE_GB_PER_CPU is not known, so
+    they are tried and stopped when the suspend is refused.
+    """
+    if gcp_instance.get('guestAccelerators'):
+        return 'GPUs attached'
+    if any(disk.get('type') == 'SCRATCH' for disk in gcp_instance.get('disks') or []):
+        return 'Local SSDs attached'
+    machine_type = (gcp_instance.get('machineType') or '').rsplit('/', 1)[-1]
+    parts = machine_type.split('-')
+    if parts[0] in SUSPEND_UNSUPPORTED_FAMILIES or (len(parts) > 1 and parts[1] in SUSPEND_UNSUPPORTED_CLASSES):
+        return 'Memory-optimized machine type {0}'.format(machine_type)
+    memory = get_machine_type_memory(machine_type)
+    if memory is not None and memory > SUSPEND_MAX_MEMORY_MB:
+        return 'More than {0} GB of memory'.format(SUSPEND_MAX_MEMORY_MB // 1024)
+    return None
+
+def restore_slots(cls, values):
+    obj = cls.__new__(cls)
+    for slot, value in zip(cls.__slots__, values):
+        setattr(obj, slot, value)
+    return obj
+
+class InstanceRecord(object):
+    """
+    The parts of a GCP instance the evaluator uses, with the dates, lifetime
+    and working hours parsed once when the record is built.
+
+    Values that fail to parse are kept as None; the label policy rejects them
+    before they are used.
+    """
+    __slots__ = ('name', 'zone', 'status', 'labels', 'launch_date', 'owner',
+        'geo', 'lifetime', 'lifetime_end', 'workhours', 'runschedule',
+        'autostart', 'disabled', 'shutdown_type', 'stopped_until',
+        'termination_date', 'suspend_blocker')
+
+    def __init__(self, gcp_instance, zone=None):
+        """
+        :param gcp_instance: a resource representing a GCP instance
+        :param zone: The zone of the instance when it does not carry one.
+        """
+        labels = gcp_instance.get('labels')
+        self.name = gcp_instance['name']
+        self.zone = get_zone(gcp_instance) or zone
+        self.status = gcp_instance.get('status')
+        self.labels = labels
+        labels = labels or {}
+        # Every instance has its own creation time, so caching it would only
+        # push the label dates out of the cache
+        self.launch_date = parse_date(gcp_instance.get('creationTimestamp'))
+        self.owner = labels.get('owner')
+        self.geo = labels.get(GEO_LABEL)
+        self.lifetime = labels.get(LIFETIME_LABEL)
+        delta = parse_lifetime_delta(self.lifetime)
+        self.lifetime_end = self.launch_date + delta if delta and self.launch_date else None
+        self.workhours = get_workhours_times(labels.get(WORKHOURS_LABEL))
+        self.runschedule = labels.get(RUNSCHEDULE_LABEL)
+        self.autostart = (labels.get(AUTOSTART_LABEL) or '').lower() == 'true'
+        self.disabled = (labels.get(DISABLED_LABEL) or '').lower() == 'true'
+        self.shutdown_type = labels.get(SHUTDOWN_TYPE_LABEL)
+        stopped_until = labels.get(STOPPED_UNTIL_LABEL)
+        self.stopped_until = parse_label_date(stopped_until) if stopped_until is not None else None
+        self.termination_date = labels.get(TERMINATION_DATE_LABEL)
+        self.suspend_blocker = get_suspend_blocker(gcp_instance) if self.shutdown_type == 'suspend' else None
+
+    def get_launch_date(self):
+        if self.launch_date is None:
+            raise ValueError('Invalid creationTimestamp for {0}'.format(self.name))
+        return self.launch_date
+
+    def get_lifetime_end(self):
+        if self.lifetime_end is None:
+            self.get_launch_date()
+            raise ValueError('Invalid lifetime label tuple: "{0}"'.format(self.lifetime))
+        return self.lifetime_end
+
+    def __reduce__(self):
+        # Pickled field by field for the parallel mode, which is much quicker
+        # than the default for slotted classes
+        return (restore_slots, (InstanceRecord, tuple(getattr(self, slot) for slot in self.__slots__)))
+
+    def to_output(self):
+        """
+        Returns the instance as passed to the action steps.
+        """
+        return {
+            'name': self.name,
+            'zone': self.zone,
+            'shutdown_type': 'shutdown' if self.suspend_blocker else (self.shutdown_type or 'shutdown')
+        }
+
+def get_start_lead(record, config=None):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+
+    Returns how long before its working hours the instance is started, or
+    None when it is started when they begin. Each instance is in the start
+    wave picked by a hash of its name, and every wave is started
+    `start_wave_minutes` before the next one.
+    """
+    config = config or DEFAULT_CONFIG
+    if not record.autostart or (config.start_lead_minutes == 0 and config.start_waves == 1):
+        return None
+    wave = zlib.crc32(record.name.encode('utf-8')) % config.start_waves
+    minutes = config.start_lead_minutes + wave * config.start_wave_minutes
+    return timedelta(minutes=minutes) if minutes else None
+
+def is_start_time(record, timenow, lead):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param timenow: The time of the run.
+    :param lead: The start lead from get_start_lead.
+
+    Returns if the instance is within its working hours or starts them
+    within the lead.
+    """
+    if is_current_worktime(record.workhours, record.geo, record.runschedule, timenow):
+        return True
+    return lead is not None and is_current_worktime(record.workhours, record.geo, record.runschedule, timenow + lead)
+
+def should_be_started(record, config=None, timenow=None):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+    :param timenow: The time of the run, the current time when None.
+
+    This method returns a boolean and a reason if the instance should be
+    started.
+    """
+    if not record.autostart:
+        return (False, 'No configuration for starting')
+
+    if record.disabled:
+        return (False, 'Disabled')
+
+    config = config or DEFAULT_CONFIG
+    validate_labels(record, config.policy)
+
+    timenow = timenow or timenow_with_utc()
+
+    if record.lifetime is not None and record.lifetime not in INDEFINITE:
+        end_date = record.get_lifetime_end()
+        if end_date < timenow:
+            return (False, 'Lifetime elapsed on {0}'.format(end_date.strftime('%Y-%m-%d')))
+
+    if is_start_time(record, timenow, get_start_lead(record, config)):
+        if is_current_worktime(record.workhours, record.geo, record.runschedule, timenow):
+            reason = 'Within working hours'
+        else:
+            reason = 'Pre-warming for working hours'
+        if record.stopped_until is not None:
+            if record.stopped_until < timenow:
+                return (True, reason)
+        else:
+            return (True, reason)
+
+    return (False, 'No conditions met to initiate start')
+
+def get_termination_date(record, wait_time=None, config=None, timenow=None):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param wait_time: The number of minutes to wait for the 'termination_date',
+    the `minutes_to_wait` of the config when None
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+    :param timenow: The time of the run, the current time when None.
+
+    This method returns when a 'termination_date' is found and raises an
+    exception and terminates the instance when the wait_time has passed. The
+    method looks for the 'lifetime' key, parses it, and sets the
+    'termination_date' on the instance. The 'termination_date' can be set
+    directly on the instance, bypassing the steps to parse the lifetime key and
+    allowing this to return. This returns the termination_date value and reason
+    if action should be taken at a given time; otherwise, it returns None (e.g.,
+    for unlimited lifetimes or no tags available yet).
+    """
+    config = config or DEFAULT_CONFIG
+    wait_time = wait_time if wait_time is not None else config.minutes_to_wait
+    launch_date = record.get_launch_date()
+    timenow = timenow or timenow_with_utc()
+
+    try:
+        validate_labels(record, config.policy)
+    except ValueError as e:
+        if launch_date + timedelta(minutes=wait_time) < timenow:
+            # Timed out waiting for a label, so go ahead and delete this instance.
+            raise ValueError(e)
+        return (None, 'Waiting for labels to propagate')
+
+    if record.disabled:
+        return (timenow - timedelta(minutes=5), 'Disabled')
+
+    if record.stopped_until is not None and record.stopped_until > timenow:
+        return (timenow - timedelta(minutes=5), 'Stopped until {0}'.format(record.stopped_until.strftime('%Y-%m-%d')))
+
+    if not is_start_time(record, timenow, get_start_lead(record, config)):
+        return (timenow - timedelta(minutes=5), 'Not within working hours')
+
+    termination_date = record.termination_date
+
+    if termination_date is None:
+        if record.lifetime in INDEFINITE:
+            return (None, 'Indefinite lifetime')
+        else:
+            end_date = record.get_lifetime_end()
+            return (end_date, '{0} lifetime expires at {1}. Owner {2}'.format(record.lifetime, end_date.strftime('%Y-%m-%d'), record.owner))
+    elif termination_date in INDEFINITE:
+        return (None, 'Indefinite lifetime')
+    else:
+        return (get_iso_date(termination_date), 'Scheduled for termination on {0}'.format(termination_date))
+
+def get_shutdown(record):
+    # Instances that can not be suspended are stopped straight away rather
+    # than after a suspend call that is bound to fail
+    if record.shutdown_type == 'suspend' and record.suspend_blocker is None:
+        action = 'Suspending'
+        append_list = 'to_suspend'
+    else:
+        action = 'Stopping'
+        append_list = 'to_terminate'
+    return (append_list, action)
+
+def shutdown_reason(record, reason):
+    if record.suspend_blocker:
+        return '{0}. Not suspendable: {1}'.format(reason, record.suspend_blocker)
+    return reason
+
+def get_start(record):
+    if record.status == 'SUSPENDED':
+        action = 'Resuming'
+        append_list = 'to_resume'
+    else:
+        action = 'Starting'
+        append_list = 'to_start'
+    return (append_list, action)
+
+def get_zone(gcp_instance):
+    """
+    :param gcp_instance: a description of a GCP instance.
+
+    Returns the zone name from the zone URL of the instance or None when the
+    instance has no zone.
+    """
+    zone = gcp_instance.get('zone')
+    return zone.rsplit('/', 1)[-1] if zone else None
+
+def iter_instances(instances):
+    """
+    :param instances: A list of GCP instances, a dict of zone name to a list of
+    GCP instances, or the `items` of an `aggregatedList` response.
+
+    Yield a (zone, instance) tuple for every instance.
+    """
+    if isinstance(instances, dict):
+        for zone, zone_instances in instances.items():
+            # aggregatedList keys are 'zones/<name>' and wrap the instances
+            zone = zone.rsplit('/', 1)[-1]
+            if isinstance(zone_instances, dict):
+                zone_instances = zone_instances.get('instances', [])
+            for instance in zone_instances or []:
+                yield (get_zone(instance) or zone, instance)
+    else:
+        for instance in instances or []:
+            yield (get_zone(instance), instance)
+
+def list_input_zones(instances):
+    """
+    :param instances: The instances input as accepted by `iter_instances`.
+
+    Returns the zone names of a zone keyed input, so the per-zone outputs exist
+    even for zones without instances.
+    """
+    if isinstance(instances, dict):
+        return [zone.rsplit('/', 1)[-1] for zone in instances]
+    return []
+
+def iter_jsonl_instances(path):
+    """
+    :param path: A file with one JSON encoded GCP instance per line.
+
+    Yield a (zone, instance) tuple for every instance, reading one line at a
+    time.
+    """
+    with open(path) as fh:
+        for line in fh:
+            line = line.strip()
+            if line:
+                instance = json.loads(line)
+                yield (get_zone(instance), instance)
+
+def iter_file_instances(path):
+    """
+    :param path: A JSON-lines file of GCP instances, or a JSON file with any
+    of the inputs accepted by `iter_instances`.
+
+    Yield a (zone, instance) tuple for every instance. JSON-lines files are
+    read one line at a time.
+    """
+    with open(path) as fh:
+        first_line = fh.readline()
+    try:
+        first = json.loads(first_line)
+    except ValueError:
+        first = None
+    if isinstance(first, dict) and 'name' in first:
+        return iter_jsonl_instances(path)
+    with open(path) as fh:
+        return iter_instances(json.load(fh))
+
+def get_list_options(aggregated=False):
+    """
+    :param aggregated: If the options are for an aggregated listing.
+
+    Returns the listing parameters that only return the INSTANCE_FIELDS of
+    instances in the EVALUATED_STATUSES, filtered by the API.
+    """
+    fields = '{0}({1})'.format('items/*/instances' if aggregated else 'items', ','.join(INSTANCE_FIELDS))
+    return {
+        'filter': ' OR '.join('(status = "{0}")'.format(status) for status in EVALUATED_STATUSES),
+        'fields': 'nextPageToken,{0}'.format(fields),
+        'maxResults': LIST_PAGE_SIZE
+    }
+
+def iter_api_instances(compute, project_id, zones=None):
+    """
+    :param compute: The compute API resource.
+    :param project_id: The project to list the instances of.
+    :param zones: The zones to list. All zones are listed with a single
+    aggregated listing when this is empty.
+
+    Yield a (zone, instance) tuple for every instance the evaluator acts on,
+    fetching one page at a time. Only the fields the evaluator reads are
+    transferred.
+    """
+    if zones:
+        options = get_list_options()
+        for zone in zones:
+            request = compute.instances().list(project=project_id, zone=zone, **options)
+            while request is not None:
+                response = request.execute()
+                METRICS.count('api_pages')
+                for instance in response.get('items', []):
+                    yield (zone, instance)
+                request = compute.instances().list_next(request, response)
+    else:
+        request = compute.instances().aggregatedList(project=project_id, **get_list_options(aggregated=True))
+        while request is not None:
+            response = request.execute()
+            METRICS.count('api_pages')
+            for scope, scoped in response.get('items', {}).items():
+                for instance in scoped.get('instances', []):
+                    yield (get_zone(instance) or scope.rsplit('/', 1)[-1], instance)
+            request = compute.instances().aggregatedList_next(request, response)
+
+def build_compute(google):
+    """
+    :param google: The `google` step configuration with the service account.
+
+    Returns the compute API resource and the project id of the service account.
+    This needs the gcp_compute module next to this script.
+    """
+    import gcp_compute
+    return gcp_compute.get_compute(google['service_account_info'])
+
+def instance_display_name(record):
+    return '{0}/{1}'.format(record.zone, record.name) if record.zone else record.name
+
+class Decision(object):
+    """
+    The outcome of evaluating one instance.
+
+    `append_list` is the name of the action output the instance belongs to and
+    `state` the section of the report it is listed in; both are None when
+    nothing needs to be done.
+    """
+    __slots__ = ('record', 'append_list', 'state', 'reason', 'message', 'changed')
+
+    def __init__(self, record, append_list, state, reason, message, changed=True):
+        self.record = record
+        self.append_list = append_list
+        self.state = state
+        self.reason = reason
+        self.message = message
+        # If the decision differs from the one made in the previous run
+        self.changed = changed
+
+    def __reduce__(self):
+        return (Decision, (self.record, self.append_list, self.state, self.reason, self.message, self.changed))
+
+    def to_json(self):
+        return {
+            'name': self.record.name,
+            'zone': self.record.zone,
+            'status': self.record.status,
+            'action': self.append_list,
+            'state': self.state,
+            'reason': self.reason
+        }
+
+class RunReport(object):
+    """
+    The outputs of a run: the instances of every action output grouped by
+    zone, and the reason of every instance in each state of the report.
+    """
+    __slots__ = ('outputs', 'states')
+
+    def __init__(self, zones=()):
+        """
+        :param zones: The zones every action output has an entry for, even
+        when the zone has no instances.
+        """
+        self.outputs = {name: {zone: [] for zone in zones} for name in ACTION_OUTPUTS}
+        self.states = {state: {} for state in REPORT_STATES}
+
+    def add(self, decision, report=True):
+        """
+        :param decision: The Decision of an instance.
+        :param report: Whether the instance is listed in the report states as
+        well as in its action output.
+        """
+        record = decision.record
+        if decision.append_list:
+            self.outputs[decision.append_list].setdefault(record.zone, []).append(record.to_output())
+        if decision.state and report:
+            self.states[decision.state][instance_display_name(record)] = decision.reason
+
+def evaluate_running(record, timenow, config=None):
+    config = config or DEFAULT_CONFIG
+    name = instance_display_name(record)
+    try:
+        (termination_date, reason) = get_termination_date(record, config=config, timenow=timenow)
+        if termination_date is None:
+            return Decision(record, None, None, reason, '{0} is running as expected: {1}'.format(name, reason))
+        if timenow > termination_date + timedelta(days=config.terminate_days):
+            # Expired for longer than `terminate_days`
+            (append_list, action) = ('to_delete', 'Deleting')
+        elif termination_date < timenow:
+            # Should be shut down
+            (append_list, action) = get_shutdown(record)
+            reason = shutdown_reason(record, reason)
+        elif termination_date < timenow + timedelta(days=1):
+            # Instances expiring within 24 hours
+            (append_list, action) = (None, 'Expiring')
+        else:
+            return Decision(record, None, None, reason, '{0}: {1}'.format(name, reason))
+        return Decision(record, append_list, action.lower(), reason, '{0} {1}: {2}'.format(action, name, reason))
+    except Exception as e:
+        # Any failure stops the instance, so count them by type
+        METRICS.count('errors', phase='running', type=type(e).__name__)
+        (append_list, action) = get_shutdown(record)
+        return Decision(record, append_list, 'error', shutdown_reason(record, '{0}: {1}'.format(action, e)),
+            '{0} {1} due to a processing error: {2}'.format(action, name, e))
+
+def evaluate_stopped(record, config=None, timenow=None):
+    name = instance_display_name(record)
+    try:
+        (should_start, reason) = should_be_started(record, config, timenow)
+        if should_start:
+            (append_list, action) = get_start(record)
+            return Decision(record, append_list, action.lower(), reason, '{0} {1}: {2}'.format(action, name, reason))
+        return Decision(record, None, None, reason, '{0} is stopped as expected: {1}'.format(name, reason))
+    except Exception as e:
+        METRICS.count('errors', phase='stopped', type=type(e).__name__)
+        return Decision(record, None, 'error', 'Not starting: {0}'.format(e),
+            'Not starting {0} due to a processing error: {1}'.format(name, e))
+
+def next_workhours_boundary(record, timenow):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param timenow: The time to look from.
+
+    Returns the next time the instance moves in to or out of its working hours
+    in the local time of its geo, or None when it never does, such as when it
+    runs continuously.
+    """
+    if record.workhours is None or record.geo not in TIMEZONES:
+        return None
+    mask = get_schedule_mask(record.workhours, record.runschedule)
+    if mask == WEEK_MASK or mask == 0:
+        return None
+    hour = get_hour_of_week(record.geo, timenow)
+    # Rotate the week so the current hour is bit 0, the first bit that
+    # differs from it is then the number of hours to the boundary
+    rotated = ((mask >> hour) | (mask << (WEEK_MASK.bit_length() - hour))) & WEEK_MASK
+    changes = rotated ^ (WEEK_MASK if rotated & 1 else 0)
+    hours = (changes & -changes).bit_length() - 1
+    timezone = get_timezone(record.geo)
+    local_hour = timenow.astimezone(timezone).replace(minute=0, second=0, microsecond=0, tzinfo=None)
+    # Counted in wall clock hours, like the labels
+    return (local_hour + timedelta(hours=hours)).replace(tzinfo=timezone).astimezone(datetime.timezone.utc)
+
+def next_transition(record, timenow, config=None):
+    """
+    :param record: an InstanceRecord of a GCP instance
+    :param timenow: The time to look from.
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+
+    Returns the earliest time after timenow at which the decision for the
+    instance can change without its labels or status changing, or None when
+    it can not. These are the working hours boundaries, the end of the label
+    grace period, `stopped_until`, and the expiring, stopping and deleting
+    points of the lifetime or `termination_date`.
+    """
+    config = config or DEFAULT_CONFIG
+    candidates = [next_workhours_boundary(record, timenow), record.stopped_until]
+    lead = get_start_lead(record, config)
+    if lead is not None:
+        # Where the working hours are entered or left `lead` ahead of time
+        boundary = next_workhours_boundary(record, timenow + lead)
+        candidates.append(boundary - lead if boundary is not None else None)
+    if record.launch_date is not None:
+        candidates.append(record.launch_date + timedelta(minutes=config.minutes_to_wait))
+    termination_date = parse_label_date(record.termination_date) if record.termination_date else None
+    for end_date in (record.lifetime_end, termination_date):
+        if end_date is not None:
+            candidates.extend([end_date - timedelta(days=1), end_date, end_date + timedelta(days=config.terminate_days)])
+    future = [candidate for candidate in candidates if candidate is not None and candidate > timenow]
+    return min(future) if future else None
+
+def instance_fingerprint(gcp_instance):
+    """
+    :param gcp_instance: a resource representing a GCP instance
+
+    Returns a stable digest of the parts of the instance the decision is made
+    from.
+    """
+    data = json.dumps([gcp_instance.get('status'), gcp_instance.get('creationTimestamp'), gcp_instance.get('labels'),
+        get_suspend_blocker(gcp_instance)], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+def config_fingerprint(config=None):
+    """Returns a digest of the logic version and the settings that affect every decision."""
+    config = config or DEFAULT_CONFIG
+    data = json.dumps([LOGIC_VERSION, sorted(config.required_labels), config.terminate_days, config.minutes_to_wait,
+        config.start_lead_minutes, config.start_waves, config.start_wave_minutes], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+
+class TransitionSchedule(object):
+    """
+    The next transition time of every instance, ordered in a heap.
+
+    An instance only needs to be evaluated when its transition is due, when
+    its fingerprint changed, or when it is not in the schedule yet. Instances
+    with a pending action are scheduled as due straight away so they are
+    evaluated again until the action has taken effect.
+    """
+    __slots__ = ('entries', 'heap', 'config', 'due', 'seen')
+
+    def __init__(self, entries=None, saved_config=None, config=None):
+        """
+        :param entries: A dict of instance key to a (due timestamp, fingerprint)
+        tuple. A due timestamp of None never becomes due.
+        :param saved_config: The config fingerprint the entries were made with.
+        :param config: The EvaluatorConfig of the run.
+        """
+        self.config = config_fingerprint(config)
+        self.entries = dict(entries or {}) if saved_config == self.config else {}
+        self.heap = [(due, key) for key, (due, _fingerprint) in self.entries.items() if due is not None]
+        heapq.heapify(self.heap)
+        self.due = set()
+        self.seen = set()
+
+    @classmethod
+    def load(cls, path, config=None):
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except FileNotFoundError:
+            return cls(config=config)
+        return cls({key: tuple(entry) for key, entry in data.get('entries', {}).items()}, data.get('config'), config)
+
+    def save(self, path):
+        with open(path, 'w') as fh:
+            json.dump({'config': self.config, 'entries': self.entries}, fh)
+
+    def begin(self, timenow):
+        """
+        :param timenow: The time of the run.
+
+        Pops every transition that is due at timenow off the heap.
+        """
+        now = timenow.timestamp()
+        self.due = set()
+        self.seen = set()
+        while self.heap and self.heap[0][0] <= now:
+            (due, key) = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            # Entries that were rescheduled leave stale items in the heap
+            if entry is not None and entry[0] == due:
+                self.due.add(key)
+
+    def is_due(self, key, fingerprint):
+        self.seen.add(key)
+        entry = self.entries.get(key)
+        return entry is None or entry[1] != fingerprint or key in self.due
+
+    def update(self, key, fingerprint, due):
+        """
+        :param key: The instance key.
+        :param fingerprint: The fingerprint of the instance.
+        :param due: The datetime of the next transition or None.
+        """
+        due = due.timestamp() if due is not None else None
+        self.entries[key] = (due, fingerprint)
+        if due is not None:
+            heapq.heappush(self.heap, (due, key))
+
+    def finish(self):
+        """Drops the instances that were not seen in the run."""
+        for key in list(self.entries):
+            if key not in self.seen:
+                del self.entries[key]
+
+    def next_due(self):
+        """Returns the timestamp of the earliest scheduled transition or None."""
+        while self.heap and self.entries.get(self.heap[0][1], (None,))[0] != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+class DecisionCache(object):
+    """
+    A SQLite store of the last decision for every instance, keyed on the
+    instance fingerprint and valid until the next transition of the instance.
+
+    Instances whose fingerprint is unchanged and whose decision is still valid
+    reuse the stored decision without being evaluated.
+    """
+
+    def __init__(self, path, config=None):
+        """
+        :param path: The SQLite file.
+        :param config: The EvaluatorConfig of the run.
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS decisions (
+            key TEXT PRIMARY KEY, fingerprint TEXT, append_list TEXT, state TEXT,
+            reason TEXT, message TEXT, valid_until REAL, run INTEGER)''')
+        fingerprint = config_fingerprint(config)
+        if self.get_meta('config') != fingerprint:
+            # Decisions made with other settings can not be reused
+            self.db.execute('DELETE FROM decisions')
+            self.set_meta('config', fingerprint)
+        self.run = int(self.get_meta('run') or 0) + 1
+        self.set_meta('run', str(self.run))
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def lookup(self, key):
+        """
+        Returns the stored (fingerprint, append_list, state, reason, message,
+        valid_until) of the instance or None.
+        """
+        row = self.db.execute('SELECT fingerprint, append_list, state, reason, message, valid_until FROM decisions WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.db.execute('UPDATE decisions SET run = ? WHERE key = ?', (self.run, key))
+        return row
+
+    def store(self, key, fingerprint, decision, valid_until):
+        """
+        :param key: The instance key.
+        :param fingerprint: The fingerprint of the instance.
+        :param decision: The Decision made for the instance.
+        :param valid_until: The datetime the decision can next change or None.
+        """
+        self.db.execute('INSERT OR REPLACE INTO decisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (key, fingerprint,
+            decision.append_list, decision.state, decision.reason, decision.message,
+            valid_until.timestamp() if valid_until is not None else None, self.run))
+
+    def finish(self):
+        """
+        Drops the instances that were not seen in this run, saves the cache and
+        starts the next run.
+        """
+        self.db.execute('DELETE FROM decisions WHERE run < ?', (self.run,))
+        self.run += 1
+        self.set_meta('run', str(self.run))
+        self.db.commit()
+
+    def close(self):
+        self.finish()
+        self.db.close()
+
+@functools.lru_cache(maxsize=4096)
+def get_reason_code(reason):
+    """Returns the reason with the dates, lifetimes, owners and label values replaced."""
+    for (pattern, replacement) in REASON_CODE_PATTERNS:
+        reason = pattern.sub(replacement, reason)
+    return reason
+
+def history_run_path(path):
+    return os.path.join(path, HISTORY_RUNS)
+
+def history_column_path(path, name, typecode):
+    return os.path.join(path, '{0}.{1}'.format(name, typecode.lower()))
+
+def read_history_runs(path):
+    """Returns the (timestamp, end row) of every run in the history."""
+    try:
+        with open(history_run_path(path), 'rb') as fh:
+            data = fh.read()
+    except FileNotFoundError:
+        return []
+    size = struct.calcsize(HISTORY_RUN_FORMAT)
+    return list(struct.iter_unpack(HISTORY_RUN_FORMAT, data[:len(data) - len(data) % size]))
+
+def read_history_strings(path):
+    """Returns the list of strings of the history dictionary, by id."""
+    try:
+        with open(os.path.join(path, HISTORY_STRINGS)) as fh:
+            return [json.loads(line) for line in fh if line.endswith('\n')]
+    except FileNotFoundError:
+        return []
+
+class DecisionHistory(object):
+    """
+    An append-only columnar file set of the decision for every instance in
+    every run, for reporting on the fleet over time.
+
+    Every column is a file of fixed size integers, with the instance, owner,
+    geo and reason code stored as ids in a dictionary of strings. A run is
+    only recorded once all its rows are written, so rows of a run that did
+    not finish are dropped when the next run starts.
+    """
+
+    def __init__(self, path, timenow=None):
+        """
+        :param path: The directory of the history.
+        :param timenow: The time of the run.
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.timenow = timenow or timenow_with_utc()
+        strings = read_history_strings(path)
+        self.strings = {value: index for index, value in enumerate(strings)}
+        # Rewrite the dictionary when a run stopped part way through a line
+        with open(os.path.join(path, HISTORY_STRINGS), 'a+') as fh:
+            if fh.tell() and sum(len(json.dumps(value)) + 1 for value in strings) != fh.tell():
+                fh.truncate(0)
+                fh.writelines(json.dumps(value) + '\n' for value in strings)
+        self.strings_file = open(os.path.join(path, HISTORY_STRINGS), 'a')
+        runs = read_history_runs(path)
+        self.rows = runs[-1][1] if runs else 0
+        self.columns = []
+        for (name, typecode) in HISTORY_COLUMNS:
+            column = array.array(typecode)
+            with open(history_column_path(path, name, typecode), 'ab') as fh:
+                fh.truncate(self.rows * column.itemsize)
+            self.columns.append((history_column_path(path, name, typecode), column))
+
+    def string_id(self, value):
+        try:
+            return self.strings[value]
+        except KeyError:
+            index = len(self.strings)
+            self.strings[value] = index
+            self.strings_file.write(json.dumps(value) + '\n')
+            return index
+
+    def add(self, decision):
+        """
+        :param decision: The Decision made for an instance in this run.
+        """
+        record = decision.record
+        values = (
+            self.string_id(instance_display_name(record)),
+            self.string_id(record.owner or ''),
+            self.string_id(record.geo or ''),
+            self.string_id(get_reason_code(decision.reason)),
+            EVALUATED_STATUSES.index(record.status),
+            ACTION_OUTPUTS.index(decision.append_list) + 1 if decision.append_list else 0
+        )
+        for ((_path, column), value) in zip(self.columns, values):
+            column.append(value)
+        if len(self.columns[0][1]) >= HISTORY_FLUSH_ROWS:
+            self.flush()
+
+    def flush(self):
+        # The strings go first, so every id written has its string
+        self.strings_file.flush()
+        for (path, column) in self.columns:
+            with open(path, 'ab') as fh:
+                column.tofile(fh)
+        self.rows += len(self.columns[0][1])
+        for (_path, column) in self.columns:
+            del column[:]
+
+    def discard(self):
+        """
+        Stops without recording the run. Its rows are dropped by the next run.
+        """
+        self.strings_file.close()
+
+    def close(self):
+        """
+        Writes the remaining rows and records the run.
+        """
+        self.flush()
+        self.strings_file.close()
+        with open(history_run_path(self.path), 'ab') as fh:
+            fh.write(struct.pack(HISTORY_RUN_FORMAT, self.timenow.timestamp(), self.rows))
+
+class HistoryReader(object):
+    """
+    Reads a DecisionHistory through memory maps, so the columns are not
+    loaded in to memory and only the pages that are used are read.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The directory of the history.
+        """
+        self.strings = read_history_strings(path)
+        self.runs = read_history_runs(path)
+        rows = self.runs[-1][1] if self.runs else 0
+        self.files = []
+        self.columns = {}
+        for (name, typecode) in HISTORY_COLUMNS:
+            size = rows * array.array(typecode).itemsize
+            if size == 0:
+                self.columns[name] = memoryview(array.array(typecode))
+                continue
+            fh = open(history_column_path(path, name, typecode), 'rb')
+            mapped = mmap.mmap(fh.fileno(), size, access=mmap.ACCESS_READ)
+            self.files.append((fh, mapped))
+            self.columns[name] = memoryview(mapped).cast(typecode)
+
+    def run_hours(self):
+        """
+        Returns the hours each run accounts for, the time to the next run up
+        to HISTORY_MAX_GAP_HOURS. The last run counts the same as the one
+        before it.
+        """
+        times = [timestamp for (timestamp, _end) in self.runs]
+        hours = [min(HISTORY_MAX_GAP_HOURS, (later - earlier) / 3600) for (earlier, later) in zip(times, times[1:])]
+        if times:
+            hours.append(hours[-1] if hours else 1.0)
+        return hours
+
+    def close(self):
+        for (_name, column) in list(self.columns.items()):
+            column.release()
+        self.columns = {}
+        for (fh, mapped) in self.files:
+            mapped.close()
+            fh.close()
+        self.files = []
+
+def summarize_history(reader, group_by=('owner', 'geo'), since=None, until=None):
+    """
+    :param reader: The HistoryReader of the history.
+    :param group_by: The columns to group by besides the month: any of
+    `owner`, `geo`, `instance` and `reason`.
+    :param since: The first month to include as `YYYY-MM`.
+    :param until: The last month to include as `YYYY-MM`.
+
+    Returns a list of dicts with the running and off hours, and the number
+    of each action, per month and group. An instance is counted as running
+    from a run when it was left running or started in it.
+    """
+    starting = set(ACTION_OUTPUTS.index(name) + 1 for name in ('to_start', 'to_resume'))
+    stopping = set(ACTION_OUTPUTS.index(name) + 1 for name in ('to_terminate', 'to_suspend', 'to_delete'))
+    running_status = EVALUATED_STATUSES.index('RUNNING')
+    columns = [reader.columns[name] for name in group_by] + [reader.columns['status'], reader.columns['action']]
+    totals = {}
+    first = 0
+    for ((timestamp, end), hours) in zip(reader.runs, reader.run_hours()):
+        month = dt.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m')
+        if (since and month < since) or (until and month > until):
+            first = end
+            continue
+        counts = collections.Counter(zip(*[column[first:end] for column in columns]))
+        first = end
+        for (key, count) in counts.items():
+            (group, status, action) = (key[:-2], key[-2], key[-1])
+            total = totals.get((month,) + group)
+            if total is None:
+                total = totals[(month,) + group] = [0.0, 0.0, collections.Counter()]
+            if action in starting or (status == running_status and action not in stopping):
+                total[0] += count * hours
+            else:
+                total[1] += count * hours
+            if action:
+                total[2][ACTION_OUTPUTS[action - 1]] += count
+    summary = []
+    for (key, (running, off, actions)) in sorted(totals.items(), key=lambda item: (item[0][0],) + tuple(reader.strings[value] for value in item[0][1:])):
+        row = {'month': key[0]}
+        row.update((name, reader.strings[value]) for (name, value) in zip(group_by, key[1:]))
+        row.update(running_hours=round(running, 2), off_hours=round(off, 2))
+        row.update((name, actions[name]) for name in ACTION_OUTPUTS)
+        summary.append(row)
+    return summary
+
+def evaluate_instances(instances, timenow=None, schedule=None, cache=None, config=None):
+    """
+    :param instances: An iterable of (zone, GCP instance) tuples.
+    :param timenow: The time to evaluate the instances at.
+    :param schedule: An optional TransitionSchedule. Instances that are not
+    due in it are skipped.
+    :param cache: An optional DecisionCache. Instances with a valid cached
+    decision reuse it instead of being evaluated.
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+
+    Yield a Decision for every running, stopped or suspended instance as soon
+    as it has been evaluated. Only one instance is held at a time.
+    """
+    timenow = timenow or timenow_with_utc()
+    if schedule is not None:
+        schedule.begin(timenow)
+    for zone, instance in instances:
+        record = InstanceRecord(instance, zone)
+        METRICS.count('instances', status=record.status)
+        if record.status not in EVALUATED_STATUSES:
+            continue
+        key = instance_display_name(record)
+        fingerprint = instance_fingerprint(instance) if schedule is not None or cache is not None else None
+        if schedule is not None and not schedule.is_due(key, fingerprint):
+            METRICS.count('skipped', reason='not_due')
+            continue
+
+        cached = cache.lookup(key) if cache is not None else None
+        if cached is not None and cached[0] == fingerprint and (cached[5] is None or cached[5] > timenow.timestamp()):
+            METRICS.count('cache_hits')
+            decision = Decision(record, cached[1], cached[2], cached[3], cached[4], changed=False)
+        else:
+            if record.status == 'RUNNING':
+                decision = evaluate_running(record, timenow, config)
+            else:
+                decision = evaluate_stopped(record, config, timenow)
+            if cached is not None:
+                decision.changed = (cached[1], cached[2], cached[3]) != (decision.append_list, decision.state, decision.reason)
+            if cache is not None:
+                cache.store(key, fingerprint, decision, next_transition(record, timenow, config))
+
+        if schedule is not None:
+            schedule.update(key, fingerprint, next_transition(record, timenow, config) if decision.state is None else timenow)
+        METRICS.count('decisions', action=decision.append_list or 'none', state=decision.state or 'none')
+        yield decision
+
+def init_worker(config):
+    """Sets the config of a worker process once, so its policy stays warm."""
+    global DEFAULT_CONFIG
+    DEFAULT_CONFIG = config
+
+def get_workers(value):
+    """
+    :param value: The number of worker processes, or `auto` for one per CPU.
+
+    Returns the number of worker processes, 1 for the serial evaluation.
+    """
+    if str(value).lower() == 'auto':
+        return os.cpu_count() or 1
+    try:
+        return max(1, int(value or 1))
+    except ValueError:
+        print('Invalid `workers` parameter "{0}". Using 1.'.format(value))
+        return 1
+
+def evaluate_chunk(chunk, timenow):
+    """
+    :param chunk: A list of (zone, GCP instance) tuples.
+    :param timenow: The time to evaluate the instances at.
+
+    Evaluates the instances in a worker process. Returns the decisions with the
+    counters and spans of the evaluation, which stay in the worker otherwise.
+    """
+    METRICS.reset()
+    decisions = list(evaluate_instances(chunk, timenow))
+    return (decisions, METRICS.counters, METRICS.spans)
+
+def evaluate_instances_parallel(instances, workers, timenow=None, config=None, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    :param instances: An iterable of (zone, GCP instance) tuples.
+    :param workers: The number of worker processes.
+    :param timenow: The time to evaluate the instances at.
+    :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+    :param chunk_size: The number of instances sent to a worker at a time.
+
+    Yield the same decisions as `evaluate_instances`, in the same order, with
+    the instances evaluated in chunks by a pool of processes. Only a few
+    chunks per worker are read ahead of the decisions that were yielded.
+    """
+    timenow = timenow or timenow_with_utc()
+    config = config or DEFAULT_CONFIG
+    instances = iter(instances)
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker, initargs=(config,)) as executor:
+        pending = collections.deque()
+        while True:
+            chunk = list(itertools.islice(instances, chunk_size))
+            if chunk:
+                pending.append(executor.submit(evaluate_chunk, chunk, timenow))
+            # Chunks are collected in the order they were sent, so the
+            # decisions come out in input order
+            while pending and (not chunk or len(pending) >= workers * PARALLEL_CHUNKS_PER_WORKER):
+                (decisions, counters, spans) = pending.popleft().result()
+                METRICS.merge(counters, spans)
+                yield from decisions
+            if not chunk:
+                break
+
+class FleetSimulation(object):
+    """
+    Replays the labels of a fleet over a window of evenly spaced evaluation
+    times without calling the evaluator for every instance at every step.
+
+    Each condition of the enforcement logic is a bit mask over the time grid,
+    a Python int with bit `i` set when the condition holds at step `i`. The
+    working hours masks are built once per geo and hour of the week mask, the
+    date conditions are prefix masks, and the running state of an instance
+    follows from a few integer operations on them.
+    """
+
+    def __init__(self, start, days=7, step_minutes=15, config=None):
+        """
+        :param start: The time of the first evaluation.
+        :param days: The length of the window in days.
+        :param step_minutes: The minutes between evaluations.
+        :param config: The EvaluatorConfig, DEFAULT_CONFIG when None.
+        """
+        self.config = config or DEFAULT_CONFIG
+        self.step = timedelta(minutes=step_minutes)
+        # Evaluations are aligned to the step like the scheduled runs are
+        epoch = start.timestamp()
+        self.start = dt.fromtimestamp(epoch - epoch % self.step.total_seconds(), datetime.timezone.utc)
+        self.steps = int(timedelta(days=days) / self.step)
+        self.full = (1 << self.steps) - 1
+        self.times = [self.start + self.step * i for i in range(self.steps)]
+        self.timestamps = [time.isoformat() for time in self.times]
+        self.dates = [time.strftime('%Y-%m-%d') for time in self.times]
+        self._week_hours = {}
+        self._work_masks = {}
+
+    def index_after(self, date):
+        """Returns the first step that is strictly after the date."""
+        if date < self.start:
+            return 0
+        return min(self.steps, int((date - self.start) / self.step) + 1)
+
+    def mask_before(self, date):
+        """Returns the mask of the steps strictly before the date."""
+        if date <= self.start:
+            return 0
+        return (1 << min(self.steps, math.ceil((date - self.start) / self.step))) - 1
+
+    def mask_until(self, date):
+        """Returns the mask of the steps at or before the date."""
+        return (1 << self.index_after(date)) - 1
+
+    def mask_after(self, date):
+        """Returns the mask of the steps strictly after the date."""
+        return self.full & ~self.mask_until(date)
+
+    def week_mask(self, geo, week, lead=None):
+        """
+        Returns the mask of the steps that are within the hours of the week
+        mask in the local time of the geo, `lead` ahead of the step.
+        """
+        key = (geo, week, lead)
+        if key not in self._work_masks:
+            if (geo, lead) not in self._week_hours:
+                self._week_hours[(geo, lead)] = [get_hour_of_week(geo, time + lead if lead else time) for time in self.times]
+            mask = 0
+            for i, hour in enumerate(self._week_hours[(geo, lead)]):
+                if week >> hour & 1:
+                    mask |= 1 << i
+            self._work_masks[key] = mask
+        return self._work_masks[key]
+
+    def work_mask(self, record):
+        """
+        Returns the mask of the steps within the working hours of the
+        instance or its start lead, the same as `is_start_time` at each step.
+        """
+        week = get_schedule_mask(record.workhours, record.runschedule)
+        if week == WEEK_MASK or week == 0:
+            return self.full if week else 0
+        lead = get_start_lead(record, self.config)
+        mask = self.week_mask(record.geo, week)
+        if lead is not None:
+            mask |= self.week_mask(record.geo, week, lead)
+        return mask
+
+    def masks(self, record):
+        """
+        :param record: an InstanceRecord of a GCP instance
+
+        Returns (keep, start, delete) masks: the steps a running instance is
+        left running at, the steps a stopped instance is started at, and the
+        steps a running instance is deleted at.
+        """
+        try:
+            validate_labels(record, self.config.policy)
+            record.get_launch_date()
+        except Exception:
+            # Invalid instances are stopped and never started
+            return (0, 0, 0)
+        if record.disabled:
+            return (0, 0, 0)
+
+        work = self.work_mask(record)
+        # The shutdowns for working hours and `stopped_until` come before the
+        # lifetime checks, so only the rest of the steps can be deletes
+        keep = work
+        if record.stopped_until is not None:
+            keep &= ~self.mask_before(record.stopped_until)
+        delete = 0
+        end_date = None
+        lifetime_end = None
+        try:
+            if record.lifetime is not None and record.lifetime not in INDEFINITE:
+                lifetime_end = record.get_lifetime_end()
+            if record.termination_date is None:
+                if record.lifetime not in INDEFINITE:
+                    end_date = record.get_lifetime_end()
+            elif record.termination_date not in INDEFINITE:
+                end_date = get_iso_date(record.termination_date)
+        except Exception:
+            # Like invalid labels, an unusable lifetime stops the instance
+            return (0, 0, 0)
+        if end_date is not None:
+            delete = keep & self.mask_after(end_date + timedelta(days=self.config.terminate_days))
+            keep &= self.mask_until(end_date)
+
+        start = 0
+        if record.autostart:
+            start = work
+            if lifetime_end is not None:
+                start &= self.mask_until(lifetime_end)
+            if record.stopped_until is not None:
+                start &= self.mask_after(record.stopped_until)
+        return (keep, start, delete)
+
+    def running_mask(self, running, keep, start):
+        """
+        :param running: If the instance is running before the first step.
+        :param keep: The steps a running instance is left running at.
+        :param start: The steps a stopped instance is started at.
+
+        Returns the mask of the steps the instance is running after.
+        """
+        if start & ~keep == 0:
+            # Every start is kept, so the instance runs from each start, or the
+            # first step when it is already running, to the end of that run of
+            # kept steps. Adding the starts to the kept mask carries through
+            # each run from its first start and clears it.
+            seeds = start | (keep & 1 if running else 0)
+            return (keep & ~(keep + seeds)) | seeds
+        # Starts that are stopped again at the next step, follow them one step
+        # at a time
+        mask = 0
+        for i in range(self.steps):
+            bit = 1 << i
+            running = bool((keep if running else start) & bit)
+            if running:
+                mask |= bit
+        return mask
+
+    def simulate(self, record):
+        """
+        :param record: an InstanceRecord of a GCP instance
+
+        Returns a (running mask, events) tuple for the instance. Events are
+        (step, action) tuples with the actions of the evaluator's outputs.
+        """
+        (keep, start, delete) = self.masks(record)
+        running = record.status == 'RUNNING'
+        mask = self.running_mask(running, keep, start)
+        before = ((mask << 1) | (1 if running else 0)) & self.full
+        changes = mask ^ before
+        suspend = record.shutdown_type == 'suspend' and record.suspend_blocker is None
+        suspended = record.status == 'SUSPENDED'
+        events = []
+        while changes:
+            bit = changes & -changes
+            changes ^= bit
+            i = bit.bit_length() - 1
+            if mask & bit:
+                events.append((i, 'to_resume' if suspended else 'to_start'))
+            elif delete & bit:
+                events.append((i, 'to_delete'))
+                suspended = False
+            else:
+                events.append((i, 'to_suspend' if suspend else 'to_terminate'))
+                suspended = suspend
+        return (mask, events)
+
+    def running_hours(self, mask):
+        return bin(mask).count('1') * self.step.total_seconds() / 3600
+
+def simulate_fleet(instances, simulation, forecast_file=None, verbose=False):
+    """
+    :param instances: An iterable of (zone, GCP instance) tuples.
+    :param simulation: The FleetSimulation to replay the instances in.
+    :param forecast_file: An optional file every instance forecast is written
+    to as a JSON line.
+    :param verbose: Whether every forecast action is printed.
+
+    Returns the forecast of the fleet: the number of actions of each kind
+    overall and per day, and the running hours in total, per geo and per
+    owner.
+    """
+    forecast = {
+        'start': simulation.start.isoformat(),
+        'end': (simulation.start + simulation.step * simulation.steps).isoformat(),
+        'step_minutes': simulation.step.total_seconds() / 60,
+        'instances': 0,
+        'events': {},
+        'daily_events': {},
+        'running_hours': {'total': 0.0, 'geo': {}, 'owner': {}}
+    }
+    hours = forecast['running_hours']
+    for zone, instance in instances:
+        record = InstanceRecord(instance, zone)
+        if record.status not in EVALUATED_STATUSES:
+            continue
+        forecast['instances'] += 1
+        (mask, events) = simulation.simulate(record)
+        running_hours = simulation.running_hours(mask)
+        hours['total'] += running_hours
+        hours['geo'][record.geo] = hours['geo'].get(record.geo, 0.0) + running_hours
+        hours['owner'][record.owner] = hours['owner'].get(record.owner, 0.0) + running_hours
+
+        for (step, action) in events:
+            forecast['events'][action] = forecast['events'].get(action, 0) + 1
+            day = forecast['daily_events'].setdefault(simulation.dates[step], {})
+            day[action] = day.get(action, 0) + 1
+            if verbose:
+                print('{0} {1}: {2}'.format(simulation.timestamps[step], instance_display_name(record), action))
+        if forecast_file:
+            forecast_file.write(json.dumps({
+                'name': record.name,
+                'zone': record.zone,
+                'geo': record.geo,
+                'owner': record.owner,
+                'running_hours': running_hours,
+                'events': [[simulation.timestamps[step], action] for (step, action) in events]
+            }) + '\n')
+    return forecast
+
+def chunk_list(lst, n):
+    """Yield successive n-sized chunks from lst."""
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+# Slack accepts at most 50 blocks per message and 2000 characters per field.
+# Messages are also kept well below the request size limit.
+SLACK_MAX_BLOCKS = 50
+SLACK_MAX_BYTES = 30000
+SLACK_MAX_FIELD_LENGTH = 2000
+# The number of messages the workflow sends; the report is cut to fit
+SLACK_MAX_MESSAGES = 3
+# States with more instances than this are summarized by reason
+SLACK_COLLAPSE_THRESHOLD = 25
+SLACK_COLLAPSE_REASONS = 9
+
+def slack_text(text, text_type='plain_text'):
+    text = str(text)
+    if len(text) > SLACK_MAX_FIELD_LENGTH:
+        text = text[:SLACK_MAX_FIELD_LENGTH - 3] + '...'
+    return {"type": text_type, "text": text}
+
+def slack_state_header(state, title=None):
+    return {
+        "type": "section",
+        "text": slack_text(title or "*{0}*".format(state.capitalize()), 'mrkdwn'),
+        "fields": [
+            slack_text("*Instance*", 'mrkdwn'),
+            slack_text("*Reason*", 'mrkdwn')
+        ]
+    }
+
+class SlackReportEncoder(object):
+    """
+    Encodes report blocks one at a time into Slack messages that stay within
+    the block count and size limits. Every block is serialized once and the
+    messages are joined from the encoded blocks.
+    """
+
+    def __init__(self, max_blocks=SLACK_MAX_BLOCKS, max_bytes=SLACK_MAX_BYTES, max_messages=SLACK_MAX_MESSAGES):
+        self.max_blocks = max_blocks
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.messages = [[]]
+        self.size = 2
+        self.omitted = 0
+
+    def fits(self, encoded, reserve_blocks=0, reserve_bytes=0):
+        current = self.messages[-1]
+        return (len(current) + 1 + reserve_blocks <= self.max_blocks
+            and self.size + len(encoded) + 2 + reserve_bytes <= self.max_bytes)
+
+    def add(self, block, continuation=None):
+        """
+        :param block: A Slack block.
+        :param continuation: A block to repeat at the top of a new message when
+        the block does not fit in the current one.
+
+        Returns False when the block was left out because the last message is
+        full.
+        """
+        encoded = json.dumps(block)
+        last = len(self.messages) >= self.max_messages
+        # Leave room in the last message for the block and the bytes of the
+        # note of what was left out
+        if self.fits(encoded, reserve_blocks=1 if last else 0, reserve_bytes=200 if last else 0):
+            self.append(encoded)
+            return True
+        if last:
+            self.omitted += 1
+            return False
+        self.messages.append([])
+        self.size = 2
+        if continuation is not None:
+            self.append(json.dumps(continuation))
+        self.append(encoded)
+        return True
+
+    def append(self, encoded):
+        self.messages[-1].append(encoded)
+        self.size += len(encoded) + 2
+
+    def encode(self):
+        """Returns the messages as JSON arrays of blocks."""
+        if self.omitted:
+            self.append(json.dumps({
+                "type": "context",
+                "elements": [slack_text('{0} more sections were left out of this report. See the workflow run for all instances.'.format(self.omitted), 'mrkdwn')]
+            }))
+        return ['[' + ', '.join(message) + ']' for message in self.messages if message]
+
+def action_result_status(result):
+    """
+    :param result: The result of an instance action from the action executor.
+
+    Returns the final status of the operation, or `sent` or `failed` for the
+    request when the operation was not waited for.
+    """
+    return result.get('status') or ('sent' if result['success'] else 'failed')
+
+def summarize_action_results(results):
+    """
+    :param results: A dict of instance name to the result of its action.
+
+    Returns a dict of API call to the number of results in each status.
+    """
+    summary = {}
+    for result in results.values():
+        statuses = summary.setdefault(result['action'], {})
+        status = action_result_status(result)
+        statuses[status] = statuses.get(status, 0) + 1
+    return summary
+
+def add_action_results(encoder, results):
+    """
+    Adds the outcome of the actions taken to the report: the number of
+    instances in each status per API call, and the instances whose action did
+    not succeed.
+    """
+    summary = summarize_action_results(results)
+    encoder.add({
+        "type": "section",
+        "text": slack_text("*Actions*", 'mrkdwn'),
+        "fields": [slack_text("*{0}*: {1}".format(action.capitalize(), ', '.join('{0} {1}'.format(count, status) for (status, count) in sorted(statuses.items()))), 'mrkdwn')
+            for (action, statuses) in sorted(summary.items())]
+    })
+    failures = [(name, result) for (name, result) in sorted(results.items()) if action_result_status(result) in ('failed', 'timed_out')]
+    if not failures:
+        return
+    if len(failures) > SLACK_COLLAPSE_THRESHOLD:
+        counts = {}
+        for (_name, result) in failures:
+            key = '{0} {1}'.format(result['action'], action_result_status(result))
+            counts[key] = counts.get(key, 0) + 1
+        encoder.add({
+            "type": "section",
+            "text": slack_text("*Failed actions* ({0} instances)".format(len(failures)), 'mrkdwn'),
+            "fields": [slack_text("{0}: {1}".format(key, count)) for (key, count) in sorted(counts.items())]
+        })
+        return
+    header = {
+        "type": "section",
+        "text": slack_text("*Failed actions*", 'mrkdwn'),
+        "fields": [slack_text("*Instance*", 'mrkdwn'), slack_text("*Error*", 'mrkdwn')]
+    }
+    encoder.add(header)
+    continuation = dict(header, text=slack_text("*Failed actions* (continued)", 'mrkdwn'))
+    for chunk in chunk_list(failures, 5):
+        section = {"type": "section", "fields": []}
+        for (name, result) in chunk:
+            section['fields'].append(slack_text(name))
+            section['fields'].append(slack_text('{0} {1}: {2}'.format(result['action'], action_result_status(result), result.get('error'))))
+        encoder.add(section, continuation)
+
+def states_to_slack_messages(states, results=None):
+    """
+    :param states a hash of the various states with instances and reasons
+    :param results: An optional dict of instance display name to the result of
+    the action taken for it, added to the report after the summary.
+
+    Converts the states into a list of slack consumable blocks, one per
+    message. The first message starts with the number of instances in each
+    state. States with many instances are summarized by reason. The results
+    are reported even when there are no states.
+    """
+    encoder = SlackReportEncoder()
+    counts = [(state, len(instances)) for state, instances in states.items() if instances]
+    # In delta mode the states can be empty while actions of unchanged
+    # instances were still taken
+    if not counts and not results:
+        return ['[]']
+
+    if counts:
+        encoder.add({
+            "type": "section",
+            "text": slack_text("*Summary*", 'mrkdwn'),
+            "fields": [slack_text("*{0}*: {1}".format(state.capitalize(), count), 'mrkdwn') for (state, count) in counts]
+        })
+    if results:
+        add_action_results(encoder, results)
+
+    for state, count in counts:
+        instances = states[state]
+        encoder.add({"type": "divider"})
+        if count > SLACK_COLLAPSE_THRESHOLD:
+            reasons = {}
+            for reason in instances.values():
+                reasons[reason] = reasons.get(reason, 0) + 1
+            top = sorted(reasons.items(), key=lambda item: (-item[1], item[0]))
+            rows = top[:SLACK_COLLAPSE_REASONS]
+            other = sum(n for (_reason, n) in top[SLACK_COLLAPSE_REASONS:])
+            if other:
+                rows.append(('Other reasons', other))
+            encoder.add({
+                "type": "section",
+                "text": slack_text("*{0}* ({1} instances)".format(state.capitalize(), count), 'mrkdwn'),
+                "fields": [slack_text("{0}: {1}".format(reason, n)) for (reason, n) in rows]
+            })
+            continue
+
+        header = slack_state_header(state)
+        encoder.add(header)
+        continuation = slack_state_header(state, "*{0}* (continued)".format(state.capitalize()))
+        for inst in chunk_list(list(instances.items()), 5):
+            section = {
+                "type": "section",
+                "fields": []
+            }
+            for instance, reason in inst:
+                section['fields'].append(slack_text(instance))
+                section['fields'].append(slack_text(reason))
+            encoder.add(section, continuation)
+
+    return encoder.encode()
+
+def states_to_slack_block(states):
+    """
+    :param states a hash of the various states with instances and reasons
+
+    Converts the states into a slack consumable block. This is the first
+    message of `states_to_slack_messages`.
+    """
+    return states_to_slack_messages(states)[0]
+
+def forecast_to_slack_messages(forecast):
+    """
+    :param forecast: The forecast from `simulate_fleet`.
+
+    Converts the forecast into a slack consumable block with the number of
+    each action and the running hours per geo and of the busiest owners.
+    """
+    blocks = [{
+        "type": "section",
+        "text": slack_text("*Forecast from {0} to {1} for {2} instances*".format(forecast['start'], forecast['end'], forecast['instances']), 'mrkdwn'),
+        "fields": [slack_text("*{0}*: {1}".format(action, count), 'mrkdwn') for (action, count) in sorted(forecast['events'].items())]
+            + [slack_text("*Running hours*: {0:,.0f}".format(forecast['running_hours']['total']), 'mrkdwn')]
+    }]
+    for group in ('geo', 'owner'):
+        hours = sorted(forecast['running_hours'][group].items(), key=lambda item: -item[1])
+        if hours:
+            blocks.append({"type": "divider"})
+            blocks.append({
+                "type": "section",
+                "text": slack_text("*Running hours by {0}*".format(group), 'mrkdwn'),
+                # Sections hold at most 10 fields
+                "fields": [slack_text("{0}: {1:,.0f}".format(name, value)) for (name, value) in hours[:10]]
+            })
+    return [json.dumps(blocks)]
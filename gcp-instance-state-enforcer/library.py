@@ -0,0 +1,53 @@
+"""
+Imports the modules the Relay step scripts share.
+
+Relay only fetches the step script itself, so the modules next to it in the
+repository are downloaded when they are not installed. They are downloaded
+from the `libraryRef` of the step, the workflow parameter of the same name,
+which is the ref the step scripts fetch this module from as well.
+"""
+
+import importlib
+import os
+import sys
+import tempfile
+import urllib.request
+
+LIBRARY_URL = 'https://raw.githubusercontent.com/puppetlabs/support-relay_workflows/{0}/gcp-instance-state-enforcer/{1}.py'
+LIBRARY_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gcp-instance-state-enforcer')
+DEFAULT_REF = 'main'
+
+def get_library_ref():
+    """Returns the `libraryRef` of the Relay step, or main when it is not set."""
+    from relay_sdk import Interface, Dynamic as D
+    return Interface().get(D.libraryRef) or DEFAULT_REF
+
+def fetch_library(module, ref, url=LIBRARY_URL):
+    """
+    :param module: The name of the module to fetch.
+    :param ref: The git ref to fetch the module at.
+    :param url: The URL of the modules with placeholders for the ref and name.
+
+    Downloads the module to a temporary directory on the import path.
+    """
+    os.makedirs(LIBRARY_DIRECTORY, exist_ok=True)
+    with urllib.request.urlopen(url.format(ref, module), timeout=60) as response:
+        source = response.read()
+    with open(os.path.join(LIBRARY_DIRECTORY, '{0}.py'.format(module)), 'wb') as fh:
+        fh.write(source)
+    if LIBRARY_DIRECTORY not in sys.path:
+        sys.path.append(LIBRARY_DIRECTORY)
+
+def import_library(module, ref=None):
+    """
+    :param module: The name of the module to import.
+    :param ref: The git ref to fetch the module at when it is not installed,
+    the `libraryRef` of the step by default.
+
+    Returns the imported module.
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        fetch_library(module, ref or get_library_ref())
+        return importlib.import_module(module)
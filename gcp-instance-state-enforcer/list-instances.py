@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+The `list-instances` Relay step. Lists the instances of the zone of the
+`google` connection, or of `zones`, for `identify-instance-states`.
+
+Only the fields the evaluator reads are requested and instances in statuses
+it does not act on are filtered out by the API, so the `instances` output is
+a fraction of the size of full instance resources.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import urllib.request
+
+# Relay only fetches this script. The modules next to it in the repository are
+# imported through library.py, which is fetched, like them, from the
+# `libraryRef` of the step when it is not installed.
+try:
+    import library
+except ImportError:
+    from relay_sdk import Interface, Dynamic as D
+    LIBRARY_DIRECTORY = os.path.join(tempfile.gettempdir(), 'gcp-instance-state-enforcer')
+    os.makedirs(LIBRARY_DIRECTORY, exist_ok=True)
+    with urllib.request.urlopen('https://raw.githubusercontent.com/puppetlabs/support-relay_workflows/{0}/gcp-instance-state-enforcer/library.py'.format(
+            Interface().get(D.libraryRef) or 'main'), timeout=60) as response:
+        with open(os.path.join(LIBRARY_DIRECTORY, 'library.py'), 'wb') as fh:
+            fh.write(response.read())
+    sys.path.append(LIBRARY_DIRECTORY)
+    import library
+
+instance_states = library.import_library('instance_states')
+gcp_compute = library.import_library('gcp_compute')
+
+def list_instances(google, zones):
+    """
+    :param google: The `google` step configuration with the service account.
+    :param zones: The zones to list.
+
+    Returns a dict of zone to the list of its instances.
+    """
+    (compute, project_id) = instance_states.build_compute(google)
+    instances = {zone: [] for zone in zones}
+    for zone, instance in instance_states.iter_api_instances(compute, project_id, zones):
+        instances[zone].append(instance)
+    return instances
+
+if __name__ == '__main__':
+    from relay_sdk import Interface, Dynamic as D
+
+    relay = Interface()
+    google = relay.get(D.google)
+    zones = relay.get(D.zones)
+    if isinstance(zones, str):
+        zones = json.loads(zones)
+    zones = zones or [google['zone']]
+
+    instances = list_instances(google, zones)
+    # A single zone is set as a list like the gcp-step-instance-list step,
+    # several as the zone keyed map `identify-instance-states` also accepts
+    output = instances[zones[0]] if len(zones) == 1 else instances
+    for zone in zones:
+        print('Listed {0} instances in {1}'.format(len(instances[zone]), zone))
+    print('Setting {0} bytes of instances'.format(len(json.dumps(output))))
+    relay.outputs.set('instances', output)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Load tests the `execute-instance-actions` step of the workflow against the
+fake Compute API in fake_compute.py, with a plan that mixes every action.
+
+    ./load-test-actions.py --instances 5000 --ineligible 0.1
+    ./load-test-actions.py --instances 2000 --latency 0.1 --quota 10
+    ./load-test-actions.py --instances 1000 --error-rate 0.05 --ineligible 0.1 --format json
+
+The step script runs unmodified in a subprocess, with the Relay metadata
+service and the Compute API both served by the fake. Reports the wall time of
+the step, the API requests it made and how its instances ended up.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_compute
+import instance_states
+
+STEP = 'execute-instance-actions.py'
+# The action outputs of the executor's plan, in turn, with the status of
+# their instances and their report state
+PLAN_ACTIONS = [
+    ('to_terminate', 'RUNNING', 'stopping'),
+    ('to_suspend', 'RUNNING', 'suspending'),
+    ('to_delete', 'RUNNING', 'deleting'),
+    ('to_start', 'TERMINATED', 'starting'),
+    ('to_resume', 'SUSPENDED', 'resuming')
+]
+# The connection of the step. The fake does not check credentials.
+SERVICE_ACCOUNT_KEY = {'type': 'service_account', 'project_id': 'fake', 'client_email': 'load-test@fake.iam.gserviceaccount.com'}
+
+def build_plan(fleet):
+    """
+    :param fleet: The instances, which are given the status of their action.
+
+    Returns a `plan` as set by `identify-instance-states` that spreads the
+    instances over every action in turn.
+    """
+    zones = sorted(set(instance['zone'].rsplit('/', 1)[-1] for instance in fleet))
+    report = instance_states.RunReport(zones)
+    for index, instance in enumerate(fleet):
+        (output, status, state) = PLAN_ACTIONS[index % len(PLAN_ACTIONS)]
+        instance['status'] = status
+        zone = instance['zone'].rsplit('/', 1)[-1]
+        report.outputs[output][zone].append({'name': instance['name'], 'zone': zone, 'shutdown_type': 'suspend' if output == 'to_suspend' else 'shutdown'})
+        report.states[state]['{0}/{1}'.format(zone, instance['name'])] = 'Load test'
+    return {'actions': report.outputs, 'states': report.states, 'messages': instance_states.states_to_slack_messages(report.states)}
+
+def build_spec(args, fleet):
+    """Returns the step spec served to the step."""
+    return {
+        'google': {'service_account_info': {'serviceAccountKey': json.dumps(SERVICE_ACCOUNT_KEY)}},
+        'plan': build_plan(fleet),
+        'concurrency': args.concurrency,
+        'waitTimeout': args.wait_timeout,
+        'rateLimit': args.rate_limit,
+        'maxAttempts': args.max_attempts
+    }
+
+def run_step(args, url):
+    """
+    :param url: The URL of the fake.
+
+    Runs the step against the fake and returns its (exit code, seconds, log).
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), STEP)
+    env = dict(os.environ, METADATA_API_URL=url, GCP_COMPUTE_ENDPOINT=url)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(script), env.get('PYTHONPATH')]))
+    start = time.monotonic()
+    process = subprocess.run([sys.executable, script], env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return (process.returncode, time.monotonic() - start, process.stdout)
+
+def summarize_results(results):
+    """
+    :param results: The `results` output of the step, a dict of zone to
+    instance name to result.
+
+    Returns a dict of the (action, status) of the results to their count.
+    """
+    counts = {}
+    for zone_results in (results or {}).values():
+        for result in zone_results.values():
+            status = result.get('status') or ('sent' if result['success'] else 'failed')
+            key = '{0} {1}'.format(result['action'], status)
+            counts[key] = counts.get(key, 0) + 1
+    return dict(sorted(counts.items()))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the instance action executor against a fake Compute API.')
+    parser.add_argument('--instances', type=int, default=1000, help='The number of instances to act on')
+    parser.add_argument('--zones', default='us-west1-a,us-west1-b,us-west1-c', help='Comma separated zones')
+    parser.add_argument('--ineligible', type=float, default=0.0, help='The share of instances that can not be suspended')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every API request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='The most seconds randomly added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='The share of API calls that fail with a 503')
+    parser.add_argument('--quota', type=float, help='The most mutations per second the fake accepts')
+    parser.add_argument('--throttle-status', type=int, choices=[403, 429], default=429, help='The status of throttled requests')
+    parser.add_argument('--operation-seconds', type=float, default=1.0, help='Seconds until an operation is done')
+    parser.add_argument('--concurrency', type=int, default=50, help='The `concurrency` parameter of the step')
+    parser.add_argument('--wait-timeout', type=int, default=600, help='The `waitTimeout` parameter of the step')
+    parser.add_argument('--rate-limit', type=float, default=20, help='The `rateLimit` parameter of the step')
+    parser.add_argument('--max-attempts', type=int, default=5, help='The `maxAttempts` parameter of the step')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the fleet and the injected faults')
+    parser.add_argument('--format', choices=['table', 'json'], default='table', help='The report format')
+    parser.add_argument('--log', help='Write the output of the step to this file')
+    args = parser.parse_args(argv)
+
+    fleet = fake_compute.make_fleet(args.instances, args.zones.split(','), 'RUNNING', args.ineligible, args.seed)
+    fake = fake_compute.FakeCompute(fleet, args.latency, args.jitter, args.error_rate, args.quota, args.operation_seconds,
+        args.throttle_status, build_spec(args, fleet), args.seed)
+    server = fake_compute.serve(fake)
+    try:
+        (returncode, seconds, log) = run_step(args, fake_compute.server_url(server))
+    finally:
+        server.shutdown()
+    if args.log:
+        with open(args.log, 'w') as fh:
+            fh.write(log)
+
+    stats = fake.stats()
+    report = {
+        'instances': args.instances,
+        'exit_code': returncode,
+        'wall_seconds': round(seconds, 3),
+        'instances_per_second': round(args.instances / seconds, 1) if seconds > 0 else None,
+        'requests': stats['counters'],
+        'statuses': stats['statuses'],
+        'results': summarize_results(fake.outputs.get('results')),
+        'summary': fake.outputs.get('summary'),
+        # Set by the executor when it could not carry out the actions
+        'error': fake.outputs.get('error')
+    }
+    if args.format == 'json':
+        print(json.dumps(report, indent=2))
+    else:
+        for name in ['instances', 'exit_code', 'error', 'wall_seconds', 'instances_per_second']:
+            print('{0:<24}{1}'.format(name, report[name]))
+        for section in ['requests', 'statuses', 'results', 'summary']:
+            print('{0}:'.format(section))
+            for name, value in sorted((report[section] or {}).items()):
+                print('  {0:<22}{1}'.format(name, value))
+    if returncode != 0 or report['error']:
+        print(log[-2000:], file=sys.stderr)
+    return returncode or (1 if report['error'] else 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Reports on the decision history written by the `historyDir` parameter of
+`identify-instance-states` or the `--history` option of
+evaluate-instance-states.py.
+
+    ./report-decision-history.py history/
+    ./report-decision-history.py --by owner --since 2021-06 history/
+    ./report-decision-history.py --by geo --format json history/
+
+For every month and group it reports the instance hours that instances were
+running and off, and the number of each action taken. The columns are read
+through memory maps, so months of hourly runs of a large fleet are reported
+on in seconds.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import instance_states
+
+GROUP_COLUMNS = ['owner', 'geo', 'instance', 'reason']
+
+def format_table(summary, group_by):
+    names = ['month'] + list(group_by) + ['running_hours', 'off_hours'] + instance_states.ACTION_OUTPUTS
+    rows = [names] + [[str(row[name]) for name in names] for row in summary]
+    widths = [max(len(row[index]) for row in rows) for index in range(len(names))]
+    return ''.join('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n' for row in rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report on the decision history of the GCP instance state enforcer.')
+    parser.add_argument('history', help='The decision history directory')
+    parser.add_argument('--by', default='owner,geo', help='Comma separated columns to group by: {0}, or none'.format(', '.join(GROUP_COLUMNS)))
+    parser.add_argument('--since', metavar='YYYY-MM', help='The first month to report')
+    parser.add_argument('--until', metavar='YYYY-MM', help='The last month to report')
+    parser.add_argument('--format', choices=['table', 'json', 'csv'], default='table', help='The output format')
+    args = parser.parse_args(argv)
+
+    group_by = [column for column in args.by.split(',') if column and column != 'none']
+    for column in group_by:
+        if column not in GROUP_COLUMNS:
+            parser.error('can not group by {0}'.format(column))
+    if not os.path.isdir(args.history):
+        parser.error('no decision history in {0}'.format(args.history))
+
+    reader = instance_states.HistoryReader(args.history)
+    try:
+        summary = instance_states.summarize_history(reader, group_by, args.since, args.until)
+    finally:
+        reader.close()
+
+    if args.format == 'json':
+        sys.stdout.write(json.dumps(summary, indent=2) + '\n')
+    elif args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, ['month'] + group_by + ['running_hours', 'off_hours'] + instance_states.ACTION_OUTPUTS)
+        writer.writeheader()
+        writer.writerows(summary)
+    else:
+        sys.stdout.write(format_table(summary, group_by))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
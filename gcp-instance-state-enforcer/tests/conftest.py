@@ -0,0 +1,27 @@
+import datetime
+import importlib.util
+import os
+import sys
+
+import pytest
+
+# The modules sit next to the step scripts rather than in a package
+DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DIRECTORY)
+
+# A Wednesday afternoon, so the fleets have instances on either side of their
+# working hours in every geo
+NOW = datetime.datetime(2024, 3, 6, 15, 20, tzinfo=datetime.timezone.utc)
+
+@pytest.fixture(scope='session')
+def benchmark():
+    """The benchmark script, for its synthetic fleet generator."""
+    spec = importlib.util.spec_from_file_location('benchmark_instance_states', os.path.join(DIRECTORY, 'benchmark-instance-states.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def fleet(benchmark):
+    """A synthetic fleet with the label mix of the benchmark, generated for NOW."""
+    return benchmark.generate_fleet(600, seed=1, now=NOW)
@@ -0,0 +1,71 @@
+import instance_states
+from conftest import NOW
+
+def blocker(machine_type, **fields):
+    return instance_states.get_suspend_blocker(dict(fields, machineType='zones/us-west1-a/machineTypes/{0}'.format(machine_type)))
+
+def test_suspend_blocker_of_predefined_machine_types():
+    for machine_type in ['n2-highmem-64', 'n2-highmem-80', 'n2d-highmem-64', 'c2d-highmem-56', 'n1-standard-96', 'c3-standard-88-lssd']:
+        assert blocker(machine_type) == 'More than 208 GB of memory', machine_type
+    for machine_type in ['n1-highmem-32', 'n2-highmem-16', 'e2-standard-4', 'e2-medium', 'c2-standard-30', 'a3-highgpu-8g']:
+        assert blocker(machine_type) is None, machine_type
+
+def test_suspend_blocker_of_memory_optimized_and_custom_machine_types():
+    assert blocker('m2-ultramem-208').startswith('Memory-optimized')
+    assert blocker('n1-megamem-96').startswith('Memory-optimized')
+    assert blocker('n2-custom-8-262144') == 'More than 208 GB of memory'
+    assert blocker('custom-8-65536-ext') is None
+    assert blocker('e2-standard-4', guestAccelerators=[{'acceleratorCount': 1}]) == 'GPUs attached'
+    assert blocker('e2-standard-4', disks=[{'type': 'SCRATCH'}]) == 'Local SSDs attached'
+
+def test_creation_timestamps_do_not_fill_the_label_date_cache(fleet):
+    instance_states.parse_label_date.cache_clear()
+    records = [instance_states.InstanceRecord(instance) for instance in fleet]
+    assert all(record.launch_date is not None for record in records)
+    # Only the stopped_until dates of the fleet are cached
+    stopped_until = set((record.labels or {}).get('stopped_until') for record in records) - {None}
+    assert instance_states.parse_label_date.cache_info().currsize == len(stopped_until)
+
+def test_label_policy_caches_are_bounded(monkeypatch):
+    monkeypatch.setattr(instance_states, 'LABEL_CACHE_SIZE', 10)
+    policy = instance_states.LabelPolicy(['owner'])
+    for index in range(25):
+        assert policy.violations({'owner': 'owner_{0}'.format(index)}) == ()
+        assert policy.is_valid('lifetime', '{0}d'.format(index + 1))
+    assert len(policy._labels_cache) <= 10
+    assert len(policy._value_cache) <= 10
+    assert policy.violations({'lifetime': 'forever'}) == ("Missing label 'owner'", 'Invalid lifetime label value: "forever"')
+
+def evaluate(fleet, config, workers=None):
+    """Returns the decisions and the metrics counters of evaluating the fleet."""
+    instance_states.METRICS.reset()
+    instances = ((None, instance) for instance in fleet)
+    if workers:
+        decisions = instance_states.evaluate_instances_parallel(instances, workers, NOW, config, chunk_size=50)
+    else:
+        decisions = instance_states.evaluate_instances(instances, NOW, config=config)
+    decisions = [decision.to_json() for decision in decisions]
+    return (decisions, dict(instance_states.METRICS.counters))
+
+def test_parallel_evaluation_matches_the_serial_one(fleet):
+    config = instance_states.EvaluatorConfig(start_lead_minutes=60, start_waves=3)
+    (serial, serial_counters) = evaluate(fleet, config)
+    (parallel, parallel_counters) = evaluate(fleet, config, workers=3)
+    assert len(serial) > 0
+    # The decisions come out in the order the instances were read
+    assert parallel == serial
+    assert parallel_counters == serial_counters
+
+def test_reports_of_serial_and_parallel_evaluations_are_the_same(fleet):
+    reports = []
+    for workers in (None, 2):
+        instances = ((None, instance) for instance in fleet)
+        if workers:
+            decisions = instance_states.evaluate_instances_parallel(instances, workers, NOW, chunk_size=50)
+        else:
+            decisions = instance_states.evaluate_instances(instances, NOW)
+        report = instance_states.RunReport()
+        for decision in decisions:
+            report.add(decision)
+        reports.append((report.outputs, report.states, instance_states.states_to_slack_messages(report.states)))
+    assert reports[0] == reports[1]
@@ -0,0 +1,54 @@
+import json
+
+import googleapiclient.errors
+import httplib2
+
+import gcp_compute
+
+def http_error(status, reason, message):
+    content = json.dumps({'error': {'errors': [{'reason': reason, 'message': message}], 'message': message}})
+    return googleapiclient.errors.HttpError(httplib2.Response({'status': status}), content.encode('utf-8'))
+
+class FakeRequest(object):
+    def __init__(self, outcomes):
+        self.outcomes = outcomes
+
+    def execute(self):
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def execute(outcomes):
+    clock = FakeClock()
+    controller = gcp_compute.RateController(10, clock=clock.clock, sleep=clock.sleep)
+    request = FakeRequest(list(outcomes))
+    return gcp_compute.execute_requests(None, 'suspend', [('us-west1-a/web-1', lambda: request)], 1, controller)['us-west1-a/web-1']
+
+def test_retried_server_error_makes_the_result_uncertain():
+    result = execute([http_error(503, 'backendError', 'Backend Error'), http_error(400, 'resourceNotReady', 'The resource is not ready')])
+    assert not result['success'] and not result['retryable']
+    assert result['attempts'] == 2
+    assert result['uncertain']
+    assert not gcp_compute.is_suspend_unsupported(result)
+
+def test_throttling_does_not_make_the_result_uncertain():
+    result = execute([http_error(429, 'rateLimitExceeded', 'Rate Limit Exceeded'), http_error(400, 'badRequest', 'Instances with guest accelerators do not support suspend.')])
+    assert not result['success']
+    assert not result['uncertain']
+    assert gcp_compute.is_suspend_unsupported(result)
+
+def test_first_attempt_is_certain():
+    result = execute([{'name': 'operation-1'}])
+    assert result['success'] and result['operation'] == 'operation-1'
+    assert not result['uncertain']
@@ -0,0 +1,89 @@
+import datetime
+from datetime import timedelta
+
+import instance_states
+from conftest import NOW
+
+def hours(day, first, last):
+    """Returns the bits of the hours from first up to last on the day."""
+    return sum(1 << (day * 24 + hour) for hour in range(first, last))
+
+def test_workhours_grammar():
+    assert instance_states.get_workhours_times(None) == ((None, 7, 18),)
+    assert instance_states.get_workhours_times('9-17') == ((None, 9, 17),)
+    assert instance_states.get_workhours_times('8-12_13-17') == ((None, 8, 12), (None, 13, 17))
+    assert instance_states.get_workhours_times('mon-thu_8-18_fri_8-14') == (((0, 1, 2, 3), 8, 18), ((4,), 8, 14))
+    # Day ranges wrap around the end of the week
+    assert instance_states.get_workhours_times('fri-mon_10-12') == (((4, 5, 6, 0), 10, 12),)
+    for value in ['', 'mon', '9-17_mon', '9to5', 'funday_9-17', '9-17-18']:
+        assert instance_states.get_workhours_times(value) is None, value
+        assert not instance_states.validate_workhours_value(value)
+
+def test_hours_mask():
+    assert instance_states.get_hours_mask(9, 17) == hours(0, 9, 17)
+    # Crossing midnight covers the end and the start of the day
+    assert instance_states.get_hours_mask(22, 6) == hours(0, 22, 24) | hours(0, 0, 6)
+    assert instance_states.get_hours_mask(0, 24) == hours(0, 0, 24)
+
+def test_schedule_masks():
+    workhours = instance_states.get_workhours_times('9-17')
+    assert instance_states.get_schedule_mask(workhours, 'weekdays') == sum(hours(day, 9, 17) for day in range(5))
+    assert instance_states.get_schedule_mask(workhours, 'daily') == sum(hours(day, 9, 17) for day in range(7))
+    assert instance_states.get_schedule_mask(workhours, None) == instance_states.get_schedule_mask(workhours, 'weekdays')
+    assert instance_states.get_schedule_mask(workhours, 'continuous') == instance_states.WEEK_MASK
+    # Windows after days of their own ignore the runschedule
+    workhours = instance_states.get_workhours_times('9-17_sat_10-12')
+    assert instance_states.get_schedule_mask(workhours, 'weekdays') == hours(5, 10, 12) | sum(hours(day, 9, 17) for day in range(5))
+
+def test_current_worktime_in_the_geo():
+    workhours = instance_states.get_workhours_times('9-17')
+    # 15:20 UTC on a Wednesday is 07:20 in Los Angeles and 23:20 in Singapore
+    assert not instance_states.is_current_worktime(workhours, 'amer', 'weekdays', NOW)
+    assert instance_states.is_current_worktime(workhours, 'amer', 'weekdays', NOW + timedelta(hours=2))
+    assert not instance_states.is_current_worktime(workhours, 'apj', 'weekdays', NOW)
+    assert instance_states.is_current_worktime(workhours, 'emea', 'weekdays', NOW)
+    # Saturday
+    assert not instance_states.is_current_worktime(workhours, 'emea', 'weekdays', NOW + timedelta(days=3))
+    assert instance_states.is_current_worktime(workhours, 'emea', 'daily', NOW + timedelta(days=3))
+
+def test_next_workhours_boundary():
+    record = instance_states.InstanceRecord({'name': 'web-1', 'zone': 'us-west1-a', 'status': 'RUNNING',
+        'creationTimestamp': '2024-01-01T00:00:00.000-07:00', 'labels': {'geo': 'amer', 'workhours': '9-17'}})
+    # 09:00 in Los Angeles, which is on PST in early March
+    assert instance_states.next_workhours_boundary(record, NOW) == datetime.datetime(2024, 3, 6, 17, tzinfo=datetime.timezone.utc)
+    # From Friday evening the next boundary is Monday morning
+    friday = datetime.datetime(2024, 3, 9, 2, tzinfo=datetime.timezone.utc)
+    assert instance_states.next_workhours_boundary(record, friday) == datetime.datetime(2024, 3, 11, 16, tzinfo=datetime.timezone.utc)
+    record.runschedule = 'continuous'
+    assert instance_states.next_workhours_boundary(record, NOW) is None
+
+def decide(instance, timenow, config):
+    record = instance_states.InstanceRecord(instance)
+    if record.status == 'RUNNING':
+        decision = instance_states.evaluate_running(record, timenow, config)
+    else:
+        decision = instance_states.evaluate_stopped(record, config, timenow)
+    return (decision.append_list, decision.state, decision.reason)
+
+def test_decisions_do_not_change_before_the_next_transition(fleet):
+    """The schedule and the decision cache skip instances until this time."""
+    config = instance_states.EvaluatorConfig(start_lead_minutes=60, start_waves=2)
+    step = timedelta(minutes=15)
+    for instance in fleet[:300]:
+        record = instance_states.InstanceRecord(instance)
+        if record.status not in instance_states.EVALUATED_STATUSES:
+            continue
+        transition = instance_states.next_transition(record, NOW, config)
+        decision = decide(instance, NOW, config)
+        when = NOW + step
+        while when < min(transition or NOW + timedelta(days=3), NOW + timedelta(days=3)):
+            assert decide(instance, when, config) == decision, (instance['name'], when, transition)
+            when += step
+
+def test_stored_transitions_are_dropped_when_the_logic_changes(monkeypatch):
+    entries = {'us-west1-a/dev-1': (NOW.timestamp(), 'abc')}
+    saved = instance_states.config_fingerprint()
+    assert instance_states.TransitionSchedule(entries, saved).entries == entries
+    monkeypatch.setattr(instance_states, 'LOGIC_VERSION', instance_states.LOGIC_VERSION + 1)
+    assert instance_states.config_fingerprint() != saved
+    assert instance_states.TransitionSchedule(entries, saved).entries == {}
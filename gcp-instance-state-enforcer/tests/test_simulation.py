@@ -0,0 +1,78 @@
+import instance_states
+from conftest import NOW
+
+# The status of an instance after each action
+ACTION_STATUSES = {
+    'to_terminate': 'TERMINATED',
+    'to_suspend': 'SUSPENDED',
+    'to_delete': 'TERMINATED',
+    'to_start': 'RUNNING',
+    'to_resume': 'RUNNING'
+}
+
+def step_instance(instance, simulation, config):
+    """
+    Returns the (running mask, events) of the instance from evaluating it at
+    every step of the simulation, taking each action as it is decided.
+    """
+    status = instance['status']
+    mask = 0
+    events = []
+    for i, when in enumerate(simulation.times):
+        record = instance_states.InstanceRecord(dict(instance, status=status))
+        if status == 'RUNNING':
+            decision = instance_states.evaluate_running(record, when, config)
+        else:
+            decision = instance_states.evaluate_stopped(record, config, when)
+        if decision.append_list:
+            events.append((i, decision.append_list))
+            status = ACTION_STATUSES[decision.append_list]
+        if status == 'RUNNING':
+            mask |= 1 << i
+    return (mask, events)
+
+def check_simulation(fleet, config):
+    simulation = instance_states.FleetSimulation(NOW, days=3, step_minutes=30, config=config)
+    checked = 0
+    for instance in fleet:
+        record = instance_states.InstanceRecord(instance)
+        if record.status not in instance_states.EVALUATED_STATUSES:
+            continue
+        assert simulation.simulate(record) == step_instance(instance, simulation, config), instance['name']
+        checked += 1
+    assert checked > 0
+
+def test_simulation_matches_stepping_the_evaluator(fleet):
+    check_simulation(fleet[:300], instance_states.EvaluatorConfig())
+
+def test_simulation_matches_stepping_with_start_waves(fleet):
+    check_simulation(fleet[300:], instance_states.EvaluatorConfig(start_lead_minutes=60, start_waves=2))
+
+def test_simulate_fleet_counts_the_events(fleet):
+    simulation = instance_states.FleetSimulation(NOW, days=2, step_minutes=60)
+    forecast = instance_states.simulate_fleet(((None, instance) for instance in fleet), simulation)
+    expected = {}
+    for instance in fleet:
+        record = instance_states.InstanceRecord(instance)
+        if record.status in instance_states.EVALUATED_STATUSES:
+            for (_step, action) in simulation.simulate(record)[1]:
+                expected[action] = expected.get(action, 0) + 1
+    assert forecast['events'] == expected
+    assert sum(sum(day.values()) for day in forecast['daily_events'].values()) == sum(expected.values())
+    assert abs(sum(forecast['running_hours']['geo'].values()) - forecast['running_hours']['total']) < 1e-6
+
+def test_simulation_matches_stepping_at_label_dates():
+    # Label dates fall on a step, so the steps at and after them are checked
+    labels = {'owner': 'test', 'geo': 'emea', 'lifetime': '2w', 'runschedule': 'continuous', 'autostart': 'true'}
+    fleet = [
+        {'name': 'expiring', 'status': 'RUNNING', 'creationTimestamp': '2024-02-25T10:00:00.000-07:00', 'labels': labels},
+        {'name': 'terminating', 'status': 'RUNNING', 'creationTimestamp': '2024-03-01T10:00:00.000-07:00',
+            'labels': dict(labels, lifetime='indefinite', termination_date='2024-03-07')},
+        {'name': 'stopped-until', 'status': 'TERMINATED', 'creationTimestamp': '2024-03-01T10:00:00.000-07:00',
+            'labels': dict(labels, stopped_until='2024-03-08')},
+        {'name': 'deleting', 'status': 'RUNNING', 'creationTimestamp': '2024-03-01T10:00:00.000-07:00',
+            'labels': dict(labels, termination_date='2024-03-06', shutdown_type='suspend')}
+    ]
+    for instance in fleet:
+        instance['zone'] = 'us-west1-a'
+    check_simulation(fleet, instance_states.EvaluatorConfig(terminate_days=1))
@@ -0,0 +1,74 @@
+import json
+
+import instance_states
+from instance_states import SLACK_MAX_BLOCKS, SLACK_MAX_BYTES, SLACK_MAX_MESSAGES
+
+def section(number, width=40):
+    return {"type": "section", "text": instance_states.slack_text('{0} {1}'.format(number, 'x' * width))}
+
+def check_limits(messages):
+    for message in messages:
+        blocks = json.loads(message)
+        assert len(blocks) <= SLACK_MAX_BLOCKS
+        assert len(message) <= SLACK_MAX_BYTES
+
+def test_encoder_fills_every_message_by_blocks():
+    encoder = instance_states.SlackReportEncoder()
+    added = [encoder.add(section(number)) for number in range(SLACK_MAX_BLOCKS * SLACK_MAX_MESSAGES + 20)]
+    messages = encoder.encode()
+
+    assert len(messages) == SLACK_MAX_MESSAGES
+    check_limits(messages)
+    assert encoder.omitted == added.count(False) == 21
+    # The last message is full apart from the note of what was left out
+    last = json.loads(messages[-1])
+    assert len(last) == SLACK_MAX_BLOCKS
+    assert last[-1]['type'] == 'context'
+    assert '21 more sections' in last[-1]['elements'][0]['text']
+    assert sum(len(json.loads(message)) for message in messages) - 1 == added.count(True)
+
+def test_encoder_fills_every_message_by_bytes():
+    encoder = instance_states.SlackReportEncoder()
+    added = [encoder.add(section(number, width=1900)) for number in range(60)]
+    messages = encoder.encode()
+
+    assert len(messages) == SLACK_MAX_MESSAGES
+    check_limits(messages)
+    assert added.count(False) == encoder.omitted > 0
+    assert '{0} more sections'.format(encoder.omitted) in json.loads(messages[-1])[-1]['elements'][0]['text']
+    # Every message but the last is filled to within a block of the limit
+    for message in messages[:-1]:
+        assert len(message) > SLACK_MAX_BYTES - 2000
+
+def test_encoder_repeats_the_continuation():
+    encoder = instance_states.SlackReportEncoder(max_blocks=3)
+    header = {"type": "section", "text": instance_states.slack_text('continued')}
+    for number in range(6):
+        encoder.add(section(number), header)
+    messages = [json.loads(message) for message in encoder.encode()]
+
+    assert [len(blocks) for blocks in messages] == [3, 3, 2]
+    assert messages[1][0] == header and messages[2][0] == header
+
+def test_states_to_slack_messages_stays_within_limits():
+    states = {state: {} for state in instance_states.REPORT_STATES}
+    # Below the collapse threshold every instance gets its own field
+    for state in ['stopping', 'starting', 'error']:
+        for number in range(instance_states.SLACK_COLLAPSE_THRESHOLD):
+            states[state]['us-west1-a/{0}-{1}'.format(state, number)] = 'reason {0} {1}'.format(number, 'y' * 300)
+    messages = instance_states.states_to_slack_messages(states)
+
+    assert 1 < len(messages) <= SLACK_MAX_MESSAGES
+    check_limits(messages)
+    assert json.loads(messages[0])[0]['text']['text'] == '*Summary*'
+
+def test_results_are_reported_without_states():
+    states = {state: {} for state in instance_states.REPORT_STATES}
+    results = {'us-west1-a/web-1': {'action': 'stop', 'success': False, 'error': 'quota exceeded'}}
+    messages = instance_states.states_to_slack_messages(states, results)
+
+    blocks = json.loads(messages[0])
+    assert blocks[0]['text']['text'] == '*Actions*'
+    assert blocks[0]['fields'][0]['text'] == '*Stop*: 1 failed'
+    assert any(field['text'] == 'us-west1-a/web-1' for block in blocks for field in block.get('fields', []))
+    assert instance_states.states_to_slack_messages(states) == ['[]']